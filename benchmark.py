@@ -0,0 +1,338 @@
+"""Performance benchmarks.
+
+Run this from the command line to see how long each stage of turning
+a script into a timeline takes, for scripts of various sizes:
+
+ python benchmark.py [--output results.json] [--compare old.json] [number of tweets] ...
+
+The scripts are generated by synthetic_script(), which uses all the
+features of the script language: chapters, days, author codes,
+replies, delays and times of day.
+
+Parsing time should grow linearly with the size of the script. If the
+time per tweet for the largest script is much worse than the time per
+tweet for the smallest script, something has gone quadratic and this
+script will exit with an error.
+
+It also reports roughly how much memory each parsed tweet takes up.
+
+With --cast, it also times how quickly the first word of a line is
+split into commands when the story has that many characters, each with
+their own author code. That should take about the same time however
+big the cast is.
+
+With --output, the timings are saved as JSON. Give that file to
+--compare when benchmarking a later version, and any stage that has
+become much slower is pointed out.
+"""
+
+from argparse import ArgumentParser
+from datetime import datetime
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from timeline import CommandLexer, load_config, Stream, TweetParser
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+
+# If the time per tweet for the largest script is this many times the
+# time per tweet for the smallest script, parsing isn't linear anymore.
+MAXIMUM_SLOWDOWN = 2.0
+
+# If a stage takes this many times as long as it did in the results
+# being compared against, it's a regression.
+REGRESSION_THRESHOLD = 1.5
+
+# The stages of turning a script into a timeline, in order.
+PHASES = ["load_config", "parse", "add_fuzz", "chapter_start_sanity_check",
+          "html_page", "json", "write_json"]
+
+# Codes for every author but the first, who has no code.
+AUTHOR_CODES = "+@%&*~^="
+
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+# How long a character might wait before tweeting again, and how
+# often they wait that long.
+DELAYS = ["5M"] * 3 + ["10M"] * 3 + ["20M"] * 2 + ["45M", "1H", "2H"]
+
+def author_codes(authors):
+    """Make up a code for each of the given number of authors.
+
+    Past the end of AUTHOR_CODES, codes are made by following "~" with
+    lowercase letters, so a big cast has codes that overlap with one
+    another, like "~", "~b" and "~ba".
+    """
+    codes = [""] + list(AUTHOR_CODES)
+    i = 1
+    while len(codes) < authors:
+        code = ""
+        n = i
+        while n > 0:
+            code = LETTERS[n % len(LETTERS)] + code
+            n /= len(LETTERS)
+        codes.append("~" + code)
+        i += 1
+    return codes[:authors]
+
+def synthetic_config(authors=2, days_per_chapter=7, seed=0):
+    """Generate the contents of a config.json file."""
+    return dict(
+        start_date="2011/07/09",
+        timezone="US/Central",
+        chapter_duration_days=days_per_chapter,
+        random_seed=seed,
+        authors=[dict(account="Character%d" % i, code=code,
+                      color="#%06x" % (i * 0x202020 % 0x1000000))
+                 for i, code in enumerate(author_codes(authors))],
+        )
+
+def synthetic_script(tweets, chapters=1, tweets_per_day=8, authors=2,
+                     reply_rate=0.2, seed=0):
+    """Generate the lines of a script with the given number of tweets.
+
+    The tweets are split evenly between chapters. Each in-story day
+    starts in the morning at a set time, and every other tweet comes
+    some time after the one before it. A fraction of tweets, given by
+    `reply_rate`, are replies to the tweet before.
+    """
+    rng = random.Random(seed)
+    codes = author_codes(authors)
+    chapter = None
+    day = 0
+    for line in range(tweets):
+        if line * chapters / tweets != chapter:
+            chapter = line * chapters / tweets
+            chapter_start = line
+            yield "== Chapter %d" % (chapter + 1)
+        if (line - chapter_start) % tweets_per_day == 0:
+            day += 1
+            yield "-- Day %d" % day
+            command = rng.choice(["7A", "8A", "9A"])
+        else:
+            command = rng.choice(DELAYS)
+            if rng.random() < reply_rate:
+                command = "R" + command
+        command = rng.choice(codes) + command
+        yield "%s Line %d of the script, on day %d." % (command, line, day)
+
+def days_per_chapter(tweets, chapters, tweets_per_day):
+    """How long each chapter of a synthetic script needs to be."""
+    tweets_per_chapter = tweets / chapters + 1
+    return tweets_per_chapter / tweets_per_day + 2
+
+def write_story(directory, tweets, chapters=1, tweets_per_day=8, authors=2,
+                reply_rate=0.2, seed=0):
+    """Write a synthetic input.txt and config.json to a directory."""
+    config = synthetic_config(
+        authors, days_per_chapter(tweets, chapters, tweets_per_day), seed)
+    out = open(os.path.join(directory, "config.json"), "w")
+    out.write(json.dumps(config, indent=2))
+    out.close()
+    out = open(os.path.join(directory, "input.txt"), "w")
+    for line in synthetic_script(
+        tweets, chapters, tweets_per_day, authors, reply_rate, seed):
+        out.write(line)
+        out.write("\n")
+    out.close()
+
+
+class BenchmarkStream(Stream):
+    """A Stream that leaves it to the caller to run each stage."""
+
+    def __init__(self, tweet_parser):
+        self.setup(tweet_parser, None, None)
+        self.build_cache = None
+
+
+class Timer(object):
+
+    def __init__(self):
+        self.results = {}
+
+    def time(self, phase, function, *args):
+        start = time.time()
+        value = function(*args)
+        self.results[phase] = time.time() - start
+        return value
+
+def consume(iterator):
+    for x in iterator:
+        pass
+
+def time_phases(directory):
+    """Turn the story in a directory into a timeline, one stage at a time.
+
+    :return: A dictionary mapping each stage to how long it took.
+    """
+    timer = Timer()
+    config = timer.time("load_config", load_config, directory)
+    stream = BenchmarkStream(TweetParser(config))
+    lines = open(os.path.join(directory, "input.txt"))
+    timer.time("parse", consume, stream.parse(lines))
+    timer.time("add_fuzz", stream.add_fuzz)
+    timer.time("chapter_start_sanity_check", stream.chapter_start_sanity_check)
+    timer.time("html_page", stream.html_page, True)
+    timer.time("json", lambda: stream.json)
+    timer.time("write_json", stream.write_json, open(os.devnull, "w"))
+    return timer.results
+
+def time_parallel_parse(directory, processes):
+    """Parse and fuzz the story in a directory with a pool of processes.
+
+    :return: How long it took.
+    """
+    config = load_config(directory)
+    start = time.time()
+    Stream(open(os.path.join(directory, "input.txt")), TweetParser(config),
+           processes=processes)
+    return time.time() - start
+
+def time_lexing(authors, commands=100000, seed=0):
+    """Split command words into commands, for a story with the given
+    number of authors.
+
+    :return: How many command words were split per second.
+    """
+    codes = author_codes(authors)
+    lexer = CommandLexer(codes)
+    rng = random.Random(seed)
+    words = []
+    for i in range(commands):
+        command = rng.choice(DELAYS + ["7A", "8A", "9A"])
+        if rng.random() < 0.2:
+            command = "R" + command
+        words.append(rng.choice(codes) + command)
+    start = time.time()
+    for word in words:
+        lexer.lex(word)
+    return commands / (time.time() - start)
+
+def peak_memory():
+    """The peak memory usage of this process, in bytes."""
+    # On Linux, ru_maxrss is measured in kilobytes.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def code_version():
+    """The git commit being benchmarked, if that can be found out."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, old_results):
+    """Point out the stages that have gotten slower.
+
+    :return: The number of regressions.
+    """
+    old_runs = dict((run['tweets'], run) for run in old_results['runs'])
+    regressions = 0
+    for run in results['runs']:
+        old_run = old_runs.get(run['tweets'])
+        if old_run is None:
+            continue
+        for phase in PHASES:
+            new, old = run['seconds'][phase], old_run['seconds'].get(phase)
+            if old is None or old < 0.01:
+                # Too quick to compare meaningfully.
+                continue
+            ratio = new / old
+            if ratio > REGRESSION_THRESHOLD:
+                regressions += 1
+                print "[REGRESSION] %s with %d tweets: %.2fs -> %.2fs (%.1fx)" % (
+                    phase, run['tweets'], old, new, ratio)
+    return regressions
+
+def main():
+    parser = ArgumentParser(
+        description="Time each stage of turning a script into a timeline.")
+    parser.add_argument("sizes", type=int, nargs="*", default=DEFAULT_SIZES,
+                        metavar="tweets")
+    parser.add_argument("--chapters", type=int, default=1,
+                        help="Split each script into this many chapters.")
+    parser.add_argument("--authors", type=int, default=2)
+    parser.add_argument("--tweets-per-day", type=int, default=8)
+    parser.add_argument("--reply-rate", type=float, default=0.2)
+    parser.add_argument(
+        "--processes", type=int, default=1,
+        help="Also time parsing and fuzzing chapters in this many "
+        "processes at once.")
+    parser.add_argument(
+        "--cast", type=int, action="append", default=[], metavar="AUTHORS",
+        help="Also time splitting command words into commands when there "
+        "are this many authors. Can be given more than once.")
+    parser.add_argument("--output", help="Save the results to this file.")
+    parser.add_argument(
+        "--compare", help="Compare the results to the ones in this file.")
+    options = parser.parse_args()
+
+    results = dict(
+        version=code_version(), python=platform.python_version(),
+        date=datetime.utcnow().isoformat(), chapters=options.chapters,
+        authors=options.authors, runs=[])
+    initial_memory = peak_memory()
+    per_tweet = []
+    for size in options.sizes:
+        directory = tempfile.mkdtemp()
+        try:
+            write_story(directory, size, options.chapters,
+                        options.tweets_per_day, options.authors,
+                        options.reply_rate)
+            seconds = time_phases(directory)
+            if options.processes > 1:
+                seconds['parallel_parse'] = time_parallel_parse(
+                    directory, options.processes)
+        finally:
+            shutil.rmtree(directory)
+        results['runs'].append(dict(tweets=size, seconds=seconds))
+        total = sum(seconds.values())
+        per_tweet.append(seconds['parse'] / size)
+        print "%9d tweets: %8.2fs (%.1f microseconds/tweet to parse)" % (
+            size, total, per_tweet[-1] * 1000000)
+        for phase in PHASES:
+            print "  %-28s %8.3fs" % (phase, seconds[phase])
+        if 'parallel_parse' in seconds:
+            print "  %-28s %8.3fs (parse and add_fuzz, %d processes)" % (
+                "parallel_parse", seconds['parallel_parse'],
+                options.processes)
+
+    for authors in options.cast:
+        print "Command lexer, %5d authors: %9d commands/sec" % (
+            authors, time_lexing(authors))
+
+    # Smaller streams are freed before larger ones are parsed, so the
+    # growth in peak memory comes from the largest stream.
+    print "Memory: about %d bytes/tweet." % (
+        (peak_memory() - initial_memory) / max(options.sizes))
+
+    if options.output is not None:
+        out = open(options.output, "w")
+        out.write(json.dumps(results, indent=2, sort_keys=True))
+        out.close()
+
+    failed = False
+    if options.compare is not None:
+        if compare(results, json.load(open(options.compare))) > 0:
+            failed = True
+
+    slowdown = per_tweet[-1] / per_tweet[0]
+    print "Time per tweet grew by a factor of %.2f." % slowdown
+    if slowdown > MAXIMUM_SLOWDOWN:
+        print "[ERROR] Parsing is not running in linear time."
+        failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
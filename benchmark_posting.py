@@ -0,0 +1,147 @@
+"""Measure how fast enact.py can post tweets.
+
+This runs Story.sync against a fake Twitter server (see
+fake_twitter.py), with timelines in which every tweet is overdue:
+
+ python benchmark_posting.py [--latency 0.01] [--threads 4] [number of tweets] ...
+
+For each timeline it reports how many tweets were posted per second,
+the median and 99th percentile time it took to post a tweet, and how
+much of the sync was spent doing something other than posting.
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from enact import Story
+from fake_twitter import FakeTwitter
+from ratelimit import RateLimiter
+
+DEFAULT_SIZES = [1000, 10000]
+
+ACCOUNTS = ["Alice", "IAmBob", "Carol", "Dave"]
+
+class TimedStory(Story):
+    """A Story that keeps track of how long each post takes."""
+
+    def __init__(self, *args, **kwargs):
+        Story.__init__(self, *args, **kwargs)
+        self.latencies = []
+
+    def post(self, tweet):
+        start = time.time()
+        Story.post(self, tweet)
+        self.latencies.append(time.time() - start)
+
+
+def synthetic_timeline(tweets):
+    """Generate a timeline in which every tweet is overdue.
+
+    Every third tweet is a reply to the tweet before it.
+    """
+    start = int(time.time()) - 24 * 60 * 60
+    for i in range(tweets):
+        yield dict(
+            internal_id="tweet-%d" % i, text="Tweet number %d." % i,
+            author=ACCOUNTS[i % len(ACCOUNTS)],
+            in_reply_to=(i % 3 == 2 and "tweet-%d" % (i - 1)) or None,
+            timestamp=start + i)
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def time_sync(server, tweets, threads):
+    """Post a synthetic timeline to the given server.
+
+    :return: A 4-tuple (story, seconds spent in the first sync,
+        seconds spent in a second sync with nothing left to post,
+        number of tweets deferred).
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        timeline_filename = os.path.join(directory, "timeline.json")
+        out = open(timeline_filename, "w")
+        for tweet in synthetic_timeline(tweets):
+            out.write(json.dumps(tweet))
+            out.write("\n")
+        out.close()
+        config = dict(
+            twitter_domain=server.domain, twitter_secure=False,
+            posting_threads=threads,
+            authors=[dict(account=x, twitter_token="token",
+                          twitter_secret="secret") for x in ACCOUNTS])
+        story = TimedStory(
+            config, open(timeline_filename),
+            os.path.join(directory, "progress.json"),
+            os.path.join(directory, "cursor.json"))
+        # Only the server's rate limits count.
+        story.rate_limiter = RateLimiter(
+            tweets_per_hour=sys.maxint, burst=sys.maxint,
+            account_tweets_per_hour=sys.maxint, account_burst=sys.maxint)
+
+        # Don't print a line for every tweet.
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            start = time.time()
+            story.sync()
+            first = time.time() - start
+            start = time.time()
+            story.sync()
+            second = time.time() - start
+        finally:
+            sys.stdout = stdout
+        deferred = tweets - len(story.progress)
+        story.progress.close()
+        return story, first, second, deferred
+    finally:
+        shutil.rmtree(directory)
+
+def main():
+    parser = ArgumentParser(
+        description="Measure how fast tweets can be posted.")
+    parser.add_argument("sizes", type=int, nargs="*", default=DEFAULT_SIZES,
+                        metavar="tweets")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Post this many tweets at once.")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="How many seconds each request takes.")
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--duplicate-rate", type=float, default=0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0)
+    options = parser.parse_args()
+
+    for size in options.sizes:
+        # A new server for each timeline, so that tweets from the last
+        # timeline don't count as duplicates.
+        server = FakeTwitter(
+            latency=options.latency, error_rate=options.error_rate,
+            duplicate_rate=options.duplicate_rate,
+            rate_limit_rate=options.rate_limit_rate, seed=0).start()
+        try:
+            story, elapsed, idle, deferred = time_sync(
+                server, size, options.threads)
+            latencies = story.latencies
+            posted = size - deferred
+            # Time spent posting, spread across the posting threads.
+            posting = sum(latencies) / min(options.threads, len(ACCOUNTS))
+            print "%9d tweets: %8.2fs, %.1f posts/sec, %d deferred" % (
+                size, elapsed, posted / elapsed, deferred)
+            print "  post latency: p50 %.2fms, p99 %.2fms" % (
+                percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.99) * 1000)
+            print "  sync overhead: %.2fs (%.1f microseconds/tweet), %.3fs with nothing to post" % (
+                elapsed - posting, (elapsed - posting) / size * 1000000, idle)
+        finally:
+            server.stop()
+
+if __name__ == '__main__':
+    main()
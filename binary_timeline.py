@@ -0,0 +1,218 @@
+"""A compact binary version of timeline.json.
+
+timeline.bin holds the same records as timeline.json, but in a form
+that enact.py can use without parsing it. The file is laid out like
+this:
+
+ * A header: the magic number, the number of records, the number of
+   authors, whether the records are in chronological order, and where
+   the string table starts.
+ * One entry per author, giving the position of the author's account
+   name in the string table.
+ * One fixed-width record per tweet: when it's to be posted (seconds
+   since the epoch, UTC), the index of its author, the index of the
+   record it replies to (or -1), its internal ID, and the position of
+   its text in the string table.
+ * The string table: every account name and tweet text, in UTF-8.
+
+Since the records are fixed-width and in chronological order, the
+file can be memory-mapped and searched by time without reading any
+record but the ones that are needed.
+"""
+
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+from timeline import to_epoch
+
+MAGIC = "SYCTL\x00\x00\x01"
+
+# Magic number, records, authors, whether the records are in order,
+# start of the string table.
+HEADER = struct.Struct("<8sIIIQ")
+
+# Position and length of the account name.
+AUTHOR = struct.Struct("<II")
+
+# Timestamp, author, record replied to, internal ID (an MD5 digest),
+# position and length of the text.
+RECORD = struct.Struct("<qii16sII")
+
+TIMESTAMP = struct.Struct("<q")
+
+class BinaryTimelineWriter(object):
+    """Writes timeline.bin, one tweet at a time.
+
+    The tweets must be given in script order, and every reply must
+    come immediately after the tweet it replies to, which is how
+    scripts work.
+    """
+
+    def __init__(self, handle, accounts):
+        self.handle = handle
+        self.start = handle.tell()
+        self.author_indexes = dict(
+            (account, i) for i, account in enumerate(accounts))
+        self.count = 0
+        self.in_order = True
+        self.previous_tweet = None
+        self.previous_timestamp = None
+        # The string table is built up on the side, and copied into
+        # place once all the records have been written.
+        self.strings = tempfile.TemporaryFile()
+        self.strings_size = 0
+
+        self.handle.write(HEADER.pack(MAGIC, 0, 0, 0, 0))
+        for account in accounts:
+            self.handle.write(AUTHOR.pack(*self.add_string(account)))
+
+    def add_string(self, string):
+        if isinstance(string, unicode):
+            string = string.encode("utf8")
+        position = self.strings_size
+        self.strings.write(string)
+        self.strings_size += len(string)
+        return position, len(string)
+
+    def add(self, tweet):
+        """Add a timeline.Tweet to the end of the timeline."""
+        timestamp = to_epoch(tweet.timestamp)
+        if (self.previous_timestamp is not None
+            and timestamp < self.previous_timestamp):
+            self.in_order = False
+        reply = -1
+        if (tweet.in_reply_to is not None
+            and tweet.in_reply_to is self.previous_tweet):
+            reply = self.count - 1
+        text_position, text_length = self.add_string(tweet.text)
+        self.handle.write(RECORD.pack(
+                timestamp, self.author_indexes[tweet.author['account']],
+                reply, tweet.digest.decode("hex"), text_position,
+                text_length))
+        self.count += 1
+        self.previous_tweet = tweet
+        self.previous_timestamp = timestamp
+
+    def close(self):
+        """Write the string table and fill in the header."""
+        strings_start = self.handle.tell() - self.start
+        self.strings.seek(0)
+        shutil.copyfileobj(self.strings, self.handle)
+        self.strings.close()
+        end = self.handle.tell()
+        self.handle.seek(self.start)
+        self.handle.write(HEADER.pack(
+                MAGIC, self.count, len(self.author_indexes),
+                int(self.in_order), strings_start))
+        self.handle.seek(end)
+
+
+class BinaryTimeline(object):
+    """A memory-mapped timeline.bin.
+
+    It works like the reader for timeline.json in enact.py: a record's
+    position is its index, and each record comes out as the same dict
+    that json.loads() would have made from timeline.json.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.count, author_count, in_order,
+         self.strings_start) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a binary timeline." % filename)
+        self.in_order = bool(in_order)
+        self.authors = []
+        for i in range(author_count):
+            position, length = AUTHOR.unpack_from(
+                self.map, HEADER.size + i * AUTHOR.size)
+            self.authors.append(self.string(position, length))
+        self.records_start = HEADER.size + author_count * AUTHOR.size
+
+    def __len__(self):
+        return self.count
+
+    def string(self, position, length):
+        start = self.strings_start + position
+        return self.map[start:start + length].decode("utf8")
+
+    def timestamp(self, index):
+        """When the record at the given index is to be posted, in
+        seconds since the epoch.
+        """
+        return TIMESTAMP.unpack_from(
+            self.map, self.records_start + index * RECORD.size)[0]
+
+    def digest(self, index):
+        return RECORD.unpack_from(
+            self.map, self.records_start + index * RECORD.size)[3].encode(
+            "hex")
+
+    def record(self, index):
+        (timestamp, author, reply, digest, text_position,
+         text_length) = RECORD.unpack_from(
+            self.map, self.records_start + index * RECORD.size)
+        if reply == -1:
+            in_reply_to = None
+        else:
+            in_reply_to = self.digest(reply)
+        return dict(
+            internal_id=digest.encode("hex"),
+            text=self.string(text_position, text_length),
+            author=self.authors[author], in_reply_to=in_reply_to,
+            timestamp=timestamp)
+
+    def bisect(self, timestamp):
+        """Find the index of the first record to be posted after the
+        given time, in seconds since the epoch.
+
+        This only works if the records are in order.
+        """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(middle) <= timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def records(self, index=0):
+        """Yield (index, record) 2-tuples, starting at the given index."""
+        for index in xrange(index, self.count):
+            yield index, self.record(index)
+
+    def scan(self, index, now):
+        """Yield (index, record, whether it's due) 3-tuples, starting at
+        the given index.
+
+        If the records are in order, the due ones are found by
+        searching, so no timestamp is converted along the way.
+        """
+        now = to_epoch(now)
+        if self.in_order:
+            due_before = self.bisect(now)
+            for index, record in self.records(index):
+                yield index, record, index < due_before
+        else:
+            for index, record in self.records(index):
+                yield index, record, self.timestamp(index) <= now
+
+    @property
+    def end(self):
+        return self.count
+
+    @property
+    def version(self):
+        """Something that changes whenever the timeline is rebuilt."""
+        stat = os.fstat(self.file.fileno())
+        return [stat.st_size, stat.st_mtime]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
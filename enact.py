@@ -1,14 +1,29 @@
 """Publish timelines to Twitter."""
 
+from argparse import ArgumentParser
+import calendar
 from datetime import datetime, timedelta
-from parsedatetime.parsedatetime import Calendar
+import heapq
+import httplib
+import itertools
+from multiprocessing.pool import ThreadPool
 import os
 import json
-import sys
+import math
+import socket
+import threading
+import time
+import urllib2
 
-import twitter
-
-from timeline import load_config, JSON_TIME_FORMAT
+from binary_timeline import BinaryTimeline
+import instrument
+import next_due
+from timeline import (
+    load_config, MONTH_NUMBERS, parse_timestamp, to_epoch)
+from progress import FSYNC_BATCH, ProgressLog
+from ratelimit import (
+    DEFAULT_ACCOUNT_BURST, DEFAULT_ACCOUNT_TWEETS_PER_HOUR, DEFAULT_BURST,
+    DEFAULT_TWEETS_PER_HOUR, limiters_by_consumer_key, shared_limiter)
 
 from keys import TWITTER_CONSUMER_KEY, TWITTER_CONSUMER_SECRET
 
@@ -21,58 +36,522 @@ DONT_POST_TWEETS_OLDER_THAN = timedelta(days=2)
 
 TWITTER_TIME_FORMAT = "%a %b %d %H:%M:%S +0000 %Y"
 
+# When running as a daemon, check this often whether the timeline has
+# been rebuilt, even if no tweet is due.
+DAEMON_POLL_INTERVAL = timedelta(minutes=1)
+
+# If posting a story's tweets fails, wait this long before trying that
+# story again.
+STORY_RETRY_DELAY = timedelta(minutes=5)
+
+# Twitter sends these HTTP status codes when an account is over its
+# rate limit or Twitter is having trouble. Posting the tweet again
+# later should work.
+RETRYABLE_HTTP_STATUSES = set([420, 429, 500, 502, 503, 504])
+
+# The error code Twitter uses when a tweet is a duplicate of one that
+# was already posted.
+DUPLICATE_STATUS_CODE = 187
+
+# The error codes Twitter uses when an account is over its rate limit
+# (88) or its limit on status updates (185). The second comes with
+# HTTP status 403, so it can't be recognized by the status alone.
+RATE_LIMIT_STATUS_CODES = set([88, 185])
+
+# Stands in for the Twitter ID of a tweet that was rejected as a
+# duplicate.
+DUPLICATE_TWITTER_ID = '[duplicate]'
+
+class TweetDeferred(Exception):
+    """A tweet can't be posted right now, but can be posted later."""
+
+    def __init__(self, delay):
+        Exception.__init__(self, "Try again in %d seconds." % delay)
+        # How many seconds to wait before trying again.
+        self.delay = delay
+
+def parse_twitter_time(created_at):
+    """Find the seconds since the epoch for a time in
+    TWITTER_TIME_FORMAT, without strptime().
+    """
+    weekday, month, day, time_of_day, offset, year = created_at.split()
+    hour, minute, second = time_of_day.split(":")
+    return calendar.timegm((int(year), MONTH_NUMBERS[month], int(day),
+                            int(hour), int(minute), int(second)))
+
+# The twitter module is imported inside the functions that use it.
+# It's slow to import, and most runs of enact.py don't post anything.
+
+def error_codes(error):
+    """The Twitter error codes in a TwitterHTTPError's response."""
+    data = error.response_data
+    if not isinstance(data, dict):
+        return []
+    return [x.get('code') for x in data.get('errors', [])]
+
+def is_duplicate(error):
+    """Did Twitter reject a tweet because it was already posted?"""
+    import twitter
+    if isinstance(error, twitter.TwitterHTTPError):
+        return DUPLICATE_STATUS_CODE in error_codes(error)
+    return error.message == "Status is a duplicate."
+
+def is_transient(error):
+    """Is this the sort of error that goes away if you wait?"""
+    import twitter
+    if isinstance(error, twitter.TwitterHTTPError):
+        return (error.e.code in RETRYABLE_HTTP_STATUSES
+                or any(code in RATE_LIMIT_STATUS_CODES
+                       for code in error_codes(error)))
+    return isinstance(
+        error, (urllib2.URLError, httplib.HTTPException, socket.error))
+
+class ClientPool(object):
+    """Twitter API clients, one per author account.
+
+    A client is created the first time an account posts, and reused
+    for every later post from that account.
+
+    Clients talk to the Twitter API at `domain`, over HTTPS if
+    `secure` is True.
+    """
+
+    def __init__(self, credentials_by_account, domain="api.twitter.com",
+                 secure=True):
+        self.credentials_by_account = credentials_by_account
+        self.domain = domain
+        self.secure = secure
+        self.clients = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, account):
+        import twitter
+        with self.lock:
+            client = self.clients.get(account)
+            if client is None:
+                self.misses += 1
+                access_token_key, access_token_secret = (
+                    self.credentials_by_account[account])
+                oauth = twitter.OAuth(
+                    access_token_key, access_token_secret,
+                    TWITTER_CONSUMER_KEY, TWITTER_CONSUMER_SECRET)
+                client = twitter.Twitter(
+                    auth=oauth, domain=self.domain, secure=self.secure)
+                self.clients[account] = client
+            else:
+                self.hits += 1
+            return client
+
+
+class ConcurrentPoster(object):
+    """Posts a batch of tweets from several threads at once.
+
+    Tweets from the same account are posted in script order, one at a
+    time. A reply isn't posted until the tweet it replies to has been
+    posted, since the reply needs the other tweet's Twitter ID. Apart
+    from that, tweets from different accounts go out in parallel.
+
+    If a tweet can't be posted, nothing else from its account is
+    posted, and neither are replies to it. Once everything else is
+    done, the first error is raised. If the tweet was only deferred,
+    the tweets held up by it are deferred along with it.
+    """
+
+    def __init__(self, post, threads):
+        """:param post: A function that posts a single tweet."""
+        self.post = post
+        self.threads = threads
+
+    def run(self, tweets):
+        """:return: A list of (tweet, seconds) 2-tuples for the tweets
+            that were deferred.
+        """
+        self.lanes = {}
+        self.accounts = []
+        for tweet in tweets:
+            account = tweet['author']
+            if account not in self.lanes:
+                self.lanes[account] = []
+                self.accounts.append(account)
+            self.lanes[account].append(tweet)
+        self.unfinished = set(tweet['internal_id'] for tweet in tweets)
+        # Maps the internal ID of each tweet that wasn't posted to how
+        # long it was deferred, or to None if it failed outright.
+        self.failed = {}
+        self.busy_accounts = set()
+        self.errors = []
+        self.deferred = []
+        self.condition = threading.Condition()
+
+        threads = [threading.Thread(target=self.work)
+                   for i in range(min(self.threads, len(self.accounts)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if len(self.errors) > 0:
+            raise self.errors[0]
+        return self.deferred
+
+    def next_tweet(self):
+        """Claim a tweet that's ready to be posted.
+
+        Must be called with the condition held.
+
+        :return: A tweet, or None if nothing is ready right now.
+        """
+        for account in self.accounts:
+            lane = self.lanes[account]
+            if len(lane) == 0 or account in self.busy_accounts:
+                continue
+            tweet = lane[0]
+            parent = tweet['in_reply_to']
+            if parent in self.failed:
+                # This is a reply to a tweet that couldn't be posted.
+                # Give up on this account.
+                self.give_up(account, self.failed[parent])
+                continue
+            if parent in self.unfinished:
+                # The tweet this replies to hasn't been posted yet.
+                continue
+            lane.pop(0)
+            self.busy_accounts.add(account)
+            return tweet
+        return None
+
+    def give_up(self, account, delay=None):
+        for tweet in self.lanes[account]:
+            self.unfinished.discard(tweet['internal_id'])
+            self.failed[tweet['internal_id']] = delay
+            if delay is not None:
+                self.deferred.append((tweet, delay))
+        self.lanes[account] = []
+        self.condition.notify_all()
+
+    def work(self):
+        while True:
+            with self.condition:
+                tweet = self.next_tweet()
+                while tweet is None:
+                    if not any(self.lanes.values()):
+                        return
+                    self.condition.wait()
+                    tweet = self.next_tweet()
+            account = tweet['author']
+            error = None
+            delay = None
+            try:
+                self.post(tweet)
+            except TweetDeferred, e:
+                delay = e.delay
+            except Exception, e:
+                error = e
+            with self.condition:
+                self.busy_accounts.discard(account)
+                self.unfinished.discard(tweet['internal_id'])
+                if delay is not None:
+                    self.deferred.append((tweet, delay))
+                    self.failed[tweet['internal_id']] = delay
+                    self.give_up(account, delay)
+                elif error is not None:
+                    self.errors.append(error)
+                    self.failed[tweet['internal_id']] = None
+                    self.give_up(account)
+                self.condition.notify_all()
+
+
+class JSONTimeline(object):
+    """A timeline.json file.
+
+    A record's position is its byte offset in the file.
+    """
+
+    def __init__(self, filehandle):
+        self.filehandle = filehandle
+
+    def records(self, offset=0):
+        """Read the timeline from the given byte offset onwards.
+
+        :yield: (offset, tweet) 2-tuples.
+        """
+        self.filehandle.seek(offset)
+        for line in iter(self.filehandle.readline, ''):
+            if len(line.strip()) > 0:
+                yield offset, json.loads(line.strip())
+            offset += len(line)
+
+    def scan(self, offset, now):
+        """Yield (offset, tweet, whether it's due) 3-tuples, starting at
+        the given offset.
+        """
+        now = to_epoch(now)
+        for offset, tweet in self.records(offset):
+            yield offset, tweet, parse_timestamp(tweet['timestamp']) <= now
+
+    @property
+    def end(self):
+        self.filehandle.seek(0, os.SEEK_END)
+        return self.filehandle.tell()
+
+    @property
+    def version(self):
+        """Something that changes whenever timeline.json is rebuilt."""
+        stat = os.fstat(self.filehandle.fileno())
+        return [stat.st_size, stat.st_mtime]
+
+
 class Story(object):
 
-    def __init__(self, config, script_filehandle, progress_filename):
+    @instrument.timed("story_init")
+    def __init__(self, config, script_filehandle, progress_filename,
+                 cursor_filename=None, name=None, rate_limit_filename=None):
         self.progress_filename = progress_filename
-
-        self.script = [json.loads(line.strip()) for line in script_filehandle]
-        if os.path.exists(progress_filename):
-            self.progress = [json.loads(line.strip())
-                             for line in open(progress_filename)]
+        # How the story is identified in messages.
+        self.name = name or os.path.dirname(progress_filename)
+        # How many tweets can be posted at once when several are due.
+        self.posting_threads = int(config.get('posting_threads', 1))
+        self.script_filehandle = script_filehandle
+        if hasattr(script_filehandle, 'scan'):
+            # Already a timeline, such as a BinaryTimeline.
+            self.timeline = script_filehandle
         else:
-            # No progress yet
-            self.progress = []
+            self.timeline = JSONTimeline(script_filehandle)
+        self.cursor_filename = cursor_filename
+        # Where the state of the rate limits is kept between runs.
+        self.rate_limit_filename = rate_limit_filename
+        # When the first unposted tweet is due, in seconds since the
+        # epoch, as of the last sync. None means every tweet has been
+        # posted.
+        self.next_due = None
+
+        self.progress = ProgressLog(
+            progress_filename,
+            fsync_policy=config.get('progress_fsync', FSYNC_BATCH))
         self.credentials_by_account = {}
         for author in config['authors']:
             self.credentials_by_account[author['account']] = (
                 author['twitter_token'], author['twitter_secret'])
 
-        self.posted_tweets_by_internal_id = {}
-        for posted_tweet in self.progress:
-            self.posted_tweets_by_internal_id[posted_tweet['internal_id']] = (
-                posted_tweet)
+        # The progress log can look up posted tweets by internal ID
+        # without reading the whole thing.
+        self.posted_tweets_by_internal_id = self.progress
+
+        self.clients = ClientPool(
+            self.credentials_by_account,
+            config.get('twitter_domain', 'api.twitter.com'),
+            config.get('twitter_secure', True))
+
+        # Every story posting through this application shares the
+        # application's rate limits.
+        self.rate_limiter = shared_limiter(
+            TWITTER_CONSUMER_KEY,
+            tweets_per_hour=config.get(
+                'tweets_per_hour', DEFAULT_TWEETS_PER_HOUR),
+            burst=config.get('tweet_burst', DEFAULT_BURST),
+            account_tweets_per_hour=config.get(
+                'account_tweets_per_hour', DEFAULT_ACCOUNT_TWEETS_PER_HOUR),
+            account_burst=config.get(
+                'account_tweet_burst', DEFAULT_ACCOUNT_BURST))
+        self.load_rate_limits()
+
+    def records(self, offset=0):
+        """Read the script from the given offset onwards.
+
+        :yield: (offset, tweet) 2-tuples.
+        """
+        return self.timeline.records(offset)
+
+    @property
+    def script(self):
+        return [tweet for offset, tweet in self.records()]
 
+    @property
+    def script_version(self):
+        """Something that changes whenever the timeline is rebuilt."""
+        return self.timeline.version
+
+    def load_cursor(self):
+        """Find the offset of the first unposted tweet in the script.
+
+        Every tweet before the cursor has been posted, so there's no
+        need to read them. If the script has been rebuilt since the
+        cursor was saved, the cursor is useless and the whole script
+        has to be read.
+        """
+        if self.cursor_filename is None or not os.path.exists(
+            self.cursor_filename):
+            return 0
+        cursor = json.loads(open(self.cursor_filename).read())
+        if cursor['timeline'] != self.script_version:
+            return 0
+        return cursor['offset']
+
+    def save_cursor(self, offset):
+        if self.cursor_filename is None:
+            return
+        cursor = dict(timeline=self.script_version, offset=offset)
+        # Write the new cursor alongside the old one and then move it
+        # into place, so there's never a half-written cursor.
+        temporary_filename = self.cursor_filename + ".tmp"
+        out = open(temporary_filename, "w")
+        out.write(json.dumps(cursor))
+        out.close()
+        os.rename(temporary_filename, self.cursor_filename)
+
+    def load_rate_limits(self):
+        """Pick up the rate limits where the last run left them.
+
+        Otherwise, every run of enact.py from cron would start with
+        full token buckets and no backoff.
+        """
+        if self.rate_limit_filename is None or not os.path.exists(
+            self.rate_limit_filename):
+            return
+        try:
+            saved = json.loads(open(self.rate_limit_filename).read())
+        except ValueError:
+            return
+        self.rate_limiter.load(saved)
+
+    def save_rate_limits(self):
+        if self.rate_limit_filename is None:
+            return
+        temporary_filename = self.rate_limit_filename + ".tmp"
+        out = open(temporary_filename, "w")
+        out.write(json.dumps(self.rate_limiter.dump()))
+        out.close()
+        os.rename(temporary_filename, self.rate_limit_filename)
+
+    @property
+    def unposted_tweets(self):
+        for offset, tweet in self.records(self.load_cursor()):
+            if tweet['internal_id'] not in self.posted_tweets_by_internal_id:
+                yield tweet
+
+    @instrument.timed("sync")
     def sync(self):
-        """Synchronize by posting at most one tweet."""
-        for tweet in self.script:
+        """Synchronize by posting every tweet that's due."""
+        due = []
+        offsets = {}
+        coming_up = None
+        next_due = None
+        offset = self.load_cursor()
+        now = datetime.utcnow()
+        for offset, tweet, is_due in self.timeline.scan(offset, now):
             if tweet['internal_id'] in self.posted_tweets_by_internal_id:
                 # We already posted this tweet.
                 continue
             else:
                 # We have not yet posted this tweet.
-                post_at = datetime.strptime(
-                    tweet['timestamp'], JSON_TIME_FORMAT)
-                now = datetime.utcnow()
-                if post_at <= now:
-                    if False and now - post_at > DONT_POST_TWEETS_OLDER_THAN:
+                if is_due:
+                    # The check is switched off, so the age is only
+                    # worked out if it's switched back on.
+                    if False and now - datetime.utcfromtimestamp(
+                        parse_timestamp(tweet['timestamp'])) > (
+                        DONT_POST_TWEETS_OLDER_THAN):
                         print (
                             'Not posting "%s". It\'s so old (%s) that posting '
                             'it might screw up the timeline.' % (
-                                tweet['text'], now-post_at))
+                                tweet['text'], now - datetime.utcfromtimestamp(
+                                    parse_timestamp(tweet['timestamp']))))
                         continue
                     # It's time to post this sucker.
-                    self.post(tweet)
+                    due.append(tweet)
+                    offsets[tweet['internal_id']] = offset
                     continue
                 else:
                     # This tweet's time has yet to come. Since the
                     # script is in chronological order, there's no
                     # point in looking further in the script.
-                    print 'Coming up in %s: "%s"' % (post_at-now, tweet['text'])
-                    pass
+                    next_due = parse_timestamp(tweet['timestamp'])
+                    post_at = datetime.utcfromtimestamp(next_due)
+                    coming_up = 'Coming up in %s: "%s"' % (
+                        post_at-now, tweet['text'])
                 break
+        else:
+            # Every tweet in the script has been posted.
+            offset = self.timeline.end
+        deferred = self.post_tweets(due)
+        if len(deferred) > 0:
+            print "Deferred %d tweets until the next run." % len(deferred)
+            # The cursor mustn't move past a tweet that wasn't posted.
+            offset = min(
+                offsets[tweet['internal_id']] for tweet, delay in deferred)
+            # The deferred tweets are overdue already, but there's no
+            # point trying them again until the wait is over.
+            next_due = to_epoch(now) + int(math.ceil(
+                    min(delay for tweet, delay in deferred)))
+        elif coming_up is not None:
+            print coming_up
+        self.save_cursor(offset)
+        self.next_due = next_due
+        if self.clients.hits + self.clients.misses > 0:
+            print "API clients: %d reused, %d created." % (
+                self.clients.hits, self.clients.misses)
+
+    def post_tweets(self, tweets):
+        """Post a batch of due tweets, in parallel if that's allowed.
+
+        A tweet that runs into a rate limit or a transient error is
+        deferred, and so is every later tweet from its account and
+        every reply to it.
+
+        :return: A list of (tweet, seconds) 2-tuples: the tweets that
+            were deferred, and how long to wait before trying again.
+        """
+        try:
+            if self.posting_threads > 1 and len(tweets) > 1:
+                return ConcurrentPoster(
+                    self.attempt, self.posting_threads).run(tweets)
+            deferred = []
+            delay_by_account = {}
+            delay_by_internal_id = {}
+            for tweet in tweets:
+                delay = delay_by_account.get(
+                    tweet['author'],
+                    delay_by_internal_id.get(tweet['in_reply_to']))
+                if delay is None:
+                    try:
+                        self.attempt(tweet)
+                        continue
+                    except TweetDeferred, e:
+                        delay = e.delay
+                delay_by_account[tweet['author']] = delay
+                delay_by_internal_id[tweet['internal_id']] = delay
+                deferred.append((tweet, delay))
+            return deferred
+        finally:
+            self.progress.commit()
+            if len(tweets) > 0:
+                self.save_rate_limits()
 
+    def attempt(self, tweet):
+        """Post a tweet, if the rate limits allow it.
+
+        :raise TweetDeferred: If the tweet can't be posted yet.
+        """
+        account = tweet['author']
+        delay = self.rate_limiter.acquire(account)
+        if delay > 0:
+            instrument.count("tweets_rate_limited")
+            raise TweetDeferred(delay)
+        try:
+            self.post(tweet)
+        except Exception, e:
+            if not is_transient(e):
+                raise
+            delay = self.rate_limiter.failed(account)
+            instrument.count("transient_errors")
+            print '[WARNING] Could not post "%s": %s. Will try again in %d seconds.' % (
+                tweet['text'], e, delay)
+            raise TweetDeferred(delay)
+        self.rate_limiter.succeeded(account)
+
+    @instrument.timed("post")
     def post(self, tweet):
+        import twitter
         text = tweet['text']
         print 'Posting "%s"' % text
         author_account = tweet['author']
@@ -84,60 +563,288 @@ class Story(object):
             in_reply_to = self.posted_tweets_by_internal_id.get(in_reply_to_id)
             if in_reply_to is None:
                 print '"%s" is supposedly a response to nonexistent internal ID %s. Posting it as a standalone tweet instead.' % (text, in_reply_to_id)
+            elif in_reply_to['twitter_id'] == DUPLICATE_TWITTER_ID:
+                print '"%s" is a response to a tweet that was rejected as a duplicate. Posting it as a standalone tweet instead.' % text
             else:
                 in_reply_to_twitter_id = in_reply_to['twitter_id']
 
-        access_token_key, access_token_secret = self.credentials_by_account[
-            author_account]
-        oauth = twitter.OAuth(access_token_key, access_token_secret,
-                              TWITTER_CONSUMER_KEY, TWITTER_CONSUMER_SECRET)
-        api = twitter.Twitter(auth=oauth)
+        api = self.clients.get(author_account)
 
         # Post the tweet.
         try:
-            data = api.statuses.update(status=text, in_reply_to_status_id=in_reply_to_twitter_id)
-            actual_time = datetime.strptime(data['created_at'], TWITTER_TIME_FORMAT)
+            arguments = dict(status=text)
+            if in_reply_to_twitter_id is not None:
+                # Otherwise the twitter module would send "None".
+                arguments['in_reply_to_status_id'] = in_reply_to_twitter_id
+            data = api.statuses.update(**arguments)
+            actual_time = parse_twitter_time(data['created_at'])
             twitter_id = data['id']
             pass
         except twitter.TwitterError, e:
-            if e.message != "Status is a duplicate.":
+            if not is_duplicate(e):
                 raise e
-            actual_time = datetime.now()
-            twitter_id = '[duplicate]'
+            actual_time = int(time.time())
+            twitter_id = DUPLICATE_TWITTER_ID
+            instrument.count("duplicates")
         #actual_time = datetime.now()
         #twitter_id = 120943957396785
 
         # Append to the log of progress
         progress_entry = dict(
             text=text,
-            planned_timestamp=tweet['timestamp'],
-            actual_timestamp=actual_time.strftime(JSON_TIME_FORMAT),
+            planned_timestamp=parse_timestamp(tweet['timestamp']),
+            actual_timestamp=actual_time,
             internal_id=tweet['internal_id'],
             twitter_id=twitter_id)
-        self.progress.append(progress_entry)
-
         self.save_progress(progress_entry)
+        instrument.count("tweets_posted")
 
     def save_progress(self, entry):
-        handle = open(self.progress_filename, "a")
-        handle.write(json.dumps(entry))
-        handle.write("\n")
-        handle.close()
+        self.progress.append(entry)
+
+class Scheduler(object):
+    """Posts tweets at the moment they come due.
+
+    Unposted tweets are kept in a heap ordered by the time they're
+    supposed to be posted, so finding the next one is cheap no matter
+    how long the story is, or how many stories are being posted.
+
+    When several stories have tweets due at once, each story's tweets
+    are posted by one of `workers` threads. If one story's tweets
+    can't be posted, the other stories carry on, and the failed story
+    is tried again after STORY_RETRY_DELAY. If some of a story's
+    tweets are deferred, the rest of the story waits along with them:
+    each of its tweets that comes due in the meantime goes back on the
+    heap until the story can post again.
+    """
+
+    def __init__(self, clock=datetime.utcnow, sleep=time.sleep, workers=1):
+        self.clock = clock
+        self.sleep = sleep
+        self.heap = []
+        # Breaks ties between tweets scheduled for the same moment,
+        # so they're posted in script order.
+        self.sequence = itertools.count()
+        # When each story that's being held back can post again.
+        self.held_until = {}
+        self.pool = None
+        if workers > 1:
+            self.pool = ThreadPool(workers)
+
+    def add_story(self, story):
+        """Schedule a story's unposted tweets."""
+        for tweet in story.unposted_tweets:
+            self.push(datetime.utcfromtimestamp(
+                    parse_timestamp(tweet['timestamp'])), story, tweet)
+
+    def push(self, post_at, story, tweet):
+        heapq.heappush(
+            self.heap, (post_at, next(self.sequence), story, tweet))
+
+    def remove_story(self, story):
+        self.heap = [x for x in self.heap if x[2] is not story]
+        heapq.heapify(self.heap)
+        self.held_until.pop(story, None)
 
-if len(sys.argv) != 2:
-    print "Usage: %s [script directory]" % sys.argv[0]
-    sys.exit()
+    def clear(self):
+        self.heap = []
+        self.held_until = {}
 
-script_directory = sys.argv[1]
-config = load_config(script_directory)
+    @property
+    def next_due(self):
+        """When the next tweet is due, or None if there are no more."""
+        if len(self.heap) == 0:
+            return None
+        return self.heap[0][0]
 
-script_filename = os.path.join(script_directory, "timeline.json")
-if not os.path.exists(script_filename):
-    raise Exception(
-        "Could not find timeline.json file in directory %s. "
-        "Did you run make_timeline.py?" % script_directory)
+    def post_due_tweets(self):
+        """Post every tweet whose time has come."""
+        now = self.clock()
+        due_by_story = {}
+        stories = []
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            post_at, sequence, story, tweet = heapq.heappop(self.heap)
+            held_until = self.held_until.get(story)
+            if held_until is not None:
+                if held_until > now:
+                    self.push(held_until, story, tweet)
+                    continue
+                del self.held_until[story]
+            if story not in due_by_story:
+                due_by_story[story] = []
+                stories.append(story)
+            due_by_story[story].append(tweet)
+
+        batches = [(story, due_by_story[story]) for story in stories]
+        if self.pool is None or len(batches) < 2:
+            results = map(self.post_batch, batches)
+        else:
+            results = self.pool.map(self.post_batch, batches)
+
+        for story, (deferred, error) in zip(stories, results):
+            if error is not None:
+                print '[ERROR] Could not post tweets for %s: %s' % (
+                    story.name, error)
+                retry_at = now + STORY_RETRY_DELAY
+            elif len(deferred) > 0:
+                retry_at = now + timedelta(
+                    seconds=min(delay for tweet, delay in deferred))
+            else:
+                continue
+            # Whatever didn't get posted will be tried again later.
+            # Holding back the whole story keeps its tweets in order.
+            self.held_until[story] = retry_at
+            for tweet in due_by_story[story]:
+                if tweet['internal_id'] not in story.progress:
+                    self.push(retry_at, story, tweet)
+
+    def post_batch(self, batch):
+        """Post one story's due tweets.
+
+        :return: A 2-tuple (deferred tweets, the exception that
+            stopped the posting or None).
+        """
+        story, tweets = batch
+        # Something else, such as a cron run of enact.py, may have
+        # posted some of these tweets since the story was scheduled.
+        tweets = [tweet for tweet in tweets
+                  if tweet['internal_id'] not in story.progress]
+        try:
+            return story.post_tweets(tweets), None
+        except Exception, e:
+            return [], e
+
+    def wait(self, longest=DAEMON_POLL_INTERVAL):
+        """Sleep until the next tweet is due, or for `longest`,
+        whichever comes first.
+        """
+        delay = longest
+        next_due = self.next_due
+        if next_due is not None:
+            delay = min(delay, next_due - self.clock())
+        seconds = delay.total_seconds()
+        if seconds > 0:
+            self.sleep(seconds)
+
+
+def load_story(script_directory):
+    config = load_config(script_directory)
+
+    script_filename = os.path.join(script_directory, "timeline.json")
+    if not os.path.exists(script_filename):
+        raise Exception(
+            "Could not find timeline.json file in directory %s. "
+            "Did you run make_timeline.py?" % script_directory)
 
-progress_filename = os.path.join(script_directory, "progress.json")
+    progress_filename = os.path.join(script_directory, "progress.json")
+    cursor_filename = os.path.join(script_directory, "cursor.json")
+    rate_limit_filename = os.path.join(script_directory, "ratelimit.json")
+
+    # make_timeline.py --binary also writes timeline.bin, which can
+    # be read without parsing it. Don't use it if it's out of date.
+    script = open(script_filename)
+    binary_filename = os.path.join(script_directory, "timeline.bin")
+    if (os.path.exists(binary_filename)
+        and os.stat(binary_filename).st_mtime >= os.stat(
+            script_filename).st_mtime):
+        script.close()
+        script = BinaryTimeline(binary_filename)
+
+    return Story(config, script, progress_filename,
+                 cursor_filename, name=script_directory,
+                 rate_limit_filename=rate_limit_filename)
+
+
+def write_status(filename):
+    """Write the state of the rate limits to a JSON file."""
+    status = dict(
+        time=int(time.time()),
+        rate_limits=[x.state for x in limiters_by_consumer_key.values()])
+    temporary_filename = filename + ".tmp"
+    out = open(temporary_filename, "w")
+    out.write(json.dumps(status, indent=2))
+    out.close()
+    os.rename(temporary_filename, filename)
+
+def run_daemon(script_directories, scheduler=None, posting_threads=None,
+               forever=True, status_filename=None):
+    """Post the stories' tweets as they come due, forever.
+
+    All the stories share one scheduler. Each story is reloaded
+    whenever its timeline.json, timeline.bin or config.json changes. A story that
+    can't be loaded is skipped until its files change.
+
+    :param forever: If False, post whatever is due and return.
+    :param status_filename: After each round of posting, write the
+        state of the rate limits to this file.
+    """
+    scheduler = scheduler or Scheduler()
+    stories = {}
+    loaded_mtimes = {}
+    while True:
+        for script_directory in script_directories:
+            filenames = [os.path.join(script_directory, x)
+                         for x in ("timeline.json", "config.json")]
+            try:
+                mtimes = [os.stat(x).st_mtime for x in filenames]
+            except OSError:
+                mtimes = None
+            binary_filename = os.path.join(script_directory, "timeline.bin")
+            if mtimes is not None and os.path.exists(binary_filename):
+                mtimes.append(os.stat(binary_filename).st_mtime)
+            if mtimes == loaded_mtimes.get(script_directory, []):
+                continue
+            loaded_mtimes[script_directory] = mtimes
+            if script_directory in stories:
+                scheduler.remove_story(stories.pop(script_directory))
+            print "Loading story from %s." % script_directory
+            try:
+                story = load_story(script_directory)
+            except Exception, e:
+                print '[ERROR] Could not load story from %s: %s' % (
+                    script_directory, e)
+                continue
+            if posting_threads is not None:
+                story.posting_threads = posting_threads
+            scheduler.add_story(story)
+            stories[script_directory] = story
+        scheduler.post_due_tweets()
+        if status_filename is not None:
+            write_status(status_filename)
+        if not forever:
+            return
+        scheduler.wait()
+
+
+def main():
+    parser = ArgumentParser(description="Post a story's tweets to Twitter.")
+    parser.add_argument("script_directory", help="The script directory.")
+    parser.add_argument(
+        "--daemon", action="store_true",
+        help="Keep running, and post each tweet as soon as it comes due.")
+    parser.add_argument(
+        "--threads", type=int,
+        help="Post up to this many overdue tweets at once. Overrides "
+        "posting_threads in config.json.")
+    parser.add_argument(
+        "--status-file",
+        help="When running as a daemon, keep the state of the rate limits "
+        "in this JSON file.")
+    instrument.add_arguments(parser)
+    options = parser.parse_args()
+
+    with instrument.profiling(options):
+        if options.daemon:
+            run_daemon([options.script_directory],
+                       posting_threads=options.threads,
+                       status_filename=options.status_file)
+        else:
+            story = load_story(options.script_directory)
+            if options.threads is not None:
+                story.posting_threads = options.threads
+            story.sync()
+            # Lets enact_if_due.py skip the next run if nothing's due.
+            next_due.write(options.script_directory, story.next_due)
 
-story = Story(config, open(script_filename), progress_filename)
-story.sync()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""Run enact.py, but only if a tweet might be due.
+
+This is meant to be run from cron, in place of enact.py:
+
+ python enact_if_due.py script_directory [enact.py options]
+
+The script directory has to come first. If next_due.txt (see
+next_due.py) says the next tweet isn't due yet, this exits straight
+away, without loading the timeline or importing any of the modules
+enact.py needs. Otherwise, it runs enact.py with the same arguments.
+"""
+
+import sys
+import time
+
+import next_due
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1].startswith("-"):
+        print "Usage: %s script_directory [enact.py options]" % sys.argv[0]
+        sys.exit(2)
+    script_directory = sys.argv[1]
+    known, timestamp = next_due.read(script_directory)
+    now = time.time()
+    if known and timestamp is None:
+        print "Every tweet in %s has been posted." % script_directory
+        return
+    if known and timestamp > now:
+        print "Nothing due in %s until %s UTC." % (
+            script_directory,
+            time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(timestamp)))
+        return
+    import enact
+    enact.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""A stand-in for the Twitter API, for testing and load-testing.
+
+It implements just enough of statuses/update to keep enact.py happy.
+It can be made slow, and it can be made to fail some requests, the
+way the real Twitter does:
+
+ python fake_twitter.py [--port 8080] [--latency 0.1] [--error-rate 0.01]
+
+Then point a story at it by adding this to its config.json:
+
+ "twitter_domain" : "localhost:8080",
+ "twitter_secure" : false
+"""
+
+from argparse import ArgumentParser
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from datetime import datetime
+import json
+import random
+import threading
+import time
+import urlparse
+
+from enact import DUPLICATE_STATUS_CODE, TWITTER_TIME_FORMAT
+
+# The error codes Twitter uses when an account is over its rate limit,
+# and when it's over its limit on status updates.
+RATE_LIMIT_CODE = 88
+UPDATE_LIMIT_CODE = 185
+
+class FakeTwitterHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        path = urlparse.urlparse(self.path).path
+        if not path.endswith("/statuses/update.json"):
+            self.respond(404, dict(errors=[dict(
+                            code=34, message="Page does not exist")]))
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        form = urlparse.parse_qs(self.rfile.read(length))
+        text = form.get('status', [''])[0].decode("utf8")
+        in_reply_to = form.get('in_reply_to_status_id', [None])[0]
+        if in_reply_to is not None and not in_reply_to.isdigit():
+            # Twitter ignores an in_reply_to_status_id it can't use.
+            in_reply_to = None
+        self.respond(*self.server.update(text, in_reply_to))
+
+    def respond(self, status, data):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Don't print a line for every request.
+        pass
+
+
+class FakeTwitter(ThreadingMixIn, HTTPServer):
+    """An HTTP server that pretends to be Twitter.
+
+    :param latency: How many seconds each request takes.
+    :param error_rate: The chance that a request fails with a 503.
+    :param duplicate_rate: The chance that a status is rejected as a
+        duplicate, even if it's not. A status that really is a
+        duplicate is always rejected.
+    :param rate_limit_rate: The chance that a request is rejected
+        with a 429.
+    :param update_limit_rate: The chance that a request is rejected
+        with a 403, because the account is over its limit on status
+        updates.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=("localhost", 0), latency=0, error_rate=0,
+                 duplicate_rate=0, rate_limit_rate=0, update_limit_rate=0,
+                 seed=None):
+        HTTPServer.__init__(self, address, FakeTwitterHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.duplicate_rate = duplicate_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.update_limit_rate = update_limit_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # Every status posted, in the order posted.
+        self.statuses = []
+        self.texts = set()
+        self.requests = 0
+        self.errors = 0
+        self.duplicates = 0
+        self.rate_limited = 0
+
+    @property
+    def domain(self):
+        """The domain to give the twitter module."""
+        return "%s:%d" % self.server_address
+
+    def start(self):
+        """Start serving requests in the background."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def update(self, text, in_reply_to):
+        """Post a status.
+
+        :return: A 2-tuple (HTTP status code, response data).
+        """
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+            roll = self.random.random()
+            if roll < self.rate_limit_rate:
+                self.rate_limited += 1
+                return 429, dict(errors=[dict(
+                            code=RATE_LIMIT_CODE,
+                            message="Rate limit exceeded")])
+            roll -= self.rate_limit_rate
+            if roll < self.update_limit_rate:
+                self.rate_limited += 1
+                return 403, dict(errors=[dict(
+                            code=UPDATE_LIMIT_CODE,
+                            message="User is over daily status update limit.")])
+            roll -= self.update_limit_rate
+            if roll < self.error_rate:
+                self.errors += 1
+                return 503, dict(errors=[dict(
+                            code=130, message="Over capacity")])
+            roll -= self.error_rate
+            if roll < self.duplicate_rate or text in self.texts:
+                self.duplicates += 1
+                return 403, dict(errors=[dict(
+                            code=DUPLICATE_STATUS_CODE,
+                            message="Status is a duplicate.")])
+            status = dict(
+                id=len(self.statuses) + 1, text=text,
+                in_reply_to_status_id=in_reply_to and int(in_reply_to),
+                created_at=datetime.utcnow().strftime(TWITTER_TIME_FORMAT))
+            self.statuses.append(status)
+            self.texts.add(text)
+            return 200, status
+
+
+def main():
+    parser = ArgumentParser(description="Pretend to be the Twitter API.")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--latency", type=float, default=0,
+        help="How many seconds each request takes.")
+    parser.add_argument(
+        "--error-rate", type=float, default=0,
+        help="The chance that a request fails with a 503 error.")
+    parser.add_argument(
+        "--duplicate-rate", type=float, default=0,
+        help="The chance that a status is rejected as a duplicate.")
+    parser.add_argument(
+        "--rate-limit-rate", type=float, default=0,
+        help="The chance that a request is rejected with a 429 error.")
+    options = parser.parse_args()
+
+    server = FakeTwitter(
+        ("localhost", options.port), options.latency, options.error_rate,
+        options.duplicate_rate, options.rate_limit_rate)
+    print "Pretending to be Twitter at http://%s/." % server.domain
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
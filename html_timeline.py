@@ -0,0 +1,219 @@
+"""Write a Stream out as HTML, for checking a story before it's posted.
+
+The HTML is written to a file as it's generated, a day's worth of
+tweets at a time, so the whole document is never held in memory.
+
+A long story can be split into pages, one per chapter or one per
+real-world week, with an index page linking to them all:
+
+ HTMLTimeline(stream, real_time=True).write_pages(directory, WEEK)
+"""
+
+from datetime import timedelta
+import itertools
+import os
+
+CHAPTER = "chapter"
+WEEK = "week"
+SPLITS = [CHAPTER, WEEK]
+
+START = '''<html>
+<head>
+<meta http-equiv="Content-Type" content="text/html; charset=utf-8">
+'''
+
+class HTMLTimeline(object):
+    """Writes a parsed Stream as HTML.
+
+    :param real_time: If True, tweets are grouped by the real-world
+        days on which they'll be posted, and each one is shown with
+        the time it'll be posted. Otherwise they're grouped by the
+        days of the story.
+    """
+
+    def __init__(self, stream, real_time=False):
+        self.authors = stream.tweet_parser.authors
+        self.chapters = stream.chapters
+        self.real_time = real_time
+
+    def header(self, title=None):
+        l = [START]
+        if title is not None:
+            l.append("<title>%s</title>" % title)
+        l.append('<style type="text/css">')
+        for author in self.authors:
+            l.append(".%s { background-color: %s }" % (
+                    author['css_class'], author['color']))
+        l.append('</style></head><body>')
+
+        l.append("<p>Author guide:</p>")
+        l.append("<ul>")
+        for author in self.authors:
+            l.append('<li class="%s">%s</a>' % (
+                    author['css_class'], author['account']))
+        l.append("</ul>")
+        return "\n".join(l) + "\n"
+
+    def footer(self):
+        return "\n</body></html"
+
+    def sections(self):
+        """Yield a (chapter, day, tweets) 3-tuple for each day of the
+        timeline, in order.
+
+        A chapter with no days at all is yielded as (chapter, None, None).
+        """
+        for chapter in self.chapters:
+            if self.real_time:
+                days = self.real_days(chapter)
+            else:
+                days = ((day.date, day.tweets) for day in chapter.days)
+            empty = True
+            for date, tweets in days:
+                empty = False
+                yield chapter, date, tweets
+            if empty:
+                yield chapter, None, None
+
+    def real_days(self, chapter):
+        """Group a chapter's tweets by the real-world day they'll be
+        posted on.
+
+        :yield: (date, tweets) 2-tuples.
+        """
+        date = None
+        tweets = None
+        for tweet in chapter.all_tweets:
+            tweet_date = tweet.timestamp_date_str
+            if tweet_date != date:
+                if date is None:
+                    chapter_start_date = chapter.start_date.strftime(
+                        tweet.REAL_WORLD_TIMELINE_DATE_FORMAT)
+                    if chapter_start_date != tweet_date:
+                        print '[WARNING] Chapter "%s" starts on %s, but its first tweet happens on %s' % (
+                            chapter.name, chapter_start_date, tweet_date)
+                else:
+                    yield date, tweets
+                date = tweet_date
+                tweets = []
+            tweets.append(tweet)
+        if date is not None:
+            yield date, tweets
+
+    def day_html(self, date, tweets):
+        if len(tweets) == 0:
+            return ""
+        if self.real_time:
+            items = [tweet.real_world_timeline_html for tweet in tweets]
+        else:
+            items = [tweet.in_story_timeline_html for tweet in tweets]
+        return "\n".join(["<h3>%s</h3>" % date, "<ul>"] + items + ["</ul>"])
+
+    def write_sections(self, handle, sections):
+        """Write days of the timeline, with a heading wherever a new
+        chapter starts.
+
+        :return: The number of tweets written.
+        """
+        chapter = None
+        count = 0
+        for section_chapter, date, tweets in sections:
+            if section_chapter is not chapter:
+                if chapter is not None:
+                    handle.write("\n\n")
+                chapter = section_chapter
+                handle.write("<h2>%s</h2>\n" % chapter.name)
+            if date is not None:
+                handle.write("\n")
+                handle.write(self.day_html(date, tweets))
+                count += len(tweets)
+        return count
+
+    def write(self, handle):
+        """Write the whole timeline as a single page."""
+        handle.write(self.header())
+        self.write_sections(handle, self.sections())
+        handle.write(self.footer())
+
+    def page_keys(self, split):
+        """A function that says which page a section belongs on."""
+        if split == CHAPTER:
+            return lambda section: section[0]
+        if split != WEEK:
+            raise ValueError("Can't split a timeline by %s." % split)
+        week = [None]
+        def key(section):
+            chapter, date, tweets = section
+            # A day with no tweets goes on the same page as the day
+            # before.
+            if tweets:
+                week[0] = tweets[0].timestamp.isocalendar()[:2]
+            return week[0]
+        return key
+
+    def page_title(self, split, section):
+        """Title a page by the first day on it."""
+        chapter, date, tweets = section
+        if split == WEEK and tweets:
+            timestamp = tweets[0].timestamp
+            monday = timestamp - timedelta(days=timestamp.weekday())
+            return "Week of %s" % monday.strftime("%d %b %Y")
+        return chapter.name
+
+    def navigation(self, index_filename, previous_filename, next_filename):
+        links = ['<a href="%s">Index</a>' % index_filename]
+        if previous_filename is not None:
+            links.append('<a href="%s">Previous</a>' % previous_filename)
+        if next_filename is not None:
+            links.append('<a href="%s">Next</a>' % next_filename)
+        return "<p>%s</p>\n" % " | ".join(links)
+
+    def write_pages(self, directory, split=CHAPTER, prefix="timeline"):
+        """Write the timeline as a series of pages, one per chapter or
+        one per week, plus an index page linking to them.
+
+        :return: A list of the filenames written, starting with the
+            index page.
+        """
+        index_filename = prefix + ".html"
+        filenames = [index_filename]
+        pages = []
+        previous_filename = None
+        out = None
+        for number, (key, sections) in enumerate(
+            itertools.groupby(self.sections(), self.page_keys(split))):
+            filename = "%s-%03d.html" % (prefix, number + 1)
+            if out is not None:
+                # Now it's known that there's a next page.
+                out.write(self.navigation(
+                        index_filename, previous_filename, filename))
+                out.write(self.footer())
+                out.close()
+                previous_filename = filenames[-1]
+            # Only the first day is needed for the title; the rest are
+            # written as they're generated.
+            first = next(sections)
+            title = self.page_title(split, first)
+            out = open(os.path.join(directory, filename), "w")
+            out.write(self.header(title))
+            out.write(self.navigation(index_filename, previous_filename, None))
+            count = self.write_sections(
+                out, itertools.chain([first], sections))
+            out.write("\n")
+            filenames.append(filename)
+            pages.append((filename, title, count))
+        if out is not None:
+            out.write(self.navigation(index_filename, previous_filename, None))
+            out.write(self.footer())
+            out.close()
+
+        out = open(os.path.join(directory, index_filename), "w")
+        out.write(self.header("Index"))
+        out.write("<ul>\n")
+        for filename, title, count in pages:
+            out.write('<li><a href="%s">%s</a> (%d tweets)</li>\n' % (
+                    filename, title, count))
+        out.write("</ul>")
+        out.write(self.footer())
+        out.close()
+        return filenames
@@ -0,0 +1,167 @@
+"""Find out where the time goes.
+
+Code that does something expensive wraps it in a phase:
+
+ with instrument.phase("add_fuzz"):
+     ...
+
+or decorates it with @instrument.timed("add_fuzz"), and notes how
+much work it did with instrument.count("tweets_parsed", 100).
+
+Nothing is recorded unless a Profile has been started with start(),
+which is what the --profile option of make_timeline.py and enact.py
+does. Otherwise, phases and counts cost almost nothing.
+"""
+
+import cProfile
+from contextlib import contextmanager
+import json
+import resource
+import threading
+import time
+
+class Profile(object):
+    """Wall and CPU time spent in each phase, and counts of things done.
+
+    Phases can be nested, and the time spent in a phase includes the
+    time spent in any phases inside it. CPU time is for the whole
+    process, so if several threads are busy at once, a phase may be
+    charged for CPU time used by another thread.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    @staticmethod
+    def cpu_time():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+
+    @contextmanager
+    def phase(self, name):
+        wall = time.time()
+        cpu = self.cpu_time()
+        try:
+            yield
+        finally:
+            wall = time.time() - wall
+            cpu = self.cpu_time() - cpu
+            with self.lock:
+                phase = self.phases.get(name)
+                if phase is None:
+                    phase = self.phases[name] = dict(calls=0, wall=0, cpu=0)
+                phase['calls'] += 1
+                phase['wall'] += wall
+                phase['cpu'] += cpu
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    @property
+    def report(self):
+        with self.lock:
+            return dict(
+                phases=dict((name, dict(phase))
+                            for name, phase in self.phases.items()),
+                counters=dict(self.counters),
+                wall=time.time() - self.started,
+                # On Linux, ru_maxrss is measured in kilobytes.
+                peak_memory=resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+    def save(self, filename):
+        out = open(filename, "w")
+        out.write(json.dumps(self.report, indent=2, sort_keys=True))
+        out.close()
+
+
+# The Profile being recorded, if any.
+profile = None
+# The cProfile.Profile being recorded, if any.
+code_profile = None
+
+@contextmanager
+def nothing():
+    yield
+
+def phase(name):
+    """A context manager that charges the time spent inside it to a phase."""
+    if profile is None:
+        return nothing()
+    return profile.phase(name)
+
+def timed(name):
+    """A decorator that charges the time spent in a function to a phase."""
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            if profile is None:
+                return function(*args, **kwargs)
+            with profile.phase(name):
+                return function(*args, **kwargs)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorator
+
+def count(name, amount=1):
+    """Note that something happened `amount` times."""
+    if profile is not None:
+        profile.count(name, amount)
+
+def start(code=False):
+    """Start recording.
+
+    :param code: If True, also run cProfile on all the code that runs
+        in this thread.
+    """
+    global profile, code_profile
+    profile = Profile()
+    if code:
+        code_profile = cProfile.Profile()
+        code_profile.enable()
+    return profile
+
+def stop(filename=None, code_filename=None):
+    """Stop recording.
+
+    :param filename: Save the phases and counts here, as JSON.
+    :param code_filename: Save the cProfile statistics here, in the
+        format used by the pstats module.
+    """
+    global profile, code_profile
+    if code_profile is not None:
+        code_profile.disable()
+        if code_filename is not None:
+            code_profile.dump_stats(code_filename)
+    if profile is not None and filename is not None:
+        profile.save(filename)
+    finished = profile
+    profile = None
+    code_profile = None
+    return finished
+
+def add_arguments(parser):
+    """Add the profiling options to a command-line ArgumentParser."""
+    parser.add_argument(
+        "--profile", metavar="FILENAME",
+        help="Save the wall and CPU time spent in each phase, and counts "
+        "of the work done, to this JSON file.")
+    parser.add_argument(
+        "--cprofile", metavar="FILENAME",
+        help="Run cProfile, and save its statistics to this file.")
+
+@contextmanager
+def profiling(options):
+    """Record whatever happens inside, if the command line asked for it."""
+    if options.profile is None and options.cprofile is None:
+        yield
+        return
+    start(code=options.cprofile is not None)
+    try:
+        yield
+    finally:
+        stop(options.profile, options.cprofile)
@@ -1,18 +1,107 @@
-from timeline import load_stream, Stream
+from timeline import (
+    load_build_cache, load_parse_cache, load_stream, Stream, StreamingStream)
+from binary_timeline import BinaryTimelineWriter
+from html_timeline import SPLITS
+from argparse import ArgumentParser
+import instrument
+import next_due
 import os
-import sys
 
-if len(sys.argv) != 2:
-    print "Usage: %s [script directory]" % sys.argv[0]
-    sys.exit()
+parser = ArgumentParser(
+    description="Turn a script into timeline.html and timeline.json.")
+parser.add_argument("script_directory", help="The script directory.")
+parser.add_argument(
+    "--stream", action="store_true",
+    help="Write timeline.json while the script is being parsed, without "
+    "holding the whole script in memory. No HTML timeline is written.")
+parser.add_argument(
+    "--rebuild", action="store_true",
+    help="Calculate new timestamps for every chapter, even the ones that "
+    "haven't changed since the last build.")
+parser.add_argument(
+    "--processes", type=int, default=1,
+    help="Parse chapters in this many processes at once. The same "
+    "random_seed gives different timestamps than with one process.")
+parser.add_argument(
+    "--split", choices=SPLITS,
+    help="Write the HTML timeline as one page per chapter or per "
+    "real-world week. timeline.html becomes an index of the pages.")
+parser.add_argument(
+    "--binary", action="store_true",
+    help="Also write timeline.bin, which enact.py can read much faster "
+    "than timeline.json.")
+instrument.add_arguments(parser)
+options = parser.parse_args()
 
-script_directory = sys.argv[1]
-stream = load_stream(script_directory)
+script_directory = options.script_directory
+json_script_filename = os.path.join(script_directory, "timeline.json")
+binary_script_filename = os.path.join(script_directory, "timeline.bin")
 
-timeline_filename = os.path.join(script_directory, "timeline.html")
-print "Writing HTML timeline to %s." % timeline_filename
-open(timeline_filename, "w").write(stream.html_page(real_time=True))
+def write_json(stream):
+    print "Writing JSON timeline to %s." % json_script_filename
+    output = open(json_script_filename, "w")
+    binary_writer = None
+    if options.binary:
+        print "Writing binary timeline to %s." % binary_script_filename
+        binary_writer = BinaryTimelineWriter(
+            open(binary_script_filename, "wb"),
+            [author['account'] for author in stream.tweet_parser.authors])
+    stream.write_json(output, binary_writer)
+    output.close()
+    if binary_writer is not None:
+        # Closed after timeline.json, so it's never older.
+        binary_writer.close()
+        binary_writer.handle.close()
 
-json_script_filename = os.path.join(script_directory, "timeline.json")
-print "Writing JSON timeline to %s." % json_script_filename
-open(json_script_filename, "w").write(stream.json)
+def write_next_due(stream):
+    """Note when the first unposted tweet is due, for enact_if_due.py."""
+    progress = stream.tweet_parser.progress
+    timestamps = [tweet.timestamp_for_json for tweet in stream.tweets
+                  if progress is None or tweet.digest not in progress]
+    if len(timestamps) == 0:
+        next_due.write(script_directory, None)
+    else:
+        next_due.write(script_directory, min(timestamps))
+
+with instrument.profiling(options):
+    if options.stream:
+        stream = load_stream(script_directory, StreamingStream)
+        write_json(stream)
+        # The tweets are gone by now, so it's up to enact.py to work
+        # out when the next one is due.
+        next_due.remove(script_directory)
+    else:
+        build_cache = load_build_cache(script_directory)
+        if options.rebuild:
+            build_cache.chapters = {}
+        parse_cache = None
+        if options.processes == 1:
+            parse_cache = load_parse_cache(script_directory)
+        stream = load_stream(script_directory, build_cache=build_cache,
+                             processes=options.processes,
+                             parse_cache=parse_cache)
+        build_cache.save()
+        if parse_cache is not None:
+            if parse_cache.hits > 0:
+                print "Script hasn't changed; reused the parsed script from %s." % (
+                    parse_cache.filename)
+            else:
+                print "Parsed the script, and cached it in %s." % (
+                    parse_cache.filename)
+        print "Reused timestamps for %d chapters, calculated %d." % (
+            build_cache.hits, build_cache.misses)
+
+        timeline_filename = os.path.join(script_directory, "timeline.html")
+        print "Writing HTML timeline to %s." % timeline_filename
+        if options.split is None:
+            output = open(timeline_filename, "w")
+            stream.write_html(output, real_time=True)
+            output.close()
+        else:
+            filenames = stream.write_html_pages(
+                script_directory, options.split, real_time=True)
+            print "Wrote %d pages, one per %s." % (
+                len(filenames) - 1, options.split)
+
+        write_json(stream)
+        write_next_due(stream)
@@ -0,0 +1,65 @@
+"""Keep track of when a story's next tweet is due.
+
+make_timeline.py and enact.py leave a one-line file, next_due.txt, in
+the script directory. It says when the first unposted tweet is to be
+posted, in seconds since the epoch, or "none" if every tweet has been
+posted. It also notes the size and modification time of the
+timeline.json it was worked out from, so that if the timeline is
+rebuilt, the file is ignored until it's written again.
+
+enact_if_due.py reads this file to decide whether there's any point in
+running enact.py at all. Nothing here imports anything that isn't
+already loaded when Python starts, so that decision takes no time.
+"""
+
+import os
+
+FILENAME = "next_due.txt"
+
+def fingerprint(timeline_filename):
+    stat = os.stat(timeline_filename)
+    return "%d %r" % (stat.st_size, stat.st_mtime)
+
+def write(script_directory, timestamp):
+    """Note when the next tweet is due.
+
+    :param timestamp: Seconds since the epoch, or None if there are no
+        more tweets to post.
+    """
+    if timestamp is None:
+        timestamp = "none"
+    else:
+        timestamp = "%d" % timestamp
+    filename = os.path.join(script_directory, FILENAME)
+    temporary_filename = filename + ".tmp"
+    out = open(temporary_filename, "w")
+    out.write("%s %s\n" % (timestamp, fingerprint(
+                os.path.join(script_directory, "timeline.json"))))
+    out.close()
+    os.rename(temporary_filename, filename)
+
+def remove(script_directory):
+    """Forget when the next tweet is due, so enact.py will have to look."""
+    filename = os.path.join(script_directory, FILENAME)
+    if os.path.exists(filename):
+        os.remove(filename)
+
+def read(script_directory):
+    """Find out when the next tweet is due.
+
+    :return: A 2-tuple (whether it's known, seconds since the epoch or
+        None if there are no more tweets). It's not known if the file
+        is missing or unreadable, or if the timeline has changed since
+        it was written.
+    """
+    try:
+        line = open(os.path.join(script_directory, FILENAME)).read()
+        timestamp, recorded = line.strip().split(" ", 1)
+        if recorded != fingerprint(
+            os.path.join(script_directory, "timeline.json")):
+            return False, None
+        if timestamp == "none":
+            return True, None
+        return True, int(timestamp)
+    except (IOError, OSError, ValueError):
+        return False, None
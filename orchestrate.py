@@ -0,0 +1,61 @@
+"""Post the tweets for many stories from a single process.
+
+ python orchestrate.py [--once] [--workers N] directory-or-glob ...
+
+Every story's unposted tweets go into one scheduler, so one process
+can keep hundreds of stories running. Each story keeps its own
+progress file, and a story that can't be loaded or posted doesn't
+stop the others.
+"""
+
+from argparse import ArgumentParser
+import glob
+import os
+
+from enact import Scheduler, run_daemon
+import instrument
+
+def find_script_directories(patterns):
+    """Turn directory names and glob patterns into script directories."""
+    directories = []
+    for pattern in patterns:
+        for directory in sorted(glob.glob(pattern)) or [pattern]:
+            if (os.path.exists(os.path.join(directory, "config.json"))
+                and directory not in directories):
+                directories.append(directory)
+    return directories
+
+def main():
+    parser = ArgumentParser(
+        description="Post the tweets for many stories to Twitter.")
+    parser.add_argument(
+        "script_directories", nargs="+", metavar="script_directory",
+        help="A script directory, or a glob pattern matching several.")
+    parser.add_argument(
+        "--once", action="store_true",
+        help="Post every tweet that's due and exit, instead of running "
+        "forever.")
+    parser.add_argument(
+        "--workers", type=int, default=4,
+        help="Post tweets for up to this many stories at once.")
+    parser.add_argument(
+        "--threads", type=int,
+        help="Post up to this many of a story's overdue tweets at once. "
+        "Overrides posting_threads in each story's config.json.")
+    parser.add_argument(
+        "--status-file",
+        help="Keep the state of the rate limits in this JSON file.")
+    instrument.add_arguments(parser)
+    options = parser.parse_args()
+
+    directories = find_script_directories(options.script_directories)
+    if len(directories) == 0:
+        parser.error("No script directories found.")
+    print "Posting %d stories." % len(directories)
+    with instrument.profiling(options):
+        run_daemon(directories, Scheduler(workers=options.workers),
+                   posting_threads=options.threads, forever=not options.once,
+                   status_filename=options.status_file)
+
+if __name__ == '__main__':
+    main()
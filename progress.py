@@ -0,0 +1,271 @@
+"""Keep track of which tweets have been posted."""
+
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+
+# How often the log is forced onto the disk with fsync().
+# After every entry:
+FSYNC_ALWAYS = "always"
+# Whenever the log is committed, usually after a batch of posts:
+FSYNC_BATCH = "batch"
+# Never. It's up to the operating system:
+FSYNC_NEVER = "never"
+
+class ProgressLog(object):
+    """The progress made in posting a stream.
+
+    The log itself is progress.json: an append-only file with one JSON
+    entry per posted tweet. Alongside it is an SQLite index that maps
+    each tweet's internal ID to the position of its entry in the log,
+    so that looking up a tweet doesn't mean reading the whole log.
+
+    If the log has grown since the index was last updated (say, because
+    an older version of Sycorax appended to it), the new entries are
+    indexed the next time the log is opened. If the log has been
+    replaced, it's reindexed from scratch.
+
+    Each entry is handed to the operating system as soon as it's
+    appended, so it survives even if this process dies. How often it's
+    forced onto the disk depends on `fsync_policy`. When several
+    threads append at once, they share a single fsync(). The index is
+    never forced onto the disk, since if it's lost, the log can be
+    reindexed.
+
+    If a crash left a half-written entry at the end of the log, it's
+    repaired when the log is opened.
+
+    A ProgressLog can be shared between threads, and several processes
+    can append to the same log at once.
+    """
+
+    def __init__(self, filename, index_filename=None,
+                 fsync_policy=FSYNC_BATCH):
+        if fsync_policy not in (FSYNC_ALWAYS, FSYNC_BATCH, FSYNC_NEVER):
+            raise ValueError("Unknown fsync policy: %s" % fsync_policy)
+        self.filename = filename
+        self.index_filename = index_filename or filename + ".index"
+        self.fsync_policy = fsync_policy
+        self.lock = threading.RLock()
+        self.sync_lock = threading.Lock()
+        self.handle = None
+        # Kept open for looking up entries.
+        self.reader = None
+        # The number of entries appended, and the number of those
+        # known to be on disk.
+        self.written = 0
+        self.synced = 0
+
+        self.repair()
+        self.index = sqlite3.connect(
+            self.index_filename, check_same_thread=False)
+        # The index can always be rebuilt from the log, so there's no
+        # need to wait for it to reach the disk.
+        self.index.execute("PRAGMA synchronous=OFF")
+        self.index.execute(
+            "CREATE TABLE IF NOT EXISTS entries "
+            "(internal_id TEXT PRIMARY KEY, offset INTEGER)")
+        self.index.execute(
+            "CREATE TABLE IF NOT EXISTS log "
+            "(size INTEGER, last_internal_id TEXT, last_offset INTEGER)")
+        self.catch_up()
+
+    @property
+    def log_size(self):
+        if not os.path.exists(self.filename):
+            return 0
+        return os.stat(self.filename).st_size
+
+    def repair(self):
+        """Deal with a partially written entry at the end of the log."""
+        if self.log_size == 0:
+            return
+        handle = open(self.filename, "r+b")
+        handle.seek(-1, os.SEEK_END)
+        if handle.read(1) == "\n":
+            # The last entry is complete.
+            handle.close()
+            return
+
+        # Find the start of the last line.
+        position = self.log_size
+        tail = ""
+        while position > 0:
+            block = min(4096, position)
+            position -= block
+            handle.seek(position)
+            tail = handle.read(block) + tail
+            newline = tail.rfind("\n")
+            if newline != -1:
+                start = position + newline + 1
+                tail = tail[newline+1:]
+                break
+        else:
+            start = 0
+
+        try:
+            json.loads(tail)
+            # The entry was written, but not the newline after it.
+            handle.seek(0, os.SEEK_END)
+            handle.write("\n")
+        except ValueError:
+            # The entry is incomplete and can't be recovered.
+            print '[WARNING] Removing incomplete entry from %s: %s' % (
+                self.filename, tail)
+            handle.truncate(start)
+        handle.close()
+
+    def catch_up(self):
+        """Index any entries the index doesn't know about."""
+        row = self.index.execute(
+            "SELECT size, last_internal_id, last_offset FROM log").fetchone()
+        if row is None:
+            indexed_size, last_internal_id, last_offset = 0, None, None
+        else:
+            indexed_size, last_internal_id, last_offset = row
+
+        size = self.log_size
+        if indexed_size > size or (
+            last_internal_id is not None
+            and self.read_entry(last_offset).get(
+                'internal_id') != last_internal_id):
+            # This isn't the log that was indexed. Start over.
+            self.index.execute("DELETE FROM entries")
+            indexed_size = 0
+
+        if indexed_size < size:
+            handle = open(self.filename)
+            handle.seek(indexed_size)
+            offset = indexed_size
+            for line in iter(handle.readline, ''):
+                entry = json.loads(line.strip())
+                self.add_to_index(entry, offset, offset + len(line))
+                offset += len(line)
+            handle.close()
+        self.index.commit()
+
+    def add_to_index(self, entry, offset, end):
+        """Note that an entry runs from `offset` to `end` in the log."""
+        self.index.execute(
+            "INSERT OR REPLACE INTO entries (internal_id, offset) "
+            "VALUES (?, ?)", (entry['internal_id'], offset))
+        self.index.execute("DELETE FROM log")
+        self.index.execute(
+            "INSERT INTO log (size, last_internal_id, last_offset) "
+            "VALUES (?, ?, ?)", (end, entry['internal_id'], offset))
+
+    def read_entry(self, offset):
+        with self.lock:
+            if self.reader is None:
+                self.reader = open(self.filename)
+            self.reader.seek(offset)
+            line = self.reader.readline()
+        try:
+            return json.loads(line.strip())
+        except ValueError:
+            return {}
+
+    def get(self, internal_id, default=None):
+        """Find the log entry for the tweet with the given internal ID."""
+        with self.lock:
+            row = self.index.execute(
+                "SELECT offset FROM entries WHERE internal_id=?",
+                (internal_id,)).fetchone()
+        if row is None:
+            return default
+        return self.read_entry(row[0])
+
+    def __contains__(self, internal_id):
+        with self.lock:
+            return self.index.execute(
+                "SELECT 1 FROM entries WHERE internal_id=?",
+                (internal_id,)).fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.index.execute(
+                "SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def __iter__(self):
+        """Iterate over every entry in the log, in the order posted."""
+        if not os.path.exists(self.filename):
+            return
+        for line in open(self.filename):
+            yield json.loads(line.strip())
+
+    def append(self, entry):
+        """Add an entry to the end of the log."""
+        line = json.dumps(entry) + "\n"
+        with self.lock:
+            if self.handle is None:
+                self.handle = open(self.filename, "a")
+            # Another process may be appending to the log too. Keep it
+            # out until this entry is written and indexed, so the end
+            # of the log doesn't move in between.
+            fcntl.flock(self.handle.fileno(), fcntl.LOCK_EX)
+            try:
+                self.handle.seek(0, os.SEEK_END)
+                offset = self.handle.tell()
+                self.handle.write(line)
+                self.handle.flush()
+                self.written += 1
+                written = self.written
+                self.add_to_index(entry, offset, offset + len(line))
+                # Other processes may want to read the index, so don't
+                # leave it locked.
+                self.index.commit()
+            finally:
+                fcntl.flock(self.handle.fileno(), fcntl.LOCK_UN)
+        if self.fsync_policy == FSYNC_ALWAYS:
+            self.sync(written)
+
+    def sync(self, through=None):
+        """Make sure that entries are on disk.
+
+        :param through: Make sure the first this-many entries
+            appended are on disk. By default, all of them.
+        """
+        with self.sync_lock:
+            if through is not None and self.synced >= through:
+                # Another thread's fsync() took care of it.
+                return
+            with self.lock:
+                written = self.written
+                handle = self.handle
+            if handle is not None:
+                os.fsync(handle.fileno())
+            self.synced = written
+
+    def commit(self):
+        """Make everything appended so far durable."""
+        if self.fsync_policy != FSYNC_NEVER:
+            self.sync()
+
+    def close(self):
+        self.commit()
+        with self.lock:
+            if self.handle is not None:
+                self.handle.close()
+                self.handle = None
+            if self.reader is not None:
+                self.reader.close()
+                self.reader = None
+
+    def import_jsonl(self, input_stream):
+        """Append entries from a JSONL file, skipping any already logged."""
+        for line in input_stream:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            entry = json.loads(line)
+            if entry['internal_id'] not in self:
+                self.append(entry)
+        self.commit()
+
+    def export_jsonl(self, output_stream):
+        """Write every entry to a JSONL file."""
+        for entry in self:
+            output_stream.write(json.dumps(entry))
+            output_stream.write("\n")
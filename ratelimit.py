@@ -0,0 +1,238 @@
+"""Keep tweets from being posted faster than Twitter allows."""
+
+import random
+import threading
+import time
+
+# Twitter lets each account post about 300 tweets every three hours,
+# and the same goes for each application as a whole.
+DEFAULT_TWEETS_PER_HOUR = 100
+DEFAULT_ACCOUNT_TWEETS_PER_HOUR = 100
+# How many tweets can go out at once before the rate kicks in.
+DEFAULT_BURST = 30
+DEFAULT_ACCOUNT_BURST = 10
+
+# After an error, an account waits this long before trying again. The
+# wait doubles with every consecutive error, up to the maximum.
+MINIMUM_BACKOFF_SECONDS = 15
+MAXIMUM_BACKOFF_SECONDS = 60 * 60
+
+class TokenBucket(object):
+    """Allows `rate` events per second on average, with bursts of up
+    to `capacity` events.
+    """
+
+    def __init__(self, rate, capacity, clock=time.time):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = float(capacity)
+        self.updated = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def delay(self):
+        """How many seconds until an event is allowed."""
+        self.refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    @property
+    def state(self):
+        self.refill()
+        return dict(tokens=self.tokens, capacity=self.capacity,
+                    per_hour=self.rate * 60 * 60)
+
+    def dump(self):
+        """What load() needs to pick up where this bucket left off."""
+        return dict(tokens=self.tokens, updated=self.updated)
+
+    def load(self, saved):
+        """Take on a saved state, if it allows fewer events than this
+        bucket does now.
+        """
+        self.refill()
+        tokens = saved['tokens'] + (self.updated - saved['updated']) * self.rate
+        self.tokens = min(self.tokens, tokens)
+
+
+class Backoff(object):
+    """Exponential backoff with jitter.
+
+    Each consecutive failure doubles the wait. The actual wait is
+    somewhere between half the full wait and the full wait, so that
+    accounts which failed together don't all try again together.
+    """
+
+    def __init__(self, minimum=MINIMUM_BACKOFF_SECONDS,
+                 maximum=MAXIMUM_BACKOFF_SECONDS, clock=time.time,
+                 rng=random):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.clock = clock
+        self.rng = rng
+        self.failures = 0
+        self.until = None
+
+    def failed(self):
+        """Note a failure.
+
+        :return: How many seconds to wait before trying again.
+        """
+        self.failures += 1
+        ceiling = min(self.maximum, self.minimum * 2 ** (self.failures - 1))
+        delay = self.rng.uniform(ceiling / 2.0, ceiling)
+        self.until = self.clock() + delay
+        return delay
+
+    def succeeded(self):
+        self.failures = 0
+        self.until = None
+
+    @property
+    def delay(self):
+        """How many seconds until it's time to try again."""
+        if self.until is None:
+            return 0
+        return max(0, self.until - self.clock())
+
+    @property
+    def state(self):
+        return dict(failures=self.failures, delay=self.delay)
+
+    def dump(self):
+        """What load() needs to pick up where this backoff left off."""
+        return dict(failures=self.failures, until=self.until)
+
+    def load(self, saved):
+        """Take on a saved state, if it means waiting longer."""
+        if saved['until'] is not None and (
+            self.until is None or saved['until'] > self.until):
+            self.failures = saved['failures']
+            self.until = saved['until']
+
+
+class RateLimiter(object):
+    """Rate limits for one application and the accounts posting with it.
+
+    A tweet can be posted only if both the application's token bucket
+    and its account's token bucket allow it, and the account isn't
+    backing off after an error.
+
+    A RateLimiter can be shared between threads.
+    """
+
+    def __init__(self, tweets_per_hour=DEFAULT_TWEETS_PER_HOUR,
+                 burst=DEFAULT_BURST,
+                 account_tweets_per_hour=DEFAULT_ACCOUNT_TWEETS_PER_HOUR,
+                 account_burst=DEFAULT_ACCOUNT_BURST,
+                 clock=time.time, rng=random):
+        self.account_rate = account_tweets_per_hour / 3600.0
+        self.account_burst = account_burst
+        self.clock = clock
+        self.rng = rng
+        self.bucket = TokenBucket(tweets_per_hour / 3600.0, burst, clock)
+        self.account_buckets = {}
+        self.backoffs = {}
+        self.lock = threading.Lock()
+
+    def for_account(self, account):
+        """The token bucket and backoff for the given account.
+
+        Must be called with the lock held.
+        """
+        if account not in self.account_buckets:
+            self.account_buckets[account] = TokenBucket(
+                self.account_rate, self.account_burst, self.clock)
+            self.backoffs[account] = Backoff(clock=self.clock, rng=self.rng)
+        return self.account_buckets[account], self.backoffs[account]
+
+    def acquire(self, account):
+        """Try to get permission to post a tweet from the given account.
+
+        :return: 0 if the tweet can be posted now. Otherwise, the
+            number of seconds to wait before asking again.
+        """
+        with self.lock:
+            bucket, backoff = self.for_account(account)
+            delay = max(backoff.delay, bucket.delay, self.bucket.delay)
+            if delay == 0:
+                bucket.take()
+                self.bucket.take()
+            return delay
+
+    def failed(self, account):
+        """Note that a tweet from the given account hit a rate limit or
+        a transient error.
+
+        :return: How many seconds the account should wait before
+            trying again.
+        """
+        with self.lock:
+            bucket, backoff = self.for_account(account)
+            return backoff.failed()
+
+    def succeeded(self, account):
+        with self.lock:
+            bucket, backoff = self.for_account(account)
+            backoff.succeeded()
+
+    @property
+    def state(self):
+        """The state of every limit, for monitoring."""
+        with self.lock:
+            accounts = {}
+            for account, bucket in self.account_buckets.items():
+                accounts[account] = dict(
+                    bucket.state, **self.backoffs[account].state)
+            return dict(self.bucket.state, accounts=accounts)
+
+    def dump(self):
+        """Everything needed to carry these limits over to another
+        process, as something that can be written as JSON.
+        """
+        with self.lock:
+            accounts = {}
+            for account, bucket in self.account_buckets.items():
+                accounts[account] = dict(
+                    bucket=bucket.dump(),
+                    backoff=self.backoffs[account].dump())
+            return dict(bucket=self.bucket.dump(), accounts=accounts)
+
+    def load(self, saved):
+        """Take on limits saved by dump().
+
+        Whichever is stricter, the saved limit or the current one,
+        wins. That way, several stories sharing this RateLimiter can
+        each load what they saved, in any order.
+        """
+        with self.lock:
+            self.bucket.load(saved['bucket'])
+            for account, limits in saved['accounts'].items():
+                bucket, backoff = self.for_account(account)
+                bucket.load(limits['bucket'])
+                backoff.load(limits['backoff'])
+
+
+# Every story posting with the same consumer key shares these limits.
+limiters_by_consumer_key = {}
+limiters_lock = threading.Lock()
+
+def shared_limiter(consumer_key, **kwargs):
+    """The RateLimiter for everything posted with the given consumer key.
+
+    It's created, with the given settings, the first time it's needed.
+    """
+    with limiters_lock:
+        if consumer_key not in limiters_by_consumer_key:
+            limiters_by_consumer_key[consumer_key] = RateLimiter(**kwargs)
+        return limiters_by_consumer_key[consumer_key]
@@ -2,7 +2,32 @@
 
 from datetime import datetime, timedelta
 from unittest import main, TestCase
-from timeline import TweetParser, Stream, Tweet, Day, Chapter
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+from StringIO import StringIO
+from enact import (
+    ClientPool, ConcurrentPoster, Scheduler, Story, parse_twitter_time,
+    run_daemon)
+from benchmark import time_phases, write_story, PHASES
+from binary_timeline import BinaryTimeline, BinaryTimelineWriter
+from fake_twitter import FakeTwitter
+from html_timeline import CHAPTER, WEEK
+import instrument
+import next_due
+from orchestrate import find_script_directories
+from progress import ProgressLog
+import ratelimit
+from ratelimit import Backoff, RateLimiter, TokenBucket
+from timeline import (
+    BuildCache, CommandLexer, TweetParser, Stream, StreamingStream, Tweet, Day, Chapter,
+    from_epoch, load_parse_cache, load_progress, load_stream, parse_timestamp, to_epoch)
 import pytz
 
 # Begin mock objects.
@@ -67,12 +92,22 @@ class SycoraxTestCase(TestCase):
     def make_parser(self, config={}, fuzz_quotient=0, fuzz_minimum_seconds=0):
         base_config = dict(self.CONFIG)
         base_config.update(config)
-        return TweetParser(base_config, fuzz_quotient, fuzz_minimum_seconds)
+        return TweetParser(base_config, fuzz_quotient=fuzz_quotient,
+                           fuzz_minimum_seconds=fuzz_minimum_seconds)
 
     def make_stream(self, tweet_parser=None, *lines):
         tweet_parser = tweet_parser or self.make_parser()
         return Stream(lines, tweet_parser)
 
+    def quietly(self, function, *args, **kwargs):
+        """Call a function, throwing away anything it prints."""
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            sys.stdout = stdout
+
     def assertDefaultAuthor(self, tweet):
         """Assert that the given tweet has the default author."""
         self.assertEquals(self.AUTHORS[0]['account'], tweet.author['account'])
@@ -155,6 +190,1371 @@ class TestTweetParser(SycoraxTestCase):
         text = "13P Foobar"
         self.assertRaises(ValueError, self.tweet_for, text)
 
+    def test_longest_author_code_wins(self):
+        authors = self.AUTHORS + [dict(account="author4", code="++")]
+        parser = self.make_parser(dict(authors=authors))
+        stream = self.make_stream(parser, "+ One", "++ Two", "R++10M Three")
+        one, two, three = stream.chapters[0].all_tweets
+        self.assertEquals("author2", one.author['account'])
+        self.assertEquals("author4", two.author['account'])
+        self.assertEquals("author4", three.author['account'])
+        self.assertEquals(three.in_reply_to, two)
+        self.assertDelayEquals(three, minutes=10)
+
+    def test_repeated_command_is_not_a_command(self):
+        for text in ("RR Foobar", "1H1H Foobar", "9A1H Foobar", "+-1H Foobar"):
+            tweet = self.tweet_for(text)
+            self.assertEquals(text, tweet.text)
+            self.assertDefaultAuthor(tweet)
+
+
+class TestCommandLexer(TestCase):
+
+    def test_commands_in_any_order(self):
+        lexer = CommandLexer(["", "+", "@"])
+        self.assertEquals(("+", True, "10M", None), lexer.lex("+R10M"))
+        self.assertEquals(("+", True, "10M", None), lexer.lex("R+10M"))
+        self.assertEquals(("@", False, "2D", "9A"), lexer.lex("2D@9A"))
+        self.assertEquals((None, False, None, "12P"), lexer.lex("12P"))
+
+    def test_not_a_command(self):
+        lexer = CommandLexer(["", "+"])
+        for word in ("Rh+", "foo", "10X", "+ +", "R+R"):
+            self.assertEquals(None, lexer.lex(word))
+
+    def test_longest_match(self):
+        lexer = CommandLexer(["Ro", "Rob", "Robin", "2", "1H"])
+        self.assertEquals(("Rob", False, None, None), lexer.lex("Rob"))
+        self.assertEquals(("Robin", False, "5M", None), lexer.lex("Robin5M"))
+        # Once "Rob" has matched, the "i" left over isn't a command.
+        self.assertEquals(("Ro", True, None, None), lexer.lex("RoR"))
+        self.assertEquals(None, lexer.lex("Robi"))
+        # The longest match wins even if it's not an author code...
+        self.assertEquals(("2", True, None, None), lexer.lex("2R"))
+        self.assertEquals((None, False, "20M", None), lexer.lex("20M"))
+        # ...but an author code wins a tie.
+        self.assertEquals(("1H", False, None, None), lexer.lex("1H"))
+
+    def test_many_authors(self):
+        codes = [""] + ["@%d" % i for i in range(1000)]
+        lexer = CommandLexer(codes)
+        self.assertEquals(("@999", True, None, "9A"), lexer.lex("@999R9A"))
+        self.assertEquals(("@10", False, None, None), lexer.lex("@10"))
+        self.assertEquals(None, lexer.lex("@1000"))
+
+class TestStream(SycoraxTestCase):
+
+    def test_chapters_keep_running_totals(self):
+        parser = self.make_parser(
+            dict(chapter_duration_days=timedelta(days=10)))
+        stream = self.make_stream(
+            parser, "== Chapter 1", "First", "-- Day 2", "10A Second",
+            "== Chapter 2", "Third")
+        chapter1, chapter2 = stream.chapters
+        first, second, third = stream.tweets
+
+        self.assertEquals(2, chapter1.total_tweets)
+        self.assertEquals(first, chapter1.first_tweet)
+        self.assertEquals(second, chapter1.last_tweet)
+
+        self.assertEquals(1, chapter2.total_tweets)
+        self.assertEquals(third, chapter2.first_tweet)
+        self.assertEquals(third, chapter2.last_tweet)
+
+    def test_tweets_share_delays(self):
+        stream = self.make_stream(None, "10M First", "10M Second")
+        t1, t2 = stream.tweets
+        self.assertTrue(t1.delay is t2.delay)
+        self.assertFalse(hasattr(t1, '__dict__'))
+
+    def test_empty_stream(self):
+        stream = self.make_stream()
+        self.assertEquals([], stream.chapters)
+        self.assertEquals(None, stream.latest_tweet)
+
+class TestStreamingStream(SycoraxTestCase):
+
+    SCRIPT = ["== Chapter 1", "First", "+R10M Second", "-- Day 2",
+              "1D Third", "== Chapter 2", "Fourth"]
+
+    def make_parser(self):
+        return SycoraxTestCase.make_parser(
+            self, dict(chapter_duration_days=timedelta(days=10)))
+
+    def test_same_records_as_stream(self):
+        stream = Stream(self.SCRIPT, self.make_parser())
+        streaming = StreamingStream(self.SCRIPT, self.make_parser())
+        self.assertEquals(stream.json.split("\n"), list(streaming.json_lines))
+
+    def test_nothing_is_retained(self):
+        streaming = StreamingStream(self.SCRIPT, self.make_parser())
+        records = list(streaming.json_lines)
+        self.assertEquals(4, len(records))
+        self.assertEquals([], streaming.chapters)
+        self.assertEquals([], streaming.latest_chapter.days)
+        self.assertEquals(1, streaming.latest_chapter.total_tweets)
+
+    def test_write_json(self):
+        stream = Stream(self.SCRIPT, self.make_parser())
+        streaming = StreamingStream(self.SCRIPT, self.make_parser())
+        for s in stream, streaming:
+            output = StringIO()
+            s.write_json(output)
+            self.assertEquals(stream.json + "\n", output.getvalue())
+
+class TestJSONRecords(SycoraxTestCase):
+
+    def test_same_as_json_dumps(self):
+        timezone = pytz.timezone("US/Central")
+        parent = Tweet("Parent", self.AUTHORS[0], None, timezone)
+        tweet = Tweet('Caf\xc3\xa9 "quoted" \\ \xe2\x80\x9c',
+                      self.AUTHORS[1], None, timezone, in_reply_to=parent)
+        for t in parent, tweet:
+            t.timestamp = timezone.localize(datetime(2011, 12, 31, 19, 5, 6))
+            if t.in_reply_to is None:
+                in_reply_to = None
+            else:
+                in_reply_to = t.in_reply_to.digest
+            expect = json.dumps(dict(
+                    internal_id=t.digest, text=t.text,
+                    author=t.author['account'], in_reply_to=in_reply_to,
+                    timestamp=1325379906))
+            self.assertEquals(expect, t.json)
+        self.assertEquals(1325379906, tweet.timestamp_for_json)
+
+
+class TestTimestamps(TestCase):
+
+    def test_epoch(self):
+        central = pytz.timezone("US/Central")
+        moment = central.localize(datetime(2011, 12, 31, 19, 5, 6))
+        self.assertEquals(1325379906, to_epoch(moment))
+        self.assertEquals(1325379906, to_epoch(datetime(2012, 1, 1, 1, 5, 6)))
+        self.assertEquals(moment, from_epoch(1325379906))
+
+    def test_old_timestamps_can_be_read(self):
+        self.assertEquals(1325379906, parse_timestamp(1325379906))
+        self.assertEquals(
+            1325379906, parse_timestamp("01 Jan 2012 01:05:06 UTC"))
+        self.assertRaises(ValueError, parse_timestamp, "Tomorrow")
+
+    def test_twitter_time(self):
+        self.assertEquals(
+            1325379906, parse_twitter_time("Sun Jan 01 01:05:06 +0000 2012"))
+
+class TestHTMLTimeline(SycoraxTestCase):
+
+    SCRIPT = ["== Chapter 1", "First", "+R10M Second", "-- Day 2",
+              "1D Third", "== Chapter 2", "Fourth"]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.stream = Stream(self.SCRIPT, self.make_parser(
+                dict(chapter_duration_days=timedelta(days=10))))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, filename):
+        return open(os.path.join(self.directory, filename)).read()
+
+    def test_write_html(self):
+        for real_time in False, True:
+            output = StringIO()
+            self.stream.write_html(output, real_time)
+            page = output.getvalue()
+            self.assertEquals(self.stream.html_page(real_time), page)
+        self.assertTrue("<h2>Chapter 2</h2>" in page)
+        self.assertTrue('<li class="author1">04:00 First</li>' in page)
+        self.assertTrue(
+            '<ul>\n<li class="author2">04:10 Second</li>\n</ul>' in page)
+
+    def test_formatted_timestamp_follows_timestamp(self):
+        tweet = list(self.stream.tweets)[0]
+        self.assertEquals("04:00", tweet.timestamp_str)
+        self.assertEquals("Sat 01 Jan", tweet.timestamp_date_str)
+        tweet.timestamp += timedelta(days=1, minutes=1)
+        self.assertEquals("04:01", tweet.timestamp_str)
+        self.assertEquals("Sun 02 Jan", tweet.timestamp_date_str)
+
+    def test_pages_by_chapter(self):
+        filenames = self.stream.write_html_pages(
+            self.directory, CHAPTER, real_time=True)
+        self.assertEquals(
+            ["timeline.html", "timeline-001.html", "timeline-002.html"],
+            filenames)
+        index = self.read("timeline.html")
+        self.assertTrue(
+            '<a href="timeline-001.html">Chapter 1</a> (3 tweets)' in index)
+        self.assertTrue(
+            '<a href="timeline-002.html">Chapter 2</a> (1 tweets)' in index)
+        first, second = self.read(filenames[1]), self.read(filenames[2])
+        self.assertTrue("Third" in first)
+        self.assertFalse("Fourth" in first)
+        self.assertTrue('<a href="timeline-002.html">Next</a>' in first)
+        self.assertTrue("Fourth" in second)
+        self.assertTrue('<a href="timeline-001.html">Previous</a>' in second)
+        self.assertFalse("Next" in second)
+
+    def test_pages_by_week(self):
+        filenames = self.stream.write_html_pages(
+            self.directory, WEEK, real_time=True)
+        self.assertEquals(3, len(filenames))
+        index = self.read("timeline.html")
+        self.assertTrue("Week of 27 Dec 1999</a> (3 tweets)" in index)
+        self.assertTrue("Week of 10 Jan 2000</a> (1 tweets)" in index)
+        self.assertTrue("<h3>Sun 02 Jan</h3>" in self.read(filenames[1]))
+
+    def test_unknown_split(self):
+        self.assertRaises(
+            ValueError, self.stream.write_html_pages, self.directory, "year")
+
+
+class TestBuildCache(SycoraxTestCase):
+
+    SCRIPT = ["== Chapter 1", "10A First", "1H Second",
+              "== Chapter 2", "10A Third", "1H Fourth"]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "build_cache.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def build(self, script):
+        # Fuzz is turned up so that a recalculated timestamp is
+        # unlikely to match the cached one.
+        parser = SycoraxTestCase.make_parser(
+            self, dict(chapter_duration_days=timedelta(days=10)),
+            fuzz_minimum_seconds=3600)
+        cache = BuildCache(self.filename)
+        stream = Stream(script, parser, build_cache=cache)
+        cache.save()
+        return stream, cache
+
+    def test_unchanged_script_reuses_timestamps(self):
+        stream1, cache = self.build(self.SCRIPT)
+        self.assertEquals((0, 2), (cache.hits, cache.misses))
+        stream2, cache = self.build(self.SCRIPT)
+        self.assertEquals((2, 0), (cache.hits, cache.misses))
+        self.assertEquals(stream1.json, stream2.json)
+        self.assertEquals(stream1.html_page(real_time=True),
+                          stream2.html_page(real_time=True))
+
+    def test_changed_chapter_is_recalculated(self):
+        stream1, cache = self.build(self.SCRIPT)
+        script = list(self.SCRIPT)
+        script[-1] = "1H Fourth, revised"
+        stream2, cache = self.build(script)
+        self.assertEquals((1, 1), (cache.hits, cache.misses))
+        self.assertEquals(
+            [t.timestamp for t in stream1.chapters[0].all_tweets],
+            [t.timestamp for t in stream2.chapters[0].all_tweets])
+
+    def test_change_to_previous_chapter_invalidates_cache(self):
+        self.build(self.SCRIPT)
+        script = list(self.SCRIPT)
+        script[2] = "1H Second, revised"
+        stream, cache = self.build(script)
+        self.assertEquals((0, 2), (cache.hits, cache.misses))
+
+    def test_account_spacing_is_part_of_the_key(self):
+        digests = [
+            self.make_parser(dict(
+                    minimum_account_spacing_seconds=seconds)).config_digest
+            for seconds in (0, 60, 86400, 86460)]
+        self.assertEquals(4, len(set(digests)))
+
+class TestParseCache(SycoraxTestCase):
+
+    SCRIPT = ["== Chapter 1", "-- Day 1", "10A First", "+R1H Second",
+              "-- Day 2", "1D Third", "== Chapter 2", "R Fourth", "20M Fifth"]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.write_config()
+        self.write_script(self.SCRIPT)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_config(self, **kwargs):
+        config = dict(
+            start_date="2000/01/01", chapter_duration_days=10,
+            timezone=self.TIMEZONE, random_seed=1,
+            authors=[dict(account="author1"),
+                     dict(account="author2", code="+")])
+        config.update(kwargs)
+        out = open(os.path.join(self.directory, "config.json"), "w")
+        out.write(json.dumps(config))
+        out.close()
+
+    def write_script(self, script):
+        out = open(os.path.join(self.directory, "input.txt"), "w")
+        out.write("\n".join(script))
+        out.close()
+
+    def load(self):
+        cache = load_parse_cache(self.directory)
+        stream = load_stream(self.directory, parse_cache=cache)
+        return stream, cache
+
+    def test_unchanged_script_is_not_parsed_again(self):
+        stream1, cache = self.load()
+        self.assertEquals((0, 1), (cache.hits, cache.misses))
+        stream2, cache = self.load()
+        self.assertEquals((1, 0), (cache.hits, cache.misses))
+        self.assertEquals(stream1.json, stream2.json)
+        self.assertEquals(self.quietly(stream1.html_page, real_time=True),
+                          self.quietly(stream2.html_page, real_time=True))
+
+        tweets = list(stream2.tweets)
+        self.assertEquals(tweets[0], tweets[1].in_reply_to)
+        self.assertEquals(tweets[2], tweets[3].in_reply_to)
+        self.assertEquals("author2", tweets[1].author['account'])
+        self.assertEquals(tweets[-1], stream2.latest_tweet)
+        self.assertEquals(3, stream2.chapters[0].total_tweets)
+
+    def test_changed_script_or_config_is_parsed_again(self):
+        self.load()
+        self.write_script(self.SCRIPT + ["Sixth"])
+        stream, cache = self.load()
+        self.assertEquals((0, 1), (cache.hits, cache.misses))
+        self.assertEquals("Sixth", stream.latest_tweet.text)
+
+        self.write_config(timezone="UTC")
+        stream, cache = self.load()
+        self.assertEquals((0, 1), (cache.hits, cache.misses))
+        self.assertEquals(pytz.timezone("UTC"), stream.latest_tweet.timezone)
+
+    def test_posted_tweets_keep_their_timestamps(self):
+        stream, cache = self.load()
+        third = list(stream.tweets)[2]
+        posted_at = 946800000
+        log = ProgressLog(os.path.join(self.directory, "progress.json"))
+        log.append(dict(internal_id=third.digest, text=third.text,
+                        planned_timestamp=posted_at, twitter_id=1))
+        log.close()
+        stream, cache = self.load()
+        self.assertEquals((1, 0), (cache.hits, cache.misses))
+        self.assertEquals(posted_at, list(stream.tweets)[2].timestamp_for_json)
+
+    def test_unreadable_cache_is_a_miss(self):
+        stream1, cache = self.load()
+        contents = open(cache.filename).read()
+        out = open(cache.filename, "w")
+        out.write(contents[:len(contents) / 2])
+        out.close()
+        stream2, cache = self.quietly(self.load)
+        self.assertEquals((0, 1), (cache.hits, cache.misses))
+        self.assertEquals(stream1.json, stream2.json)
+
+
+class TestParallelParsing(SycoraxTestCase):
+
+    SCRIPT = ["First", "== Chapter 1", "Second", "+R10M Third", "-- Day 2",
+              "1D Fourth", "== Empty chapter", "== Chapter 3",
+              "+R Fifth", "10M Sixth"]
+
+    def parse(self, script, processes, **config):
+        config.setdefault('chapter_duration_days', timedelta(days=10))
+        parser = SycoraxTestCase.make_parser(
+            self, dict(config, random_seed=1), fuzz_minimum_seconds=60)
+        return Stream(script, parser, processes=processes)
+
+    def describe(self, stream):
+        return [(chapter.name, chapter.start_date,
+                 [(tweet.text, tweet.in_reply_to and tweet.in_reply_to.text)
+                  for tweet in chapter.all_tweets])
+                for chapter in stream.chapters]
+
+    def test_same_tweets_as_serial_parse(self):
+        serial = self.parse(self.SCRIPT, 1)
+        parallel = self.parse(self.SCRIPT, 2)
+        self.assertEquals(self.describe(serial), self.describe(parallel))
+        # The reply at the start of chapter 3 is to the last tweet of
+        # chapter 1.
+        fifth = parallel.chapters[3].first_tweet
+        self.assertEquals("Fourth", fifth.in_reply_to.text)
+        self.assertEquals("Sixth", parallel.latest_tweet.text)
+
+        # The same seed gives the same timestamps.
+        timestamps = [t.timestamp for t in parallel.tweets]
+        self.assertEquals(
+            timestamps, [t.timestamp for t in self.parse(self.SCRIPT, 2).tweets])
+        self.assertEquals(sorted(timestamps), timestamps)
+
+    def test_overlapping_chapters_are_refuzzed(self):
+        # Chapters only a day long, so each runs into the next.
+        script = ["== One", "10P First", "3H Second",
+                  "== Two", "12A Third", "+10M Fourth"]
+        instrument.start()
+        try:
+            stream = self.quietly(
+                self.parse, script, 2,
+                chapter_duration_days=timedelta(days=1))
+        finally:
+            profile = instrument.stop()
+        self.assertEquals(1, profile.counters['chapters_refuzzed'])
+        timestamps = [t.timestamp for t in stream.tweets]
+        self.assertEquals(sorted(timestamps), timestamps)
+        self.assertEquals(4, len(set(timestamps)))
+
+    def test_first_tweet_cannot_be_reply(self):
+        self.assertRaises(ValueError, self.parse, ["R Reply"], 2)
+
+
+class TestProgressLog(SycoraxTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "progress.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def entry(self, internal_id):
+        return dict(internal_id=internal_id, text="Tweet %s" % internal_id,
+                    planned_timestamp="01 Jan 2000 06:00:00 UTC",
+                    twitter_id=int(internal_id))
+
+    def test_append_and_get(self):
+        log = ProgressLog(self.filename)
+        self.assertEquals(None, log.get("1"))
+        log.append(self.entry("1"))
+        log.append(self.entry("2"))
+        self.assertEquals(self.entry("2"), log.get("2"))
+        self.assertTrue("1" in log)
+        self.assertFalse("3" in log)
+
+        # The log is still an ordinary JSONL file.
+        lines = open(self.filename).read().strip().split("\n")
+        self.assertEquals([self.entry("1"), self.entry("2")],
+                          [json.loads(line) for line in lines])
+
+        # A new ProgressLog finds the entries through the index.
+        log = ProgressLog(self.filename)
+        self.assertEquals(2, len(log))
+        self.assertEquals(self.entry("1"), log.get("1"))
+
+    def test_entries_appended_elsewhere_are_indexed(self):
+        ProgressLog(self.filename).append(self.entry("1"))
+        handle = open(self.filename, "a")
+        handle.write(json.dumps(self.entry("2")) + "\n")
+        handle.close()
+        log = ProgressLog(self.filename)
+        self.assertEquals(self.entry("2"), log.get("2"))
+
+    def test_two_logs_append_to_one_file(self):
+        # Say, a daemon and a cron job posting the same story.
+        a = ProgressLog(self.filename)
+        b = ProgressLog(self.filename)
+        a.append(self.entry("1"))
+        b.append(self.entry("2"))
+        a.append(self.entry("3"))
+        for log in (a, b):
+            for internal_id in ("1", "2", "3"):
+                self.assertEquals(self.entry(internal_id),
+                                  log.get(internal_id))
+
+    def test_two_processes_append_to_one_file(self):
+        def append(first):
+            log = ProgressLog(self.filename)
+            for i in range(first, first + 500):
+                log.append(self.entry(str(i)))
+            log.close()
+            os._exit(0)
+        ProgressLog(self.filename).close()
+        processes = [multiprocessing.Process(target=append, args=(first,))
+                     for first in (1000, 2000)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        # Every entry is indexed at its real position in the log. (Look
+        # at the index directly, since opening another ProgressLog
+        # might reindex the log.)
+        index = sqlite3.connect(self.filename + ".index")
+        offset = 0
+        for line in open(self.filename):
+            internal_id = json.loads(line)['internal_id']
+            self.assertEquals(offset, index.execute(
+                    "SELECT offset FROM entries WHERE internal_id=?",
+                    (internal_id,)).fetchone()[0])
+            offset += len(line)
+        self.assertEquals(1000, offset / len(line))
+        index.close()
+
+    def test_replaced_log_is_reindexed(self):
+        log = ProgressLog(self.filename)
+        log.append(self.entry("1"))
+        log.append(self.entry("2"))
+        open(self.filename, "w").write(
+            json.dumps(self.entry("3")) + "\n" +
+            json.dumps(self.entry("4")) + "\n")
+        log = ProgressLog(self.filename)
+        self.assertFalse("1" in log)
+        self.assertEquals(self.entry("4"), log.get("4"))
+
+    def test_incomplete_entry_is_removed(self):
+        log = ProgressLog(self.filename)
+        log.append(self.entry("1"))
+        log.close()
+        handle = open(self.filename, "a")
+        handle.write(json.dumps(self.entry("2"))[:20])
+        handle.close()
+
+        log = self.quietly(ProgressLog, self.filename)
+        self.assertEquals(1, len(log))
+        self.assertFalse("2" in log)
+        log.append(self.entry("3"))
+        log.commit()
+        self.assertEquals([self.entry("1"), self.entry("3")], list(log))
+
+    def test_entry_missing_its_newline_is_kept(self):
+        open(self.filename, "w").write(
+            json.dumps(self.entry("1")) + "\n" + json.dumps(self.entry("2")))
+        log = ProgressLog(self.filename)
+        log.append(self.entry("3"))
+        log.commit()
+        self.assertEquals([self.entry(x) for x in "123"], list(log))
+
+    def test_fsync_policies(self):
+        log = ProgressLog(self.filename, fsync_policy="always")
+        log.append(self.entry("1"))
+        self.assertEquals(1, log.synced)
+
+        log = ProgressLog(self.filename, fsync_policy="batch")
+        log.append(self.entry("2"))
+        log.append(self.entry("3"))
+        self.assertEquals(0, log.synced)
+        log.commit()
+        self.assertEquals(2, log.synced)
+
+        self.assertRaises(
+            ValueError, ProgressLog, self.filename, fsync_policy="sometimes")
+
+    def test_import_and_export(self):
+        log = ProgressLog(self.filename)
+        log.append(self.entry("1"))
+        jsonl = "\n".join(json.dumps(self.entry(x)) for x in "12")
+        log.import_jsonl(StringIO(jsonl))
+        self.assertEquals(2, len(log))
+        output = StringIO()
+        log.export_jsonl(output)
+        self.assertEquals(jsonl + "\n", output.getvalue())
+
+    def test_posted_tweet_keeps_its_timestamp(self):
+        log = ProgressLog(self.filename)
+        entry = self.entry("1")
+        entry['internal_id'] = Tweet(
+            "Second", None, None, self.TIMEZONE_O).digest
+        log.append(entry)
+        parser = TweetParser(self.CONFIG, progress=log)
+        stream = self.make_stream(parser, "First", "Second")
+        t1, t2 = stream.tweets
+        self.assertEquals(datetime(2000, 1, 1, 6, 0, 0, tzinfo=pytz.utc),
+                          t2.timestamp)
+
+    def test_load_progress_reads_the_whole_log(self):
+        contents = (json.dumps(self.entry("1")) + "\n"
+                    + json.dumps(self.entry("2"))[:20])
+        open(self.filename, "w").write(contents)
+        progress = load_progress(self.directory)
+        self.assertEquals(self.entry("1"), progress.get("1"))
+        self.assertFalse("2" in progress)
+        # Reading the log doesn't index it or repair it.
+        self.assertFalse(os.path.exists(self.filename + ".index"))
+        self.assertEquals(contents, open(self.filename).read())
+
+class RecordingStory(Story):
+    """A Story that records its posts instead of sending them to Twitter."""
+
+    def __init__(self, *args, **kwargs):
+        Story.__init__(self, *args, **kwargs)
+        self.posted = []
+
+    def post(self, tweet):
+        self.posted.append(tweet['text'])
+        self.save_progress(dict(
+            internal_id=tweet['internal_id'], text=tweet['text'],
+            planned_timestamp=tweet['timestamp'],
+            twitter_id=len(self.posted)))
+
+
+class EnactTestCase(SycoraxTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.progress_filename = os.path.join(self.directory, "progress.json")
+        # Don't let one test's posts count against another's rate limits.
+        ratelimit.limiters_by_consumer_key.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def record(self, text, timestamp, author="author1", in_reply_to=None):
+        return dict(internal_id=text, text=text, author=author,
+                    in_reply_to=in_reply_to, timestamp=to_epoch(timestamp))
+
+    def make_story(self, records, story_class=RecordingStory,
+                   progress_filename=None):
+        config = dict(authors=[
+                dict(account=author['account'], twitter_token="token",
+                     twitter_secret="secret") for author in self.AUTHORS])
+        script = StringIO("\n".join(json.dumps(x) for x in records))
+        return story_class(
+            config, script, progress_filename or self.progress_filename)
+
+    def sync(self, story):
+        self.quietly(story.sync)
+
+
+class TestScheduler(EnactTestCase):
+
+    def test_tweets_are_posted_when_due(self):
+        start = datetime(2000, 1, 1)
+        story = self.make_story(
+            [self.record("one", start + timedelta(minutes=1)),
+             self.record("two", start + timedelta(minutes=2)),
+             self.record("three", start + timedelta(minutes=3))])
+
+        now = [start]
+        slept = []
+        def sleep(seconds):
+            slept.append(seconds)
+            now[0] += timedelta(seconds=seconds)
+        scheduler = Scheduler(clock=lambda: now[0], sleep=sleep)
+        scheduler.add_story(story)
+
+        scheduler.post_due_tweets()
+        self.assertEquals([], story.posted)
+
+        # The scheduler sleeps until exactly the moment the first
+        # tweet is due.
+        scheduler.wait()
+        self.assertEquals([60], slept)
+        scheduler.post_due_tweets()
+        self.assertEquals(["one"], story.posted)
+
+        now[0] += timedelta(minutes=5)
+        scheduler.post_due_tweets()
+        self.assertEquals(["one", "two", "three"], story.posted)
+        self.assertEquals(None, scheduler.next_due)
+
+    def test_posted_tweets_are_not_scheduled(self):
+        start = datetime(2000, 1, 1)
+        records = [self.record("one", start), self.record("two", start)]
+        story = self.make_story(records)
+        story.post(records[0])
+
+        scheduler = Scheduler(clock=lambda: start)
+        scheduler.add_story(self.make_story(records))
+        self.assertEquals(1, len(scheduler.heap))
+
+    def test_tweets_posted_elsewhere_are_not_posted_again(self):
+        start = datetime(2000, 1, 1)
+        records = [self.record("one", start), self.record("two", start)]
+        story = self.make_story(records)
+        scheduler = Scheduler(clock=lambda: start)
+        scheduler.add_story(story)
+
+        # Another process posts the first tweet.
+        self.make_story(records).post(records[0])
+        scheduler.post_due_tweets()
+        self.assertEquals(["two"], story.posted)
+
+    def test_failing_story_does_not_stop_other_stories(self):
+        class FailingStory(RecordingStory):
+            def post(self, tweet):
+                raise Exception("Twitter is down.")
+
+        start = datetime(2000, 1, 1)
+        failing = self.make_story(
+            [self.record("one", start), self.record("two", start)],
+            FailingStory, os.path.join(self.directory, "failing.json"))
+        working = self.make_story(
+            [self.record("three", start)],
+            progress_filename=os.path.join(self.directory, "working.json"))
+
+        scheduler = Scheduler(clock=lambda: start, workers=2)
+        scheduler.add_story(failing)
+        scheduler.add_story(working)
+        self.quietly(scheduler.post_due_tweets)
+        self.assertEquals(["three"], working.posted)
+
+        # The failing story's tweets will be tried again later.
+        self.assertEquals(2, len(scheduler.heap))
+        self.assertTrue(scheduler.next_due > start)
+
+    def test_remove_story(self):
+        start = datetime(2000, 1, 1)
+        story1 = self.make_story(
+            [self.record("one", start)],
+            progress_filename=os.path.join(self.directory, "1.json"))
+        story2 = self.make_story(
+            [self.record("two", start)],
+            progress_filename=os.path.join(self.directory, "2.json"))
+        scheduler = Scheduler(clock=lambda: start)
+        scheduler.add_story(story1)
+        scheduler.add_story(story2)
+        scheduler.remove_story(story1)
+        self.assertEquals(["two"], [x[3]['text'] for x in scheduler.heap])
+
+class TestOrchestrator(EnactTestCase):
+
+    def make_script_directory(self, name, records=None):
+        directory = os.path.join(self.directory, name)
+        os.mkdir(directory)
+        config = dict(start_date="2000/01/01", chapter_duration_days=7,
+                      timezone="UTC", authors=[])
+        open(os.path.join(directory, "config.json"), "w").write(
+            json.dumps(config))
+        if records is not None:
+            open(os.path.join(directory, "timeline.json"), "w").write(
+                "\n".join(json.dumps(x) for x in records))
+        return directory
+
+    def test_find_script_directories(self):
+        story1 = self.make_script_directory("story1")
+        story2 = self.make_script_directory("story2")
+        os.mkdir(os.path.join(self.directory, "not-a-story"))
+        self.assertEquals(
+            [story1, story2],
+            find_script_directories([os.path.join(self.directory, "*"),
+                                     story1]))
+
+    def test_broken_story_does_not_stop_other_stories(self):
+        future = datetime.utcnow() + timedelta(days=1)
+        working = self.make_script_directory(
+            "working", [self.record("one", future)])
+        # This story has no timeline.json.
+        broken = self.make_script_directory("broken")
+
+        scheduler = Scheduler()
+        self.quietly(run_daemon, [broken, working], scheduler, forever=False)
+        [(post_at, sequence, story, tweet)] = scheduler.heap
+        self.assertEquals(working, story.name)
+        self.assertEquals("one", tweet['text'])
+
+class TestStorySync(EnactTestCase):
+
+    def write_timeline(self, records):
+        filename = os.path.join(self.directory, "timeline.json")
+        open(filename, "w").write("\n".join(json.dumps(x) for x in records))
+        return filename
+
+    def make_story(self, records, story_class=RecordingStory):
+        config = dict(authors=[])
+        return story_class(
+            config, open(self.write_timeline(records)),
+            self.progress_filename,
+            os.path.join(self.directory, "cursor.json"))
+
+    def test_sync_posts_due_tweets(self):
+        past = datetime.utcnow() - timedelta(days=1)
+        future = datetime.utcnow() + timedelta(days=1)
+        story = self.make_story(
+            [self.record("one", past), self.record("two", past),
+             self.record("three", future)])
+        self.sync(story)
+        self.assertEquals(["one", "two"], story.posted)
+        self.sync(story)
+        self.assertEquals(["one", "two"], story.posted)
+
+    def test_cursor_skips_posted_tweets(self):
+        past = datetime.utcnow() - timedelta(days=1)
+        future = datetime.utcnow() + timedelta(days=1)
+        records = [self.record("one", past), self.record("two", future)]
+        story = self.make_story(records)
+        self.sync(story)
+
+        # The cursor points at the first unposted tweet, so the next
+        # run starts reading there.
+        offset = story.load_cursor()
+        self.assertEquals(len(json.dumps(records[0])) + 1, offset)
+        self.assertEquals([records[1]],
+                          [tweet for o, tweet in story.records(offset)])
+        self.assertEquals([records[1]], list(story.unposted_tweets))
+
+    def test_sync_survives_transient_errors(self):
+        past = datetime.utcnow() - timedelta(days=1)
+        records = [self.record("one", past), self.record("two", past),
+                   self.record("three", past, author="author2")]
+        story = self.make_story(records, FlakyStory)
+        story.flaky = set(["two"])
+        self.sync(story)
+        self.assertEquals(["one", "three"], story.posted)
+        # The next run starts with the tweet that was deferred.
+        self.assertEquals([records[1]], list(story.unposted_tweets))
+
+    def test_old_timeline_can_be_read(self):
+        past = datetime.utcnow() - timedelta(days=1)
+        future = datetime.utcnow() + timedelta(days=1)
+        records = [self.record("one", past), self.record("two", future)]
+        for record in records:
+            record['timestamp'] = from_epoch(record['timestamp']).strftime(
+                "%d %b %Y %H:%M:%S %Z")
+        story = self.make_story(records)
+        self.sync(story)
+        self.assertEquals(["one"], story.posted)
+
+    def test_rebuilt_timeline_invalidates_cursor(self):
+        past = datetime.utcnow() - timedelta(days=1)
+        future = datetime.utcnow() + timedelta(days=1)
+        story = self.make_story(
+            [self.record("one", past), self.record("two", future)])
+        self.sync(story)
+        self.assertNotEquals(0, story.load_cursor())
+
+        # A tweet is added near the start of the timeline.
+        story = self.make_story(
+            [self.record("one", past), self.record("one and a half", past),
+             self.record("two", future)])
+        self.assertEquals(0, story.load_cursor())
+        self.sync(story)
+        self.assertEquals(["one and a half"], story.posted)
+
+    def test_sync_finds_next_due_tweet(self):
+        past = datetime.utcnow() - timedelta(days=1)
+        future = datetime.utcnow() + timedelta(days=1)
+        records = [self.record("one", past), self.record("two", past),
+                   self.record("three", future)]
+        story = self.make_story(records)
+        self.sync(story)
+        self.assertEquals(records[2]['timestamp'], story.next_due)
+
+        # Once every tweet has been posted, nothing is due.
+        os.remove(self.progress_filename)
+        story = self.make_story(records[:2])
+        self.sync(story)
+        self.assertEquals(None, story.next_due)
+
+        # A deferred tweet is due once the wait is over.
+        os.remove(self.progress_filename)
+        story = self.make_story(records, FlakyStory)
+        story.flaky = set(["two"])
+        before = to_epoch(datetime.utcnow())
+        self.sync(story)
+        delay = story.rate_limiter.backoffs['author1'].delay
+        self.assertTrue(story.next_due > before + delay - 2)
+        self.assertTrue(story.next_due < before + delay + 2)
+
+
+class TestNextDue(SycoraxTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.timeline_filename = os.path.join(self.directory, "timeline.json")
+        self.write_timeline("{}")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_timeline(self, contents):
+        out = open(self.timeline_filename, "w")
+        out.write(contents)
+        out.close()
+
+    def test_write_and_read(self):
+        self.assertEquals((False, None), next_due.read(self.directory))
+        next_due.write(self.directory, 1000)
+        self.assertEquals((True, 1000), next_due.read(self.directory))
+        next_due.write(self.directory, None)
+        self.assertEquals((True, None), next_due.read(self.directory))
+        next_due.remove(self.directory)
+        self.assertEquals((False, None), next_due.read(self.directory))
+
+    def test_rebuilt_timeline_is_not_known(self):
+        next_due.write(self.directory, 1000)
+        self.write_timeline("{}\n{}")
+        self.assertEquals((False, None), next_due.read(self.directory))
+
+    def test_unreadable_file_is_not_known(self):
+        out = open(os.path.join(self.directory, next_due.FILENAME), "w")
+        out.write("garbage")
+        out.close()
+        self.assertEquals((False, None), next_due.read(self.directory))
+
+class TestBinaryTimeline(EnactTestCase):
+
+    SCRIPT = ["== Chapter 1", "First", "+R10M Caf\xc3\xa9", "-- Day 2",
+              "-1D Third", "R1H Fourth"]
+
+    def write_timeline(self, records):
+        """Write records like the ones in timeline.json to timeline.bin."""
+        timezone = pytz.timezone("US/Central")
+        filename = os.path.join(self.directory, "timeline.bin")
+        writer = BinaryTimelineWriter(
+            open(filename, "wb"), [x['account'] for x in self.AUTHORS])
+        tweets_by_id = {}
+        for record in records:
+            author = [x for x in self.AUTHORS
+                      if x['account'] == record['author']][0]
+            tweet = Tweet(record['text'], author, None, timezone,
+                          in_reply_to=tweets_by_id.get(record['in_reply_to']))
+            tweet.timestamp = from_epoch(record['timestamp'])
+            tweets_by_id[record['internal_id']] = tweet
+            writer.add(tweet)
+            # Use the tweet's real internal ID from here on.
+            record['internal_id'] = tweet.digest
+            if record['in_reply_to'] is not None:
+                record['in_reply_to'] = tweet.in_reply_to.digest
+        writer.close()
+        writer.handle.close()
+        return BinaryTimeline(filename)
+
+    def test_same_records_as_timeline_json(self):
+        stream = Stream(self.SCRIPT, self.make_parser())
+        json_output = StringIO()
+        filename = os.path.join(self.directory, "timeline.bin")
+        writer = BinaryTimelineWriter(
+            open(filename, "wb"), [x['account'] for x in self.AUTHORS])
+        stream.write_json(json_output, writer)
+        writer.close()
+        writer.handle.close()
+
+        timeline = BinaryTimeline(filename)
+        expect = [json.loads(x) for x in json_output.getvalue().split("\n")
+                  if x != ""]
+        self.assertEquals(4, len(timeline))
+        self.assertEquals(
+            expect, [record for index, record in timeline.records()])
+        self.assertEquals(expect[2:], [x for i, x in timeline.records(2)])
+        timeline.close()
+
+    def test_scan_finds_due_records(self):
+        start = datetime(2000, 1, 1)
+        timeline = self.write_timeline(
+            [self.record("one", start), self.record("two", start),
+             self.record("three", start + timedelta(minutes=1))])
+        self.assertTrue(timeline.in_order)
+        self.assertEquals(2, timeline.bisect(946684800))
+        self.assertEquals(
+            [(1, True), (2, False)],
+            [(index, due) for index, record, due in timeline.scan(1, start)])
+
+        # Out of order, every record's timestamp has to be checked.
+        timeline = self.write_timeline(
+            [self.record("one", start + timedelta(minutes=1)),
+             self.record("two", start)])
+        self.assertFalse(timeline.in_order)
+        self.assertEquals(
+            [False, True],
+            [due for index, record, due in timeline.scan(0, start)])
+
+    def test_replies(self):
+        start = datetime(2000, 1, 1)
+        records = [self.record("one", start),
+                   self.record("two", start, in_reply_to="one")]
+        timeline = self.write_timeline(records)
+        self.assertEquals(records, [x for i, x in timeline.records()])
+
+    def test_sync(self):
+        past = datetime.utcnow() - timedelta(days=1)
+        future = datetime.utcnow() + timedelta(days=1)
+        timeline = self.write_timeline(
+            [self.record("one", past), self.record("two", past),
+             self.record("three", future)])
+        cursor_filename = os.path.join(self.directory, "cursor.json")
+        story = RecordingStory(
+            dict(authors=[]), timeline, self.progress_filename,
+            cursor_filename)
+        self.sync(story)
+        self.assertEquals(["one", "two"], story.posted)
+        self.assertEquals(2, story.load_cursor())
+        self.sync(story)
+        self.assertEquals(["one", "two"], story.posted)
+
+
+class TestClientPool(SycoraxTestCase):
+
+    def test_clients_are_reused(self):
+        pool = ClientPool(dict(alice=("token", "secret"),
+                               bob=("token2", "secret2")))
+        alice = pool.get("alice")
+        self.assertTrue(alice is pool.get("alice"))
+        self.assertFalse(alice is pool.get("bob"))
+        self.assertEquals((1, 2), (pool.hits, pool.misses))
+
+class TestConcurrentPoster(SycoraxTestCase):
+
+    def tweet(self, internal_id, author, in_reply_to=None):
+        return dict(internal_id=internal_id, author=author,
+                    in_reply_to=in_reply_to)
+
+    def test_different_accounts_post_in_parallel(self):
+        b_started = threading.Event()
+        posted = []
+        def post(tweet):
+            if tweet['internal_id'] == 'a1':
+                # This will only return True if b1 is posted while a1
+                # is still being posted.
+                posted.append(b_started.wait(5))
+            else:
+                b_started.set()
+        ConcurrentPoster(post, 2).run(
+            [self.tweet('a1', 'alice'), self.tweet('b1', 'bob')])
+        self.assertEquals([True], posted)
+
+    def test_replies_wait_for_parents(self):
+        lock = threading.Lock()
+        posted = []
+        def post(tweet):
+            with lock:
+                posted.append(tweet['internal_id'])
+        tweets = [self.tweet('a1', 'alice'),
+                  self.tweet('b1', 'bob', 'a1'),
+                  self.tweet('a2', 'alice', 'b1'),
+                  self.tweet('c1', 'carol'),
+                  self.tweet('a3', 'alice')]
+        ConcurrentPoster(post, 3).run(tweets)
+        self.assertEquals(sorted(posted), sorted(x['internal_id'] for x in tweets))
+        self.assertTrue(posted.index('a1') < posted.index('b1'))
+        self.assertTrue(posted.index('b1') < posted.index('a2'))
+        self.assertTrue(posted.index('a2') < posted.index('a3'))
+
+    def test_failure_stops_account_and_replies(self):
+        posted = []
+        def post(tweet):
+            if tweet['internal_id'] == 'a1':
+                raise ValueError("Twitter is down")
+            posted.append(tweet['internal_id'])
+        tweets = [self.tweet('a1', 'alice'),
+                  self.tweet('b1', 'bob', 'a1'),
+                  self.tweet('a2', 'alice'),
+                  self.tweet('c1', 'carol')]
+        self.assertRaises(ValueError, ConcurrentPoster(post, 2).run, tweets)
+        self.assertEquals(['c1'], posted)
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestRateLimiter(TestCase):
+
+    def test_token_bucket(self):
+        clock = FakeClock()
+        bucket = TokenBucket(0.5, 2, clock)
+        for i in range(2):
+            self.assertEquals(0, bucket.delay)
+            bucket.take()
+        self.assertEquals(2, bucket.delay)
+        clock.now += 1
+        self.assertEquals(1, bucket.delay)
+        # The bucket never holds more than its capacity.
+        clock.now += 100
+        self.assertEquals(2, bucket.state['tokens'])
+
+    def test_backoff_doubles_with_jitter(self):
+        backoff = Backoff(10, 100, FakeClock())
+        delays = [backoff.failed() for i in range(6)]
+        for delay, ceiling in zip(delays, [10, 20, 40, 80, 100, 100]):
+            self.assertTrue(ceiling / 2.0 <= delay <= ceiling)
+        self.assertAlmostEquals(delays[-1], backoff.delay)
+        backoff.succeeded()
+        self.assertEquals(0, backoff.delay)
+        self.assertEquals(0, backoff.failures)
+
+    def test_account_and_global_limits(self):
+        clock = FakeClock()
+        limiter = RateLimiter(tweets_per_hour=3600, burst=3,
+                              account_tweets_per_hour=360, account_burst=2,
+                              clock=clock)
+        self.assertEquals(0, limiter.acquire("alice"))
+        self.assertEquals(0, limiter.acquire("alice"))
+        # Alice has used up her burst.
+        self.assertEquals(10, limiter.acquire("alice"))
+        self.assertEquals(0, limiter.acquire("bob"))
+        # Now the application has used up its burst.
+        self.assertEquals(1, limiter.acquire("bob"))
+
+        state = limiter.state
+        self.assertEquals(0, state['tokens'])
+        self.assertEquals(0, state['accounts']['alice']['tokens'])
+        self.assertEquals(1, state['accounts']['bob']['tokens'])
+
+    def test_backoff_after_failure(self):
+        clock = FakeClock()
+        limiter = RateLimiter(clock=clock)
+        delay = limiter.failed("alice")
+        self.assertAlmostEquals(delay, limiter.acquire("alice"))
+        self.assertEquals(0, limiter.acquire("bob"))
+        clock.now += delay
+        self.assertEquals(0, limiter.acquire("alice"))
+        self.assertEquals(1, limiter.state['accounts']['alice']['failures'])
+
+    def test_dump_and_load(self):
+        clock = FakeClock()
+        kwargs = dict(tweets_per_hour=3600, burst=3,
+                      account_tweets_per_hour=360, account_burst=2,
+                      clock=clock)
+        limiter = RateLimiter(**kwargs)
+        limiter.acquire("alice")
+        limiter.acquire("alice")
+        delay = limiter.failed("bob")
+        saved = json.loads(json.dumps(limiter.dump()))
+
+        # Five seconds later, another process picks up the saved
+        # limits. The buckets have refilled a little since then.
+        clock.now += 5
+        limiter = RateLimiter(**kwargs)
+        limiter.load(saved)
+        state = limiter.state
+        self.assertAlmostEquals(3, state['tokens'])
+        self.assertAlmostEquals(0.5, state['accounts']['alice']['tokens'])
+        self.assertEquals(1, state['accounts']['bob']['failures'])
+        self.assertAlmostEquals(delay - 5, limiter.acquire("bob"))
+
+
+class FlakyStory(RecordingStory):
+    """A Story that can't reach Twitter for certain tweets."""
+
+    flaky = set()
+
+    def post(self, tweet):
+        if tweet['text'] in self.flaky:
+            raise socket.error("Connection reset by peer")
+        RecordingStory.post(self, tweet)
+
+
+class TestDeferral(EnactTestCase):
+
+    def test_transient_error_defers_account_and_replies(self):
+        start = datetime(2000, 1, 1)
+        story = self.make_story(
+            [self.record("one", start),
+             self.record("two", start, in_reply_to="one", author="author2"),
+             self.record("three", start),
+             self.record("four", start, author="author3")],
+            FlakyStory)
+        story.flaky = set(["one"])
+        deferred = self.quietly(story.post_tweets, story.script)
+        self.assertEquals(["four"], story.posted)
+        self.assertEquals(["one", "two", "three"],
+                          [tweet['text'] for tweet, delay in deferred])
+        self.assertEquals(1, story.rate_limiter.state[
+                'accounts']['author1']['failures'])
+
+    def test_concurrent_poster_defers(self):
+        start = datetime(2000, 1, 1)
+        story = self.make_story(
+            [self.record("one", start),
+             self.record("two", start, in_reply_to="one", author="author2"),
+             self.record("three", start),
+             self.record("four", start, author="author3")],
+            FlakyStory)
+        story.flaky = set(["one"])
+        story.posting_threads = 3
+        deferred = self.quietly(story.post_tweets, story.script)
+        self.assertEquals(["four"], story.posted)
+        self.assertEquals(["one", "three", "two"],
+                          sorted(tweet['text'] for tweet, delay in deferred))
+
+    def test_rate_limit_defers_tweets(self):
+        start = datetime(2000, 1, 1)
+        story = self.make_story(
+            [self.record(str(i), start) for i in range(5)])
+        story.rate_limiter = RateLimiter(account_burst=3)
+        deferred = self.quietly(story.post_tweets, story.script)
+        self.assertEquals(["0", "1", "2"], story.posted)
+        self.assertEquals(["3", "4"],
+                          [tweet['text'] for tweet, delay in deferred])
+
+    def test_scheduler_requeues_deferred_tweets(self):
+        start = datetime(2000, 1, 1)
+        story = self.make_story(
+            [self.record("one", start), self.record("two", start)],
+            FlakyStory)
+        story.flaky = set(["one"])
+        scheduler = Scheduler(clock=lambda: start)
+        scheduler.add_story(story)
+        self.quietly(scheduler.post_due_tweets)
+        self.assertEquals([], story.posted)
+        self.assertEquals(2, len(scheduler.heap))
+        self.assertTrue(scheduler.next_due > start)
+
+    def test_rate_limits_carry_over_between_runs(self):
+        start = datetime(2000, 1, 1)
+        records = [self.record("one", start)]
+        rate_limit_filename = os.path.join(self.directory, "ratelimit.json")
+        story = self.make_story(records, FlakyStory)
+        story.rate_limit_filename = rate_limit_filename
+        story.flaky = set(["one"])
+        self.quietly(story.post_tweets, records)
+
+        # The next run starts out backing off, just as the last run
+        # left it.
+        ratelimit.limiters_by_consumer_key.clear()
+        config = dict(authors=[])
+        story = Story(config, StringIO(), self.progress_filename,
+                      rate_limit_filename=rate_limit_filename)
+        self.assertEquals(1, story.rate_limiter.state[
+                'accounts']['author1']['failures'])
+        self.assertTrue(story.rate_limiter.acquire("author1") > 0)
+
+    def test_deferred_story_is_held_back(self):
+        start = datetime(2000, 1, 1)
+        story = self.make_story(
+            [self.record("one", start),
+             self.record("two", start + timedelta(seconds=5))],
+            FlakyStory)
+        story.flaky = set(["one"])
+        now = [start]
+        scheduler = Scheduler(clock=lambda: now[0])
+        scheduler.add_story(story)
+        self.quietly(scheduler.post_due_tweets)
+        retry_at = scheduler.held_until[story]
+        self.assertTrue(retry_at > start + timedelta(seconds=5))
+
+        # "two" is due, but it waits for "one".
+        now[0] = start + timedelta(seconds=5)
+        scheduler.post_due_tweets()
+        self.assertEquals([], story.posted)
+        self.assertEquals([(retry_at, "one"), (retry_at, "two")],
+                          [(x[0], x[3]['text']) for x in sorted(scheduler.heap)])
+
+        now[0] = retry_at
+        story.flaky = set()
+        story.rate_limiter.succeeded("author1")
+        self.quietly(scheduler.post_due_tweets)
+        self.assertEquals(["one", "two"], story.posted)
+        self.assertEquals({}, scheduler.held_until)
+
+class TestPostingToTwitter(EnactTestCase):
+    """Test Story against a fake Twitter server."""
+
+    def setUp(self):
+        super(TestPostingToTwitter, self).setUp()
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stop()
+        super(TestPostingToTwitter, self).tearDown()
+
+    def make_story(self, records, **server_options):
+        self.server = FakeTwitter(seed=0, **server_options).start()
+        config = dict(
+            twitter_domain=self.server.domain, twitter_secure=False,
+            authors=[dict(account=author['account'], twitter_token="token",
+                          twitter_secret="secret")
+                     for author in self.AUTHORS])
+        script = StringIO("\n".join(json.dumps(x) for x in records))
+        return Story(config, script, self.progress_filename)
+
+    def test_sync_posts_replies(self):
+        past = datetime.utcnow() - timedelta(days=1)
+        story = self.make_story(
+            [self.record("one", past),
+             self.record("two", past, in_reply_to="one", author="author2")])
+        self.sync(story)
+        one, two = self.server.statuses
+        self.assertEquals("one", one['text'])
+        self.assertEquals(None, one['in_reply_to_status_id'])
+        self.assertEquals(one['id'], two['in_reply_to_status_id'])
+        self.assertEquals(two['id'], story.progress.get("two")['twitter_id'])
+        entry = story.progress.get("one")
+        self.assertEquals(to_epoch(past), entry['planned_timestamp'])
+        self.assertTrue(entry['actual_timestamp'] > entry['planned_timestamp'])
+
+    def test_duplicate_counts_as_posted(self):
+        past = datetime.utcnow() - timedelta(days=1)
+        story = self.make_story(
+            [self.record("one", past),
+             self.record("two", past, in_reply_to="one")],
+            duplicate_rate=1)
+        self.sync(story)
+        self.assertEquals([], self.server.statuses)
+        self.assertEquals(2, self.server.duplicates)
+        self.assertEquals(["[duplicate]", "[duplicate]"],
+                          [x['twitter_id'] for x in story.progress])
+
+    def test_rate_limited_tweet_is_deferred(self):
+        past = datetime.utcnow() - timedelta(days=1)
+        story = self.make_story([self.record("one", past)],
+                                rate_limit_rate=1)
+        self.sync(story)
+        self.assertEquals(1, self.server.rate_limited)
+        self.assertEquals(0, len(story.progress))
+        self.assertEquals(1, story.rate_limiter.state[
+                'accounts']['author1']['failures'])
+
+    def test_update_limit_defers_tweet(self):
+        # Twitter sends a 403 when an account is over its daily limit.
+        past = datetime.utcnow() - timedelta(days=1)
+        story = self.make_story([self.record("one", past)],
+                                update_limit_rate=1)
+        self.sync(story)
+        self.assertEquals(1, self.server.rate_limited)
+        self.assertEquals(0, len(story.progress))
+        self.assertEquals(1, story.rate_limiter.state[
+                'accounts']['author1']['failures'])
+
+class TestBenchmark(TestCase):
+
+    def test_synthetic_story(self):
+        directory = tempfile.mkdtemp()
+        try:
+            write_story(directory, 100, chapters=3, authors=4)
+            stream = load_stream(directory)
+            self.assertEquals(100, len(list(stream.tweets)))
+            self.assertEquals(3, len(stream.chapters))
+            self.assertEquals(
+                4, len(set(tweet.author['account']
+                           for tweet in stream.tweets)))
+            self.assertEquals(sorted(PHASES),
+                              sorted(time_phases(directory).keys()))
+        finally:
+            shutil.rmtree(directory)
+
+class TestInstrument(TestCase):
+
+    def tearDown(self):
+        instrument.stop()
+
+    def test_nothing_is_recorded_by_default(self):
+        with instrument.phase("phase"):
+            instrument.count("things")
+        self.assertEquals(None, instrument.profile)
+
+    def test_phases_and_counts(self):
+        profile = instrument.start()
+
+        @instrument.timed("outer")
+        def outer():
+            for i in range(2):
+                with instrument.phase("inner"):
+                    instrument.count("things", 2)
+        outer()
+
+        report = profile.report
+        self.assertEquals(1, report['phases']['outer']['calls'])
+        self.assertEquals(2, report['phases']['inner']['calls'])
+        self.assertTrue(report['phases']['outer']['wall']
+                        >= report['phases']['inner']['wall'])
+        self.assertEquals(dict(things=4), report['counters'])
+
+    def test_stream_phases(self):
+        profile = instrument.start()
+        config = dict(start_date=datetime(2000, 1, 1), timezone="UTC",
+                      chapter_duration_days=timedelta(days=7),
+                      authors=[dict(account="author1")])
+        stream = Stream(["1A One", "1H Two"], config=config)
+        stream.json
+        report = instrument.stop()
+        self.assertEquals(2, report.counters['tweets_parsed'])
+        for phase in ("parse", "add_fuzz", "chapter_start_sanity_check",
+                      "json"):
+            self.assertEquals(1, report.phases[phase]['calls'])
+
 class TestTimecodeAssignment(SycoraxTestCase):
 
     def tweet_for(self, text=None, author=None, base_timecode=None,
@@ -217,8 +1617,60 @@ class TestTimecodeAssignment(SycoraxTestCase):
         # This test will fail one time in 60, but we need to test that
         # *some* fuzz is being applied.
         self.assertTrue(t1.timestamp != self.START_DATE)
-        difference = abs((t1.timestamp - self.START_DATE).seconds)
-        self.assertTrue(difference < 60)
+        difference = abs((t1.timestamp - self.START_DATE).total_seconds())
+        self.assertTrue(difference <= 60)
+
+    def test_random_seed_makes_fuzz_repeatable(self):
+        def timestamps():
+            parser = self.make_parser(
+                dict(random_seed=5), fuzz_minimum_seconds=600)
+            stream = self.make_stream(
+                parser, "First", "10M Second", "3P Third")
+            return [t.timestamp for t in stream.tweets]
+        self.assertEquals(timestamps(), timestamps())
+
+    def test_fuzz_window_is_clipped_to_after_previous_tweet(self):
+        # Most of the fuzz window for the second tweet comes before
+        # the first tweet, but the second tweet always comes out
+        # after it.
+        parser = self.make_parser(fuzz_minimum_seconds=600)
+        for i in range(50):
+            stream = self.make_stream(parser, "First", "1M Second")
+            t1, t2 = stream.tweets
+            self.assertTrue(t2.timestamp > t1.timestamp)
+
+    def test_impossible_fuzz_window(self):
+        # Every timestamp in the second tweet's window comes before the
+        # previous tweet, so it goes out right after the previous tweet.
+        previous = self.tweet_for(
+            base_timecode=self.START_DATE + timedelta(hours=2),
+            delay=timedelta(minutes=0))
+        tweet = self.make_tweet(delay=timedelta(minutes=1))
+        timestamp = tweet.calculate_timestamp(0, 0, previous)
+        self.assertEquals(previous.timestamp + timedelta(seconds=1), timestamp)
+
+    def test_not_before(self):
+        tweet = self.make_tweet(delay=timedelta(minutes=1))
+        not_before = self.START_DATE + timedelta(minutes=30)
+        timestamp = tweet.calculate_timestamp(0, 0, None, not_before=not_before)
+        self.assertEquals(not_before, timestamp)
+
+    def test_minimum_account_spacing(self):
+        parser = self.make_parser(
+            dict(minimum_account_spacing_seconds=600))
+        stream = self.make_stream(
+            parser, "First", "1M Second", "+1M Third", "1M Fourth")
+        t1, t2, t3, t4 = stream.tweets
+
+        # The second tweet has to wait ten minutes after the first.
+        self.assertEquals(t2.timestamp - t1.timestamp, timedelta(minutes=10))
+
+        # The third tweet is from a different account, so it doesn't
+        # have to wait.
+        self.assertEquals(t3.timestamp - t2.timestamp, timedelta(minutes=1))
+
+        # The fourth tweet has to wait for the second.
+        self.assertEquals(t4.timestamp - t2.timestamp, timedelta(minutes=10))
 
     def test_fuzz_on_hour_of_day(self):
         # A tweet that takes place in the ten o'clock hour will
@@ -1,12 +1,23 @@
 """Parse a Sycorax script into an annotated multi-author timeline."""
 
+import calendar
 from datetime import datetime, timedelta
+import gc
 import json
+import marshal
+import math
+import multiprocessing
 import random
 import re
 import hashlib
+from json.encoder import encode_basestring_ascii as encode_json_string
 import os
 import pytz
+from StringIO import StringIO
+
+from html_timeline import HTMLTimeline
+import instrument
+from progress import ProgressLog
 
 # 10M: ~10 minutes later
 # 4H: ~4 hours later
@@ -16,13 +27,86 @@ import pytz
 # 9P: 9PM on the current day
 
 DEFAULT_DELAY = timedelta(hours=4)
+ONE_SECOND = timedelta(seconds=1)
 REPLY_TO_CODE = "R"
 DELAY_CODE = re.compile("([0-9]+)([MHD])")
 DELAY_UNITS = dict(M="minutes", H="hours", D="days")
 TIME_OF_DAY_CODE = re.compile("([0-9]{1,2})([AP])")
 
+# Timestamps are written as whole seconds since the epoch. Files
+# written by older versions have strings in this format instead.
 JSON_TIME_FORMAT = "%d %b %Y %H:%M:%S %Z"
 
+UTC = pytz.utc
+EPOCH = datetime(1970, 1, 1)
+UTC_EPOCH = UTC.localize(EPOCH)
+MONTH_ABBREVIATIONS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun",
+                       "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+MONTH_NUMBERS = dict(
+    (month, i + 1) for i, month in enumerate(MONTH_ABBREVIATIONS))
+
+def json_record_template():
+    """A timeline.json record with the values left out.
+
+    A record can be encoded by filling in the template, instead of with
+    json.dumps(). The template is made with json.dumps(), from the same
+    dict a record used to be made from, so the keys come out in the
+    same order.
+    """
+    template = json.dumps(dict(
+            internal_id="@internal_id@", text="@text@", author="@author@",
+            in_reply_to="@in_reply_to@", timestamp="@timestamp@"))
+    for field in ("internal_id", "text", "author", "in_reply_to",
+                  "timestamp"):
+        template = template.replace('"@%s@"' % field, "%%(%s)s" % field)
+    return template
+
+JSON_RECORD_TEMPLATE = json_record_template()
+
+# How many records Stream.write_json() writes at a time.
+JSON_CHUNK_SIZE = 1000
+
+# When chapters are parsed in separate processes, a reply at the start
+# of a chapter is a reply to this, until the chapters are stitched
+# together and it can be replaced with the previous chapter's last
+# tweet.
+PREVIOUS_CHAPTER = "[the last tweet of the previous chapter]"
+
+def to_epoch(timestamp):
+    """Convert a datetime to whole seconds since the epoch.
+
+    A datetime with no timezone is taken to be UTC.
+    """
+    offset = timestamp.utcoffset()
+    if offset is not None:
+        timestamp = timestamp.replace(tzinfo=None) - offset
+    delta = timestamp - EPOCH
+    return delta.days * 86400 + delta.seconds
+
+def from_epoch(epoch):
+    """Convert seconds since the epoch to a UTC datetime."""
+    return UTC_EPOCH + timedelta(seconds=epoch)
+
+def parse_timestamp(timestamp):
+    """Find the seconds since the epoch for a timestamp read from
+    timeline.json, progress.json or the build cache.
+
+    Older versions wrote timestamps in JSON_TIME_FORMAT. Those are
+    taken apart by hand rather than with strptime(), which is slow and
+    depends on the locale.
+    """
+    if not isinstance(timestamp, basestring):
+        return timestamp
+    try:
+        day, month, year, time, zone = timestamp.split()
+        hour, minute, second = time.split(":")
+        if zone != "UTC":
+            raise ValueError()
+        return calendar.timegm((int(year), MONTH_NUMBERS[month], int(day),
+                                int(hour), int(minute), int(second)))
+    except (KeyError, ValueError):
+        raise ValueError('Unrecognized timestamp: "%s"' % timestamp)
+
 def load_config(directory):
     filename = os.path.join(directory, "config.json")
     if not os.path.exists(filename):
@@ -36,50 +120,431 @@ def load_config(directory):
         days=data['chapter_duration_days'])
     return data
 
-def load_stream(directory):
-    config = load_config(directory)
+@instrument.timed("load_stream")
+def load_stream(directory, stream_class=None, build_cache=None, processes=1,
+                parse_cache=None):
+    stream_class = stream_class or Stream
+    with instrument.phase("load_config"):
+        config = load_config(directory)
     filename = os.path.join(directory, "input.txt")
     if not os.path.exists(filename):
         raise Exception("Could not find input.txt file in directory %s" % (
                 directory
                 ))
 
-    progress = load_progress(directory)
     try:
-        progress = load_progress(directory)
+        with instrument.phase("load_progress"):
+            progress = load_progress(directory)
     except Exception, e:
         # Nothing has been posted yet.
         progress = None
 
-    return Stream(open(filename), config=config, progress=progress)
+    return stream_class(open(filename), config=config, progress=progress,
+                        build_cache=build_cache, processes=processes,
+                        parse_cache=parse_cache)
 
 
 def load_progress(directory):
-    config = load_config(directory)
     filename = os.path.join(directory, "progress.json")
     if not os.path.exists(filename):
         raise Exception("Could not find progress.json file in directory %s" % (
                 directory
                 ))
+    # Every tweet in the script gets looked up, so it's quicker to read
+    # the whole log at once than to go through its index.
     return Progress(open(filename))
 
 
+def load_build_cache(directory):
+    return BuildCache(os.path.join(directory, "build_cache.json"))
+
+
+def load_parse_cache(directory):
+    return ParseCache(os.path.join(directory, "parse_cache.marshal"),
+                      os.path.join(directory, "input.txt"),
+                      os.path.join(directory, "config.json"))
+
+
+def without_gc(function, *args):
+    """Call a function with the garbage collector turned off.
+
+    Loading a whole script from the parse cache makes hundreds of
+    thousands of objects, none of them garbage, and the collector would
+    otherwise look through all of them again and again.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return function(*args)
+    finally:
+        if enabled:
+            gc.enable()
+
+def file_digest(filename):
+    digest = hashlib.md5()
+    input_file = open(filename, "rb")
+    for chunk in iter(lambda: input_file.read(1024 * 1024), ""):
+        digest.update(chunk)
+    input_file.close()
+    return digest.hexdigest()
+
+def code_version():
+    """A hash of the parser's source code.
+
+    A parse cache is laid out the way ParseCache.flatten() and
+    unflatten() expect, so one written by a different version of this
+    module can't be trusted.
+    """
+    return file_digest(os.path.splitext(__file__)[0] + ".py")
+
+
 class TimezoneAware(object):
 
+    __slots__ = ()
+
     def start_of_day(self, datetime):
         return datetime.replace(
             hour=0, minute=0, second=0, tzinfo=self.timezone)
 
 
 class Progress(object):
-    """The progress made in posting a stream."""
+    """The progress made in posting a stream, read into memory from
+    a JSONL file.
+
+    enact.py uses a ProgressLog instead, which doesn't have to read the
+    whole file. Both can be used as a TweetParser's progress.
+    """
 
     def __init__(self, input_stream):
-        self.timeline = [json.loads(line.strip()) for line in input_stream]
         self.posts = {}
-        for post in self.timeline:
+        for line in input_stream:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            try:
+                post = json.loads(line)
+            except ValueError:
+                # A half-written entry at the end of the log. The next
+                # ProgressLog to open the log will clean it up.
+                continue
             self.posts[post['internal_id']] = post
 
+    def get(self, internal_id, default=None):
+        return self.posts.get(internal_id, default)
+
+    def __contains__(self, internal_id):
+        return internal_id in self.posts
+
+class BuildCache(object):
+    """The timestamps given to each chapter's tweets in earlier builds.
+
+    A chapter is keyed by a hash of its text, the parts of the
+    configuration that affect timestamps, and the last tweet of the
+    chapter before it. If none of those have changed since the last
+    build, the chapter's tweets get the same timestamps as last time,
+    instead of being fuzzed all over again.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        if os.path.exists(filename):
+            self.chapters = json.loads(open(filename).read())['chapters']
+        else:
+            self.chapters = {}
+        # Only chapters seen in this build are saved, so entries for
+        # old versions of a chapter don't pile up.
+        self.used_chapters = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, tweet_parser, chapter, previous_tweet):
+        key = hashlib.md5(tweet_parser.config_digest)
+        key.update(chapter.source_digest)
+        key.update(chapter.start_date.isoformat())
+        if previous_tweet is not None:
+            key.update(previous_tweet.digest)
+            key.update(str(previous_tweet.timestamp_for_json))
+        return key.hexdigest()
+
+    def get(self, key, chapter):
+        """Find the timestamps for a chapter's tweets, if they're cached.
+
+        :return: A list of timestamps, as they were written to
+            timeline.json, or None.
+        """
+        cached = self.chapters.get(key)
+        if cached is not None:
+            digests = [digest for digest, timestamp in cached]
+            if digests != [tweet.digest for tweet in chapter.all_tweets]:
+                cached = None
+        if cached is None:
+            self.misses += 1
+            instrument.count("build_cache_misses")
+            return None
+        self.hits += 1
+        instrument.count("build_cache_hits")
+        self.used_chapters[key] = cached
+        return [timestamp for digest, timestamp in cached]
+
+    def local_timestamp(self, timestamp, timezone):
+        """Turn a cached timestamp back into the kind of datetime the
+        parser would have calculated: one whose tzinfo is the script's
+        timezone.
+        """
+        utc = EPOCH + timedelta(seconds=parse_timestamp(timestamp))
+        local = utc.replace(tzinfo=timezone)
+        return local + local.utcoffset()
+
+    def put(self, key, chapter):
+        self.used_chapters[key] = [
+            [tweet.digest, tweet.timestamp_for_json]
+            for tweet in chapter.all_tweets]
+
+    def save(self):
+        out = open(self.filename, "w")
+        out.write(json.dumps(dict(chapters=self.used_chapters)))
+        out.close()
+
+
+def trie_pattern(codes):
+    """A regular expression that matches the longest of the given
+    codes that starts at a given position.
+
+    The codes are arranged in a trie, so matching takes time
+    proportional to the length of the code matched, however many codes
+    there are.
+    """
+    trie = {}
+    for code in codes:
+        node = trie
+        for char in code:
+            node = node.setdefault(char, {})
+        node[None] = True
+
+    def pattern(node):
+        branches = [re.escape(char) + pattern(child)
+                    for char, child in sorted(node.items())
+                    if char is not None]
+        if len(branches) == 0:
+            return ""
+        if len(branches) == 1 and None not in node:
+            return branches[0]
+        group = "(?:%s)" % "|".join(branches)
+        if None in node:
+            # A longer code is tried before settling for this one.
+            group += "?"
+        return group
+
+    if len(trie) == 0:
+        return None
+    return re.compile(pattern(trie))
+
+
+class CommandLexer(object):
+    """Splits the first word of a line of script into commands.
+
+    A command word is made of an author code, the reply code, a delay
+    and a time of day, each of which may appear at most once. The
+    author code and the reply code can go anywhere in the word, but a
+    delay has to come before a time of day.
+
+    At each position in the word, the longest code that matches wins,
+    and an author code wins a tie.
+    """
+
+    SYNTAX = re.compile("(?P<delay>%s)|(?P<time>%s)|(?P<reply>%s)" % (
+            DELAY_CODE.pattern, TIME_OF_DAY_CODE.pattern,
+            re.escape(REPLY_TO_CODE)))
+
+    def __init__(self, author_codes):
+        self.authors = trie_pattern(
+            [code for code in author_codes if code != ""])
+
+    def lex(self, command):
+        """Tokenize a command word.
+
+        :return: None if the word isn't made entirely of commands.
+            Otherwise, a 4-tuple (author code, whether it's a reply,
+            delay code, time of day code), with None for any command
+            that isn't there.
+        """
+        author = delay = time_of_day = None
+        is_reply = False
+        position = 0
+        end = len(command)
+        while position < end:
+            author_match = None
+            if self.authors is not None:
+                author_match = self.authors.match(command, position)
+            match = self.SYNTAX.match(command, position)
+            if author_match is not None and (
+                match is None or author_match.end() >= match.end()):
+                if author is not None:
+                    return None
+                author = author_match.group()
+                position = author_match.end()
+                continue
+            if match is None:
+                return None
+            token = match.lastgroup
+            if token == "reply":
+                if is_reply:
+                    return None
+                is_reply = True
+            elif token == "delay":
+                if delay is not None or time_of_day is not None:
+                    return None
+                delay = match.group()
+            else:
+                if time_of_day is not None:
+                    return None
+                time_of_day = match.group()
+            position = match.end()
+        return author, is_reply, delay, time_of_day
+
+
+class ParseCache(object):
+    """The parsed script from the last build, before any timestamps
+    were calculated.
+
+    It's keyed by hashes of input.txt, config.json and the parser's
+    code. If none of those have changed since the last build, the
+    script doesn't have to be parsed again. Otherwise the cache is
+    ignored, and replaced once the script has been parsed.
+
+    The chapters, days and tweets are stored as flat tuples of
+    strings and numbers, with marshal, which is many times faster than
+    pickling the objects themselves.
+    """
+
+    def __init__(self, filename, script_filename, config_filename):
+        self.filename = filename
+        self.key = hashlib.md5(" ".join([
+                    code_version(), str(marshal.version),
+                    file_digest(script_filename),
+                    file_digest(config_filename)])).hexdigest()
+        self.hits = 0
+        self.misses = 0
+
+    @instrument.timed("load_parse_cache")
+    def load(self, tweet_parser):
+        """Load the parsed script, if it's cached.
+
+        :return: A list of Chapters, or None.
+        """
+        chapters = None
+        if os.path.exists(self.filename):
+            input_file = open(self.filename, "rb")
+            try:
+                if input_file.readline().strip() == self.key:
+                    chapters = without_gc(
+                        self.unflatten, tweet_parser, *marshal.load(input_file))
+            except Exception, e:
+                print "[WARNING] Couldn't read %s: %s" % (self.filename, e)
+            input_file.close()
+        if chapters is None:
+            self.misses += 1
+            instrument.count("parse_cache_misses")
+        else:
+            self.hits += 1
+            instrument.count("parse_cache_hits")
+        return chapters
+
+    @instrument.timed("save_parse_cache")
+    def save(self, tweet_parser, chapters):
+        temporary_filename = self.filename + ".tmp"
+        out = open(temporary_filename, "wb")
+        out.write(self.key + "\n")
+        marshal.dump(self.flatten(tweet_parser, chapters), out)
+        out.close()
+        os.rename(temporary_filename, self.filename)
+
+    def flatten(self, tweet_parser, chapters):
+        """Turn parsed chapters into a 2-tuple (chapter records, tweet
+        records) that marshal can handle.
+
+        Authors and the tweets being replied to become indexes, and
+        datetimes become tuples. Timestamps are left out, since they
+        haven't been calculated yet.
+        """
+        authors = dict((id(author), i)
+                       for i, author in enumerate(tweet_parser.authors))
+        indexes = {}
+        chapter_records = []
+        tweet_records = []
+        for chapter in chapters:
+            days = []
+            for day in chapter.days:
+                days.append((day.date, len(day.tweets)))
+                for tweet in day.tweets:
+                    indexes[id(tweet)] = len(tweet_records)
+                    delay = None
+                    if tweet.delay is not None:
+                        delay = (tweet.delay.days, tweet.delay.seconds)
+                    tweet_records.append((
+                            tweet.text, authors[id(tweet.author)],
+                            indexes.get(id(tweet.in_reply_to), -1),
+                            tweet.digest, delay, tweet.hour_of_day,
+                            datetime_tuple(tweet.base_timecode)))
+            chapter_records.append((
+                    chapter.name, datetime_tuple(chapter.start_date),
+                    chapter.source_digest, days))
+        return chapter_records, tweet_records
+
+    def unflatten(self, tweet_parser, chapter_records, tweet_records):
+        """Turn the output of flatten() back into Chapters."""
+        authors = tweet_parser.authors
+        timezone = tweet_parser.timezone
+        # Tweets share timedelta objects, the way the parser makes them.
+        delays = {}
+        tweets = []
+        for (text, author, reply, digest, delay, hour_of_day,
+             base_timecode) in tweet_records:
+            if delay is not None:
+                if delay not in delays:
+                    delays[delay] = timedelta(*delay)
+                delay = delays[delay]
+            in_reply_to = None
+            if reply >= 0:
+                in_reply_to = tweets[reply]
+            tweet = Tweet.__new__(Tweet)
+            tweet.__setstate__((
+                    text, authors[author], timezone, in_reply_to, digest,
+                    delay, hour_of_day,
+                    tuple_datetime(base_timecode, timezone), None))
+            tweets.append(tweet)
+
+        chapters = []
+        position = 0
+        for name, start_date, source_digest, days in chapter_records:
+            chapter = Chapter(name, tuple_datetime(start_date, timezone))
+            chapter.source = source_digest
+            for date, count in days:
+                day = Day(date)
+                chapter.days.append(day)
+                for tweet in tweets[position:position + count]:
+                    chapter.add_tweet(day, tweet)
+                position += count
+            chapters.append(chapter)
+        return chapters
+
+def datetime_tuple(value):
+    """Turn a datetime into a tuple that marshal can handle.
+
+    Every datetime in a parsed script is in the script's timezone, so
+    the timezone isn't stored.
+    """
+    if value is None:
+        return None
+    return (value.year, value.month, value.day, value.hour, value.minute,
+            value.second, value.microsecond)
+
+def tuple_datetime(value, timezone):
+    if value is None:
+        return None
+    return datetime(*value, tzinfo=timezone)
+
+
 class TweetParser(TimezoneAware):
 
     """Parses a line of script into a tweet."""
@@ -97,10 +562,19 @@ class TweetParser(TimezoneAware):
         fuzz = float(config.get('fuzz', fuzz_quotient))
         self.fuzz_quotient = fuzz
         self.fuzz_minimum_seconds = int(config.get('fuzz_minimum_seconds', fuzz_minimum_seconds))
+        # The minimum time between two tweets from the same account.
+        self.account_spacing = timedelta(seconds=int(
+            config.get('minimum_account_spacing_seconds', 0)))
         self.start_date=config['start_date']
         self.config = config
         self.progress = progress
 
+        # All the fuzz for a stream comes from this generator. Set
+        # random_seed in the configuration to get the same timestamps
+        # every time.
+        self.random = random.Random(config.get('random_seed'))
+
+        self.delays = {}
         self.default_author = None
         self.authors_by_code = {}
         for author in self.authors:
@@ -108,6 +582,18 @@ class TweetParser(TimezoneAware):
             if code == '':
                 self.default_author = author
             self.authors_by_code[code] = author
+        self.lexer = CommandLexer(self.authors_by_code.keys())
+
+        # A hash of every setting that affects how a script is parsed
+        # and when its tweets are posted.
+        self.config_digest = hashlib.md5(repr((
+            self.start_date.isoformat(),
+            str(config.get('chapter_duration_days')),
+            config['timezone'], self.fuzz_quotient,
+            self.fuzz_minimum_seconds,
+            int(self.account_spacing.total_seconds()),
+            sorted((author['code'], author['account'])
+                   for author in self.authors)))).hexdigest()
 
     def parse(self, line, stream_so_far):
         is_command = False
@@ -141,60 +627,47 @@ class TweetParser(TimezoneAware):
                          progress=self.progress)
 
         # The "command" may actually be the first word of the tweet.
-        # Extract commands from it until there's nothing left.
-        # If there is something left, it's not a command.
-        for author_code, possible_author in self.authors_by_code.items():
-            if author_code != "" and author_code in command:
-                author = possible_author
-                command = command.replace(author_code, "", 1)
-                break
-
+        # If it's not made up entirely of commands, it's part of the
+        # tweet.
         is_reply = False
-        if REPLY_TO_CODE in command:
-            reply_to = stream_so_far.latest_tweet
-            command = command.replace(REPLY_TO_CODE, "", 1)
-            is_reply = True
-
-        match = DELAY_CODE.match(command)
-        if match is not None:
-            number, unit = match.groups()
-            subcommand = "".join(match.groups())
-            command = command.replace(subcommand, "")
-            kwargs = { DELAY_UNITS[unit]: int(number) }
-            delay = timedelta(**kwargs)
-
-        match = TIME_OF_DAY_CODE.match(command)
-        if match is not None:
-            hour, am = match.groups()
-            subcommand = "".join(match.groups())
-            command = command.replace(subcommand, "")
-            hour = int(hour)
-            if am == "A" and hour == 12:
-                hour = 0
-            if am == "P" and hour != 12:
-                hour += 12
-            if hour > 23:
-                raise ValueError("Bad time of day %s in %s" % (
-                        subcommand, line))
-            hour_of_day = hour
-
-        if command == "":
-            # The first word has been entirely processed as
-            # commands. The rest of the line is the actual content.
+        tokens = self.lexer.lex(command)
+        if tokens is not None:
+            # The rest of the line is the actual content.
             line = tweet
-        else:
-            # The first word was not a command.
-            author = self.default_author
-            reply_to = None
-            delay = None
-            is_reply = False
+            author_code, is_reply, delay_code, time_code = tokens
+            if author_code is not None:
+                author = self.authors_by_code[author_code]
+            if is_reply:
+                reply_to = stream_so_far.latest_tweet
+
+            if delay_code is not None:
+                delay = self.delays.get(delay_code)
+                if delay is None:
+                    number, unit = DELAY_CODE.match(delay_code).groups()
+                    kwargs = { DELAY_UNITS[unit]: int(number) }
+                    delay = timedelta(**kwargs)
+                    # Scripts use the same few delays over and over, so
+                    # tweets can share timedelta objects.
+                    self.delays[delay_code] = delay
+
+            if time_code is not None:
+                hour, am = TIME_OF_DAY_CODE.match(time_code).groups()
+                hour = int(hour)
+                if am == "A" and hour == 12:
+                    hour = 0
+                if am == "P" and hour != 12:
+                    hour += 12
+                if hour > 23:
+                    raise ValueError("Bad time of day %s in %s" % (
+                            time_code, command + " " + tweet))
+                hour_of_day = hour
 
         if is_reply and stream_so_far.latest_tweet is None:
             raise ValueError(
                 "The first tweet in the script cannot be a reply.")
 
         if delay is None and hour_of_day is None:
-            if len(stream_so_far.current_day.tweets) == 0 and stream_so_far.current_chapter.total_tweets > 0:
+            if stream_so_far.current_day.total_tweets == 0 and stream_so_far.current_chapter.total_tweets > 0:
                 # This is the first tweet of an in-story day, and no
                 # special date instructions were given, so publish it at
                 # the start of the next real-world day.
@@ -215,29 +688,43 @@ class Chapter:
         self.name = name
         self.days = []
         self.start_date = start_date
+        self.source = hashlib.md5(name)
 
-    @property
-    def in_story_timeline_html(self):
-        return "\n".join(
-            ["<h2>%s</h2>\n" % self.name] +
-            #["<p>%s days, %s tweets</p>\n" % (
-            #        len(self.days), self.total_tweets)] +
-            [day.in_story_timeline_html for day in self.days])
-
-    @property
-    def real_world_timeline_html(self):
-        chapter_start_date = self.start_date.strftime(Tweet.REAL_WORLD_TIMELINE_DATE_FORMAT)
-        if chapter_start_date != self.real_days[0].date:
-            print '[WARNING] Chapter "%s" starts on %s, but its first tweet happens on %s' % (
-                self.name, chapter_start_date, self.real_days[0].date)
-        return "\n".join(
-            ["<h2>%s</h2>\n" % self.name] +
-            [day.real_world_timeline_html for day in self.real_days])
+        # These are kept up to date by add_tweet(), so the parser can
+        # find out where it is in the chapter without walking it.
+        self.total_tweets = 0
+        self.first_tweet = None
+        self.last_tweet = None
 
+    def add_source_line(self, line):
+        """Note a line of script that's part of this chapter."""
+        self.source.update(line)
+        self.source.update("\n")
 
     @property
-    def total_tweets(self):
-        return sum(len(x.tweets) for x in self.days)
+    def source_digest(self):
+        if isinstance(self.source, str):
+            return self.source
+        return self.source.hexdigest()
+
+    def __getstate__(self):
+        # A hashlib object can't be pickled. Once a chapter has been
+        # parsed, its digest is all that's needed.
+        state = dict(self.__dict__)
+        state['source'] = self.source_digest
+        return state
+
+    def add_tweet(self, day, tweet, retain=True):
+        """Add a tweet to one of this chapter's days.
+
+        :param retain: If this is False, the tweet is counted but not
+            kept in memory.
+        """
+        day.add_tweet(tweet, retain)
+        if self.first_tweet is None:
+            self.first_tweet = tweet
+        self.last_tweet = tweet
+        self.total_tweets += 1
 
     @property
     def all_tweets(self):
@@ -245,21 +732,6 @@ class Chapter:
             for t in d.tweets:
                 yield t
 
-    @property
-    def real_days(self):
-        """A list of Day objects corresponding to real-world days for this chapter."""
-        days = []
-        current_date = None
-        current_day = None
-        for story_day in self.days:
-            for tweet in story_day.tweets:
-                if tweet.timestamp_date_str != current_date:
-                    current_date = tweet.timestamp_date_str
-                    current_day = Day(current_date)
-                    days.append(current_day)
-                current_day.tweets.append(tweet)
-        return days
-
 
 class Day:
 
@@ -268,28 +740,37 @@ class Day:
     def __init__(self, date):
         self.date = date
         self.tweets = []
+        self.total_tweets = 0
 
-    @property
-    def in_story_timeline_html(self):
-        if len(self.tweets) == 0:
-            return ""
-        return "\n".join(
-            ["<h3>%s</h3>" % self.date, "<ul>"] +
-            [tweet.in_story_timeline_html for tweet in self.tweets] + ["</ul>"])
-
-    @property
-    def real_world_timeline_html(self):
-        if len(self.tweets) == 0:
-            return ""
-        return "\n".join(
-            ["<h3>%s</h3>" % self.date, "<ul>"] +
-            [tweet.real_world_timeline_html for tweet in self.tweets] + ["</ul>"])
+    def add_tweet(self, tweet, retain=True):
+        if retain:
+            self.tweets.append(tweet)
+        self.total_tweets += 1
 
 class Tweet(TimezoneAware):
 
+    # A long script means a lot of Tweet objects. Without a __dict__
+    # each one takes up much less memory.
+    __slots__ = ('text', 'author', 'timezone', 'in_reply_to', 'digest',
+                 'delay', 'hour_of_day', 'base_timecode', 'timestamp',
+                 'formatted_timestamp')
+
     REAL_WORLD_TIMELINE_TIME_FORMAT = "%H:%M"
     REAL_WORLD_TIMELINE_DATE_FORMAT = "%a %d %b"
 
+    def __getstate__(self):
+        # Much faster to pickle than the dict pickle would otherwise
+        # make from the slots.
+        return (self.text, self.author, self.timezone, self.in_reply_to,
+                self.digest, self.delay, self.hour_of_day,
+                self.base_timecode, self.timestamp)
+
+    def __setstate__(self, state):
+        (self.text, self.author, self.timezone, self.in_reply_to,
+         self.digest, self.delay, self.hour_of_day, self.base_timecode,
+         self.timestamp) = state
+        self.formatted_timestamp = None
+
     def __init__(self, text, author, base_timecode, timezone, delay=None,
                  hour_of_day=None, in_reply_to=None, progress=None):
         self.text = text
@@ -305,15 +786,14 @@ class Tweet(TimezoneAware):
 
         # In general, timestamps are calculated in a second pass.
         self.timestamp = None
+        # The timestamp, and its time and date as shown in the HTML
+        # timeline.
+        self.formatted_timestamp = None
 
         # However, if this tweet has already been posted, we know its
         # timestamp already.
         if progress is not None:
-            as_posted = progress.posts.get(self.digest)
-            if as_posted is not None:
-                self.timestamp = datetime.strptime(
-                    as_posted['planned_timestamp'], JSON_TIME_FORMAT).replace(
-                    tzinfo=pytz.timezone("UTC"))
+            self.use_progress(progress)
 
         if (self.hour_of_day is not None and self.delay is not None
             and self.delay < timedelta(days=1)):
@@ -321,8 +801,25 @@ class Tweet(TimezoneAware):
                 '"%s" defines both a delay and an hour of day, but the delay '
                 'is less than one day.' % text)
 
+    def use_progress(self, progress):
+        """If this tweet has already been posted, take its timestamp
+        from the progress.
+        """
+        as_posted = progress.get(self.digest)
+        if as_posted is not None:
+            self.timestamp = from_epoch(
+                parse_timestamp(as_posted['planned_timestamp']))
+
     def calculate_timestamp(self, fuzz_quotient, fuzz_minimum_seconds,
-                            previous_tweet):
+                            previous_tweet, rng=random, not_before=None):
+        """Calculate a fuzzed timestamp that comes after the previous
+        tweet's timestamp.
+
+        :param rng: The source of randomness for the fuzz: the random
+            module or a random.Random object.
+        :param not_before: If this is given, the timestamp will be no
+            earlier than this.
+        """
         timestamp = self.base_timecode or previous_tweet.timestamp
         if self.timestamp is not None:
             # This tweet already has a timestamp, possibly because
@@ -350,68 +847,95 @@ class Tweet(TimezoneAware):
 
         # Now we have a precise timestamp. But posting one tweet
         # exactly 30 minutes after another one will look fake. We need
-        # to fudge the timestamp a little.
+        # to fudge the timestamp a little, by picking a number of
+        # seconds between `earliest` and `latest` to add to it.
 
         if self.hour_of_day is not None:
             # We know which hour the tweet should go out. Pick
             # sometime in the first 45 minutes of that hour, to
             # minimize the chances of collisions with future tweets.
-            actual_delta = timedelta(seconds=random.randint(0, 45*60))
-            timestamp = timestamp + actual_delta
+            earliest, latest = 0, 45*60
         elif self.delay is not None:
             # We know approximately how long after the previous tweet
-            # this tweet should go out. Pick sometime
+            # this tweet should go out. Pick sometime around then.
             delay_seconds = self.delay.seconds
-            maximum_variation = max(
-                delay_seconds * fuzz_quotient, fuzz_minimum_seconds)
-            actual_variation = random.randint(-maximum_variation, maximum_variation)
-            actual_delta = timedelta(seconds=actual_variation)
-            if random.randint(0,1) == 1:
-                timestamp = timestamp + actual_delta
-            else:
-                timestamp = timestamp - actual_delta
+            maximum_variation = int(max(
+                delay_seconds * fuzz_quotient, fuzz_minimum_seconds))
+            earliest, latest = -maximum_variation, maximum_variation
         else:
             raise ValueError(
                 'Tweet "%s" has neither hour-of-day nor delay since previous '
                 'tweet. Cannot calculate timestamp.' % self.text)
-        return timestamp
+
+        # This tweet has to go out after the previous one, and no
+        # earlier than `not_before`. Rather than picking offsets until
+        # one of them works, pick from the part of the window that
+        # satisfies both.
+        allowed = not_before
+        if previous_tweet is not None:
+            after_previous = previous_tweet.timestamp + ONE_SECOND
+            if allowed is None or after_previous > allowed:
+                allowed = after_previous
+        if allowed is not None:
+            earliest = max(earliest, int(math.ceil(
+                (allowed - timestamp).total_seconds())))
+            if earliest > latest:
+                # Nothing in the window is late enough. Going out a
+                # little late looks more natural than going out of
+                # order, so use the first moment that works.
+                latest = earliest
+                instrument.count("tweets_pushed_back")
+
+        return timestamp + timedelta(seconds=rng.randint(earliest, latest))
 
     @property
     def json(self):
+        # Digests never need escaping, and timestamps are integers.
         if self.in_reply_to is None:
-            in_reply_to = None
+            in_reply_to = "null"
         else:
-            in_reply_to = self.in_reply_to.digest
-        d = dict(internal_id=self.digest, text=self.text,
-                 author=self.author['account'],
-                 in_reply_to=in_reply_to, timestamp=self.timestamp_for_json)
-        return json.dumps(d)
+            in_reply_to = '"%s"' % self.in_reply_to.digest
+        return JSON_RECORD_TEMPLATE % dict(
+            internal_id='"%s"' % self.digest,
+            text=encode_json_string(self.text),
+            author=encode_json_string(self.author['account']),
+            in_reply_to=in_reply_to,
+            timestamp=self.timestamp_for_json)
 
     def li(self, text):
-        a = []
+        li = '<li class="%s">%s</li>' % (self.author['css_class'], text)
         if self.in_reply_to is not None:
-            a.append("<ul>")
-        a.append('<li class="%s">%s</li>' % (self.author['css_class'], text))
-        if self.in_reply_to is not None:
-            a.append("</ul>")
-        return "\n".join(a)
+            return "<ul>\n%s\n</ul>" % li
+        return li
 
     @property
     def in_story_timeline_html(self):
         return self.li(self.text)
 
+    def format_timestamp(self):
+        """Format the time and date for the HTML timeline, once for
+        each timestamp the tweet is given.
+        """
+        formatted = self.formatted_timestamp
+        if formatted is None or formatted[0] is not self.timestamp:
+            formatted = self.formatted_timestamp = (
+                self.timestamp,
+                self.timestamp.strftime(self.REAL_WORLD_TIMELINE_TIME_FORMAT),
+                self.timestamp.strftime(self.REAL_WORLD_TIMELINE_DATE_FORMAT))
+        return formatted
+
     @property
     def timestamp_str(self):
-        return self.timestamp.strftime(self.REAL_WORLD_TIMELINE_TIME_FORMAT)
+        return self.format_timestamp()[1]
 
     @property
     def timestamp_for_json(self):
-        return self.timestamp.astimezone(pytz.timezone("UTC")).strftime(
-            JSON_TIME_FORMAT)
+        """When the tweet is to be posted, in seconds since the epoch."""
+        return to_epoch(self.timestamp)
 
     @property
     def timestamp_date_str(self):
-        return self.timestamp.strftime(self.REAL_WORLD_TIMELINE_DATE_FORMAT)
+        return self.format_timestamp()[2]
 
     @property
     def real_world_timeline_html(self):
@@ -420,7 +944,35 @@ class Tweet(TimezoneAware):
 
 class Stream:
 
-    def __init__(self, lines, tweet_parser=None, config=None, progress=None):
+    # If this is False, chapters, days and tweets are forgotten as
+    # soon as the parser is done with them.
+    retain_tweets = True
+
+    def __init__(self, lines, tweet_parser=None, config=None, progress=None,
+                 build_cache=None, processes=1, parse_cache=None):
+        """:param processes: If this is more than 1, chapters are parsed
+            and given timestamps in a pool of this many processes.
+        :param parse_cache: A ParseCache. If the script hasn't changed
+            since it was cached, it won't be parsed again. This only
+            works with one process.
+        """
+        self.setup(tweet_parser, config, progress)
+        self.build_cache = build_cache
+        if processes > 1:
+            with instrument.phase("parse_chapters"):
+                self.parse_chapters(lines, processes)
+        else:
+            if parse_cache is None or not self.load_parsed(parse_cache):
+                with instrument.phase("parse"):
+                    for tweet in self.parse(lines):
+                        pass
+                if parse_cache is not None:
+                    parse_cache.save(self.tweet_parser, self.chapters)
+            self.add_fuzz()
+        with instrument.phase("chapter_start_sanity_check"):
+            self.chapter_start_sanity_check()
+
+    def setup(self, tweet_parser, config, progress):
         if tweet_parser is None:
             if config is None:
                 raise ValueError(
@@ -428,11 +980,37 @@ class Stream:
                     "tweet parser or a configuration for one.")
             tweet_parser = TweetParser(config=config, progress=progress)
         self.current_chapter = None
+        self.latest_chapter = None
         self.current_day = None
         self.chapters = []
         self.tweet_parser = tweet_parser
         self.latest_tweet = None
-
+        # The latest timestamp given to each account's tweets.
+        self.timestamps_by_account = {}
+
+    def load_parsed(self, parse_cache):
+        """Pick up the parsed script from a ParseCache.
+
+        :return: Whether the script was in the cache.
+        """
+        chapters = parse_cache.load(self.tweet_parser)
+        if chapters is None:
+            return False
+        self.chapters = chapters
+        if len(chapters) > 0:
+            self.latest_chapter = chapters[-1]
+        progress = self.tweet_parser.progress
+        for tweet in self.tweets:
+            # Tweets that have been posted since the script was cached
+            # keep the timestamps they were posted with.
+            if progress is not None:
+                tweet.use_progress(progress)
+            self.latest_tweet = tweet
+        return True
+
+    def parse(self, lines):
+        """Parse lines of script, yielding each tweet as it's added."""
+        tweets = 0
         for line in lines:
             line = line.strip()
             if len(line) == 0:
@@ -445,44 +1023,31 @@ class Stream:
                 self.end_day()
                 self.begin_day(line[3:])
             else:
-                self.add_tweet(line)
+                tweets += 1
+                yield self.add_tweet(line)
         self.end_chapter()
-        self.add_fuzz()
-        self.chapter_start_sanity_check()
+        instrument.count("tweets_parsed", tweets)
 
+    @instrument.timed("html_page")
     def html_page(self, real_time=False):
+        output = StringIO()
+        HTMLTimeline(self, real_time).write(output)
+        return output.getvalue()
 
-        START = '''<html>
-<head>
-<meta http-equiv="Content-Type" content="text/html; charset=utf-8">
-'''
-
-        l = [START]
-        l.append('<style type="text/css">')
-        for author in self.tweet_parser.authors:
-              l.append(".%s { background-color: %s }" % (
-                      author['css_class'], author['color']))
-        l.append('</style></head><body>')
-
-        l.append("<p>Author guide:</p>")
-        l.append("<ul>")
-        for author in self.tweet_parser.authors:
-            l.append('<li class="%s">%s</a>' % (author['css_class'], author['account']))
-        l.append("</ul>")
-        if real_time:
-            l.append(self.real_world_timeline_html)
-        else:
-            l.append(self.in_story_timeline_html)
-        l.append("</body></html")
-        return "\n".join(l)
+    @instrument.timed("write_html")
+    def write_html(self, handle, real_time=False):
+        """Write the HTML timeline to a file as it's generated."""
+        HTMLTimeline(self, real_time).write(handle)
 
-    @property
-    def in_story_timeline_html(self):
-        return "\n\n".join(chapter.in_story_timeline_html for chapter in self.chapters)
+    @instrument.timed("write_html")
+    def write_html_pages(self, directory, split, real_time=False):
+        """Write the HTML timeline as one page per chapter or per week,
+        plus an index page.
 
-    @property
-    def real_world_timeline_html(self):
-        return "\n\n".join(chapter.real_world_timeline_html for chapter in self.chapters)
+        :return: A list of the filenames written, starting with the
+            index page.
+        """
+        return HTMLTimeline(self, real_time).write_pages(directory, split)
 
     @property
     def tweets(self):
@@ -499,7 +1064,9 @@ class Stream:
 
         line = line.strip()
         tweet = self.tweet_parser.parse(line, self)
-        self.current_day.tweets.append(tweet)
+        self.current_chapter.add_source_line(line)
+        self.current_chapter.add_tweet(
+            self.current_day, tweet, self.retain_tweets)
         self.latest_tweet = tweet
         return tweet
 
@@ -512,15 +1079,17 @@ class Stream:
         self.current_chapter = None
 
     def begin_chapter(self, chapter_name):
-        if len(self.chapters) == 0:
+        previous_chapter = self.latest_chapter
+        if previous_chapter is None:
             start_date = self.tweet_parser.start_of_day(
                 self.tweet_parser.config['start_date'])
         else:
-            previous_chapter = self.chapters[-1]
             duration = self.tweet_parser.config['chapter_duration_days']
             start_date = previous_chapter.start_date + duration
         self.current_chapter = Chapter(chapter_name, start_date)
-        self.chapters.append(self.current_chapter)
+        self.latest_chapter = self.current_chapter
+        if self.retain_tweets:
+            self.chapters.append(self.current_chapter)
 
     def end_day(self):
         if self.current_day is None:
@@ -529,51 +1098,317 @@ class Stream:
 
     def begin_day(self, date):
         self.current_day = Day(date)
-        self.current_chapter.days.append(self.current_day)
+        self.current_chapter.add_source_line("-- " + date)
+        if self.retain_tweets:
+            self.current_chapter.days.append(self.current_day)
 
 
+    @instrument.timed("add_fuzz")
     def add_fuzz(self):
         previous_tweet = None
-        for tweet in self.tweets:
-            progress = self.tweet_parser.progress
-            if (progress is not None
-                and progress.posts.get(tweet.digest) is not None):
-                # This tweet has already been posted. Don't mess with it.
+        for chapter in self.chapters:
+            key, timestamps = self.cached_timestamps(chapter, previous_tweet)
+            previous_tweet = self.fuzz_chapter(
+                chapter, previous_tweet, key, timestamps)
+
+    def cached_timestamps(self, chapter, previous_tweet):
+        """Look up a chapter in the build cache.
+
+        :return: A 2-tuple (cache key, cached timestamps or None).
+        """
+        if self.build_cache is None:
+            return None, None
+        key = self.build_cache.key(self.tweet_parser, chapter, previous_tweet)
+        return key, self.build_cache.get(key, chapter)
+
+    def fuzz_chapter(self, chapter, previous_tweet, key, timestamps):
+        """Give every tweet in a chapter a timestamp.
+
+        :param timestamps: The chapter's timestamps from the build
+            cache, if any.
+        :return: The last tweet so far.
+        """
+        if timestamps is None:
+            for tweet in chapter.all_tweets:
+                self.fuzz_tweet(tweet, previous_tweet)
+                previous_tweet = tweet
+            if self.build_cache is not None:
+                self.build_cache.put(key, chapter)
+        else:
+            # This chapter hasn't changed since the last build.
+            # Reuse its timestamps.
+            timezone = self.tweet_parser.timezone
+            for tweet, timestamp in zip(chapter.all_tweets, timestamps):
+                if tweet.timestamp is None:
+                    tweet.timestamp = self.build_cache.local_timestamp(
+                        timestamp, timezone)
+                self.timestamps_by_account[
+                    tweet.author['account']] = tweet.timestamp
                 previous_tweet = tweet
+        return previous_tweet
+
+    def parse_chapters(self, lines, processes):
+        """Parse the script and calculate its timestamps, with each
+        chapter handled separately in a pool of processes.
+
+        Apart from a reply at the start of a chapter, and timestamps
+        that have to come after the previous chapter's, chapters don't
+        depend on each other. Those are fixed up as the chapters come
+        back from the pool, in order.
+        """
+        pool = multiprocessing.Pool(
+            processes, start_chapter_process, (self.tweet_parser,))
+        try:
+            previous_tweet = None
+            for chapter, posted, timestamps_by_account in pool.imap(
+                parse_chapter, enumerate(split_chapters(lines))):
+                self.chapters.append(chapter)
+                previous_tweet = self.stitch_chapter(
+                    chapter, posted, timestamps_by_account, previous_tweet)
+                instrument.count("tweets_parsed", len(posted))
+        finally:
+            pool.terminate()
+        if len(self.chapters) > 0:
+            self.latest_chapter = self.chapters[-1]
+        self.latest_tweet = previous_tweet
+
+    def stitch_chapter(self, chapter, posted, timestamps_by_account,
+                       previous_tweet):
+        """Connect a chapter parsed in another process to the chapters
+        before it.
+
+        :param posted: Whether each of the chapter's tweets had already
+            been posted, and so had a timestamp before it was fuzzed.
+        :param timestamps_by_account: The latest timestamp given to
+            each account's tweets in this chapter.
+        :return: The last tweet so far.
+        """
+        first = chapter.first_tweet
+        if first is not None and first.in_reply_to == PREVIOUS_CHAPTER:
+            first.in_reply_to = previous_tweet
+
+        key, timestamps = self.cached_timestamps(chapter, previous_tweet)
+        if timestamps is None and self.follows(
+            chapter, posted, previous_tweet):
+            # The timestamps from the other process can be kept.
+            if self.build_cache is not None:
+                self.build_cache.put(key, chapter)
+            self.timestamps_by_account.update(timestamps_by_account)
+            return chapter.last_tweet or previous_tweet
+
+        # Calculate the chapter's timestamps again, as though it had
+        # been parsed here.
+        instrument.count("chapters_refuzzed")
+        for tweet, was_posted in zip(chapter.all_tweets, posted):
+            if not was_posted:
+                tweet.timestamp = None
+        return self.fuzz_chapter(chapter, previous_tweet, key, timestamps)
+
+    def follows(self, chapter, posted, previous_tweet):
+        """Do a chapter's timestamps, calculated without knowing about
+        the chapters before it, still come after those chapters'
+        tweets, and far enough after each account's last tweet?
+        """
+        if previous_tweet is None:
+            return True
+        spacing = self.tweet_parser.account_spacing
+        after_previous = previous_tweet.timestamp + ONE_SECOND
+        latest = max(self.timestamps_by_account.values()) + spacing
+        # Tweets that have already been posted may be out of order, in
+        # which case every tweet has to be checked.
+        in_order = True not in posted
+        for tweet, was_posted in zip(chapter.all_tweets, posted):
+            if (in_order and tweet.timestamp >= after_previous
+                and tweet.timestamp >= latest):
+                # Every tweet from here on is later still.
+                return True
+            if was_posted:
                 continue
-            success = False
-            for i in range(0, 10):
-                tweet.timestamp = tweet.calculate_timestamp(
-                    self.tweet_parser.fuzz_quotient,
-                    self.tweet_parser.fuzz_minimum_seconds,
-                    previous_tweet)
-                if (previous_tweet is None
-                    or previous_tweet.timestamp < tweet.timestamp):
-                    # This timestamp is fine. Stop trying to calculate it.
-                    success = True
-                    break
-                # If we didn't break, the timestamp we calculated came
-                # before previous tweet's timestamp, which is a
-                # problem. Restart the loop and calculate a different
-                # timestamp.
-            if not success:
-                # We tried to calculate the timestamp ten times with
-                # no success. Raise an error.
-                raise ValueError('Calculated timestamp for "%s" is %s, which comes before calculated timestamp for the previous tweet "%s" (%s). Trying again may help.' % (
-                        tweet.text, tweet.timestamp_str, previous_tweet.text, previous_tweet.timestamp_str))
-            previous_tweet = tweet
+            if tweet is chapter.first_tweet and tweet.timestamp < after_previous:
+                return False
+            if spacing:
+                account_latest = self.timestamps_by_account.get(
+                    tweet.author['account'])
+                if (account_latest is not None
+                    and tweet.timestamp < account_latest + spacing):
+                    return False
+        return True
+
+    def fuzz_tweet(self, tweet, previous_tweet):
+        """Give a tweet a timestamp that comes after the previous tweet's,
+        and far enough after its author's last tweet.
+        """
+        account = tweet.author['account']
+        progress = self.tweet_parser.progress
+        if progress is None or tweet.digest not in progress:
+            # This tweet hasn't been posted yet, so it needs a timestamp.
+            not_before = None
+            latest_for_account = self.timestamps_by_account.get(account)
+            if (latest_for_account is not None
+                and self.tweet_parser.account_spacing):
+                not_before = latest_for_account + self.tweet_parser.account_spacing
+            tweet.timestamp = tweet.calculate_timestamp(
+                self.tweet_parser.fuzz_quotient,
+                self.tweet_parser.fuzz_minimum_seconds,
+                previous_tweet, self.tweet_parser.random, not_before)
+        self.timestamps_by_account[account] = tweet.timestamp
 
     def chapter_start_sanity_check(self):
+        if len(self.chapters) == 0:
+            # An empty script has no chapters to check.
+            return
         previous_chapter = self.chapters[0]
         for chapter in self.chapters[1:]:
-            tweets = list(previous_chapter.all_tweets)
-            if len(tweets) > 0:
-                previous_chapter_last_tweet = tweets[-1]
-                if previous_chapter_last_tweet.timestamp > chapter.start_date:
-                    print '[WARNING] Last tweet in chapter "%s" overlaps the start of chapter "%s"' % (
-                        previous_chapter.name, chapter.name)
+            self.check_chapter_start(previous_chapter, chapter)
             previous_chapter = chapter
 
+    def check_chapter_start(self, previous_chapter, chapter):
+        """Warn if the previous chapter runs into this one."""
+        previous_chapter_last_tweet = previous_chapter.last_tweet
+        if previous_chapter_last_tweet is not None:
+            if previous_chapter_last_tweet.timestamp > chapter.start_date:
+                print '[WARNING] Last tweet in chapter "%s" overlaps the start of chapter "%s"' % (
+                    previous_chapter.name, chapter.name)
+
     @property
+    @instrument.timed("json")
     def json(self):
-        return "\n".join(tweet.json for tweet in self.tweets)
+        return "\n".join(self.json_lines)
+
+    @property
+    def timeline_tweets(self):
+        """Yield every tweet in the timeline, in order."""
+        return self.tweets
+
+    @property
+    def json_lines(self):
+        """Yield one timeline.json record per tweet."""
+        for tweet in self.timeline_tweets:
+            yield tweet.json
+
+    @instrument.timed("write_json")
+    def write_json(self, handle, binary_writer=None):
+        """Write timeline.json to a file, one chunk of records at a time,
+        without ever building the whole thing in memory.
+
+        :param binary_writer: A BinaryTimelineWriter. If this is
+            given, every tweet is also added to the binary timeline.
+        """
+        chunk = []
+        for tweet in self.timeline_tweets:
+            chunk.append(tweet.json)
+            if binary_writer is not None:
+                binary_writer.add(tweet)
+            if len(chunk) == JSON_CHUNK_SIZE:
+                chunk.append("")
+                handle.write("\n".join(chunk))
+                chunk = []
+        if len(chunk) > 0:
+            chunk.append("")
+            handle.write("\n".join(chunk))
+
+
+def split_chapters(lines):
+    """Split the lines of a script into one list of lines per chapter."""
+    chunk = []
+    for line in lines:
+        if line.strip()[:3] == "== ":
+            if any(x.strip() for x in chunk):
+                yield chunk
+            chunk = []
+        chunk.append(line)
+    if any(x.strip() for x in chunk):
+        yield chunk
+
+# The TweetParser used by a process in the pool that parses chapters.
+chapter_parser = None
+
+def start_chapter_process(tweet_parser):
+    global chapter_parser
+    chapter_parser = tweet_parser
+    if isinstance(tweet_parser.progress, ProgressLog):
+        # The progress log's SQLite connection can't be shared with
+        # the parent process.
+        tweet_parser.progress = ProgressLog(tweet_parser.progress.filename)
+
+def parse_chapter(job):
+    """Parse one chapter of a script and calculate its timestamps.
+
+    :param job: A 2-tuple (the index of the chapter, its lines).
+    :return: A 3-tuple (the Chapter, whether each tweet had already
+        been posted, the latest timestamp for each account).
+    """
+    index, lines = job
+    stream = ChapterStream(chapter_parser, index)
+    for tweet in stream.parse(lines):
+        pass
+    chapter = stream.latest_chapter
+    posted = [tweet.timestamp is not None for tweet in chapter.all_tweets]
+
+    # Each chapter gets its own source of fuzz, so that the same
+    # random seed always gives the same timestamps.
+    seed = chapter_parser.config.get('random_seed')
+    if seed is not None:
+        seed = int(hashlib.md5(repr((seed, index))).hexdigest(), 16)
+    chapter_parser.random = random.Random(seed)
+    stream.add_fuzz()
+    return chapter, posted, stream.timestamps_by_account
+
+
+class ChapterStream(Stream):
+    """One chapter of a script, parsed on its own in another process."""
+
+    def __init__(self, tweet_parser, index):
+        self.setup(tweet_parser, None, None)
+        self.build_cache = None
+        self.index = index
+        if index > 0:
+            # The previous chapter is in another process.
+            self.latest_tweet = PREVIOUS_CHAPTER
+
+    def begin_chapter(self, chapter_name):
+        Stream.begin_chapter(self, chapter_name)
+        self.current_chapter.start_date += (
+            self.tweet_parser.config['chapter_duration_days'] * self.index)
+
+
+class StreamingStream(Stream):
+    """A Stream that turns a script into timeline.json records as it
+    parses, without ever holding the whole script in memory.
+
+    Only the most recent tweet and the current chapter and day are
+    kept around, so this can handle scripts of any size. The tradeoff
+    is that there's no HTML output.
+    """
+
+    retain_tweets = False
+
+    def __init__(self, lines, tweet_parser=None, config=None, progress=None,
+                 build_cache=None, processes=1, parse_cache=None):
+        # Chapters are never complete in memory, so there's no way
+        # to use a build or parse cache, or to parse them in other
+        # processes.
+        self.setup(tweet_parser, config, progress)
+        self.lines = lines
+
+    def begin_chapter(self, chapter_name):
+        previous_chapter = self.latest_chapter
+        Stream.begin_chapter(self, chapter_name)
+        if previous_chapter is not None:
+            # Every tweet in the previous chapter already has its
+            # timestamp, so it can be checked now.
+            self.check_chapter_start(previous_chapter, self.current_chapter)
+
+    @property
+    def timeline_tweets(self):
+        """Parse the script, yielding each tweet once it has a timestamp."""
+        previous_tweet = None
+        for tweet in self.parse(self.lines):
+            if previous_tweet is not None:
+                # The previous tweet has been written out, so the
+                # tweet it replied to can be forgotten. Otherwise a
+                # long chain of replies would stay in memory.
+                previous_tweet.in_reply_to = None
+            self.fuzz_tweet(tweet, previous_tweet)
+            yield tweet
+            previous_tweet = tweet